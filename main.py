@@ -1,12 +1,46 @@
-import base64, datetime, io, os, PyPDF2, pytesseract, shutil, time
-from dash import Dash, dcc, html, Input, Output, State, callback
+import base64, box, datetime, os, shutil, threading, time, yaml
+from src.startup import components_ready, mark, phase, startup_report, warm_up
+from dash import Dash, dcc, html, Input, Output, State, callback, no_update
 import dash_daq as daq
-from src.db_build import run_db_build
-from src.llm import query, build_llm
-from pdf2image import convert_from_path
+from flask import Response, abort, jsonify, request, send_file
+from src.jobs import JobRunner, describe
+from src.scheduler import QueryScheduler, QueryTimeout, QueueFull
+from src.streaming import get_buffer, new_buffer, sse_events
+from src.profiling import forward, list_profiles, profile_path, profile_requested, profiled, render_profiles
+from src.tracing import render_metrics, span
+from src.uploads import UploadTooLarge, data_url_chunks, max_upload_bytes, store_upload, stream_chunks, upload_record
+# langchain, FAISS, torch and the OCR stack are imported at first use or by the warm-up thread
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+mark('imports')
+
+def load_llm():
+    from src.llm import build_llm
+    with phase(f'llm ({threading.current_thread().name})'):
+        return build_llm()
+
+def load_query_modules():
+    import src.corpus, src.db_build, src.llm
+
+def load_embeddings():
+    from src.registry import get_embeddings
+    get_embeddings()
+
+# Spawned pool workers (embedding, OCR) re-import this module as __mp_main__; only the server starts threads
+SERVER_PROCESS = __name__ != '__mp_main__'
 
 app = Dash(__name__)
-LLM = build_llm()
+SCHEDULER = QueryScheduler(load_llm)
+# Workers start once langchain is imported so the two threads never import it concurrently
+WARM_UP = warm_up([('query modules', load_query_modules),
+                   ('llm workers', SCHEDULER.start),
+                   ('embedding model', load_embeddings)]) if SERVER_PROCESS else None
+# Started once the job handlers below are defined
+JOBS = JobRunner({'transcribe': lambda params, progress: transcribe_job(params, progress),
+                  'index': lambda params, progress: index_job(params, progress),
+                  'ingest': lambda params, progress: ingest_job(params, progress)})
 
 sample_filename = 'PublicWaterMassMailing.pdf'
 db_dir = 'db/'
@@ -16,6 +50,92 @@ transcribed_dir = 'assets/temp/tx/'
 app.css.config.serve_locally = True
 app.scripts.config.serve_locally = True
 
+@app.server.route('/scheduler')
+def scheduler_metrics():
+    from src.prefix_cache import prefix_cache_stats
+    return jsonify(dict(SCHEDULER.metrics(), prefix_cache=prefix_cache_stats()))
+
+@app.server.route('/metrics')
+def metrics():
+    # Prometheus scrape target; scheduler counters and gauges are sampled at scrape time
+    counts = SCHEDULER.counts()
+    counters = {f'docqa_scheduler_requests_{key}_total': (f'Queries {key.replace("_", " ")} by the scheduler', value)
+                for key, value in counts.items()}
+    gauges = {f'docqa_scheduler_{key}': (f'Query scheduler {key.replace("_", " ")}', value)
+              for key, value in SCHEDULER.metrics().items() if key not in counts}
+    return Response(render_metrics(gauges, counters), mimetype='text/plain; version=0.0.4')
+
+@app.server.route('/profiles')
+def profiles():
+    return Response(render_profiles(list_profiles(cfg.PROFILE_LIST)), mimetype='text/html')
+
+@app.server.route('/profiles/<fname>')
+def profile_file(fname):
+    path = profile_path(fname)
+    if path is None:
+        abort(404)
+    return send_file(os.path.abspath(path), as_attachment=True)
+
+@app.server.route('/health')
+def health():
+    # Liveness only: the web server is up, whether or not the models have loaded
+    return jsonify({'status': 'ok', 'uptime_s': startup_report()['uptime_s']})
+
+@app.server.route('/ready')
+def ready():
+    report = startup_report()
+    metrics = SCHEDULER.metrics()
+    report['components']['llm'] = f"{metrics['workers_ready']}/{metrics['workers']} workers loaded"
+    report['llm_errors'] = SCHEDULER.load_errors
+    report['ready'] = components_ready() and SCHEDULER.ready()
+    return jsonify(report), 200 if report['ready'] else 503
+
+@app.server.route('/stream/<stream_id>')
+def stream_events(stream_id):
+    buffer = get_buffer(stream_id)
+    if buffer is None:
+        abort(404)
+    return Response(sse_events(buffer), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.server.route('/upload', methods=['POST', 'PUT'])
+def upload():
+    """ Raw PDF request body, written to disk as it arrives: POST /upload?filename=x.pdf[&then=index] """
+    filename = request.args.get('filename') or request.headers.get('X-Filename')
+    if not filename or not filename.lower().endswith('.pdf'):
+        return jsonify({'error': 'a .pdf filename is required'}), 400
+    if request.content_length and request.content_length > max_upload_bytes():
+        return jsonify({'error': f'{filename} exceeds the {cfg.UPLOAD_MAX_MB} MB upload limit'}), 413
+    try:
+        result = store_upload(stream_chunks(request.stream), filename, files_dir)
+    except UploadTooLarge as E:
+        return jsonify({'error': str(E)}), 413
+    if result['replaced']:
+        drop_transcription(result['filename'])
+    # Hand the stored file straight to a background job: ?then=transcribe, ?then=index or ?then=transcribe,index
+    then = request.args.get('then', '').split(',')
+    if 'index' in then:
+        result['job'] = JOBS.submit('ingest', {'filename': result['filename'],
+                                               'transcribe': 'transcribe' in then,
+                                               'chunk_size': cfg.CHUNK_SIZE,
+                                               'chunk_overlap': cfg.CHUNK_OVERLAP,
+                                               'upload': result['file_record']},
+                                    profile=profile_requested())
+    elif 'transcribe' in then:
+        result['job'] = JOBS.submit('transcribe', {'filename': result['filename']}, profile=profile_requested())
+    return jsonify(result)
+
+@app.server.route('/jobs')
+def list_jobs():
+    return jsonify(JOBS.recent())
+
+@app.server.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(dict(job, message=describe(job)))
+
 # # # start Misc. Helpers
 def base_filename(filename):
     return filename.replace('.pdf', '')
@@ -27,22 +147,17 @@ def get_transcribed_path(filename):
     return db_dir + base_filename(filename) + '/'
 
 def db_exists(db_path):
-    return os.path.exists(db_path+'index.faiss') and os.path.exists(db_path+'index.pkl')
-
-def transcribe_pdf(filepath, transcribed_filepath):
-    images = convert_from_path(filepath)
-    pdf_writer = PyPDF2.PdfWriter()
-    for i, image in enumerate(images):
-        print(f'Transcribing page {i+1} of {len(images)}')
-        page = pytesseract.image_to_pdf_or_hocr(image)
-        pdf = PyPDF2.PdfReader(io.BytesIO(page))
-        pdf_writer.add_page(pdf.pages[0])
-    print(f'{len(images)} pages transcribed')
-    with open(transcribed_filepath, 'wb') as f:
-        pdf_writer.write(f)
+    from src.chunk_store import index_exists
+    return index_exists(db_path)
 
 def is_transcribed(filename):
     return os.path.exists(transcribed_dir + filename)
+
+def page_range(page_from, page_to):
+    # UI pages are 1-based, chunk metadata pages are 0-based
+    if not page_from and not page_to:
+        return None
+    return ((page_from or 1) - 1, (page_to or 10**9) - 1)
 # # # end Misc. Helpers
 
 app.layout = html.Div([
@@ -74,6 +189,7 @@ app.layout = html.Div([
                     html.Button('Transcribe', id='transcribe-btn', style={'display':'inline-block', 'margin': '5px 10px', 'width':'99px', 'height':'40px', 'padding':'0px'}),
                     html.Div(children=[
                         dcc.Loading(id='transcribed',
+                                    children=html.Div([html.P('Not yet transcribed: only necessary when the .pdf is scanned')]),
                                     style={'display':'inline-flex'})],
                         style={'display':'inline-flex'})
                     ]),
@@ -104,7 +220,7 @@ app.layout = html.Div([
                 html.Div(children=[
                     html.Button('Index', id='index-btn', style={'display':'inline-block', 'margin':'5px 10px 40px 10px', 'width':'99px', 'height':'40px', 'padding':'0px'}),
                     html.Div(children=[
-                        dcc.Loading(html.Div(id='indexed'))], 
+                        dcc.Loading(html.Div(id='indexed', children=html.Div([html.P('Not yet indexed: pages without a text layer are OCR-ed while indexing')])))], 
                         style={'display':'inline-flex'})
                     ]),
                 html.Div(children=[
@@ -116,11 +232,29 @@ app.layout = html.Div([
                         placeholder='Enter question here and press query to submit', 
                         style={'margin':'5px 0px', 'width':'77%', 'height':'60px','display':'inline-block'})
                     ]),
+                html.Div(children=[
+                    dcc.RadioItems(
+                        id='query-scope',
+                        options=[{'label':'This document', 'value':'document'},
+                                 {'label':'All indexed documents', 'value':'corpus'}],
+                        value='document',
+                        inline=True,
+                        style={'display':'inline-block', 'margin-right':'20px'}),
+                    dcc.Input(id='page-from', type='number', min=1, placeholder='First page', style={'width':'90px', 'margin-right':'5px'}),
+                    dcc.Input(id='page-to', type='number', min=1, placeholder='Last page', style={'width':'90px'})
+                    ],
+                    style={'margin':'5px 10px'}),
                 dcc.Loading(
                     children=[
                         html.Div(id='output-query', 
                                  style={'margin':'10px 20px'})],
-                    type='default')
+                    type='default'),
+                dcc.Store(id='stream-id'),
+                dcc.Interval(id='stream-poll', interval=cfg.STREAM_POLL_MS, disabled=True),
+                # Session storage keeps job ids across page reloads; the poll runs once on load to pick them up
+                dcc.Store(id='transcribe-job', storage_type='session'),
+                dcc.Store(id='index-job', storage_type='session'),
+                dcc.Interval(id='job-poll', interval=cfg.JOB_POLL_MS, disabled=False)
                 ])
             ], 
             style={"width": '50%', 'display': 'inline-block', 'vertical-align':'top'})
@@ -137,10 +271,13 @@ app.layout = html.Div([
           State('filename-hidden', 'children'),
           prevent_initial_call=True)
 def delete_btn(n_clicks, cur_filename):
+    from src.corpus import remove_document
     print('Clearing temp uploaded and transcribed files')
     clear_files(files_dir, cur_filename); clear_files(transcribed_dir, cur_filename); 
     print('Clearing temp vector databases')
     clear_dir(db_dir)
+    if cur_filename != sample_filename:
+        remove_document(cur_filename)
     return [None]
 
 def clear_files(dir, cur_filename):
@@ -163,40 +300,94 @@ def clear_dir(dir):
                 print(f'Failed to delete {fname} from {dir}')
                 print(E)
 
-@callback(Output('output-query', 'children'),
+def finish_unstarted(buffer, future):
+    # Queries that time out or are cancelled before a worker picks them up never touch their buffer
+    if not buffer.done:
+        buffer.finish(error='Query timed out while waiting in the queue' if not future.cancelled() else 'Query cancelled')
+
+def render_response(response):
+    with span('render', documents=len(response['source_documents'])):
+        seconds, _, note = str(response['time']).partition(' ')
+        time_text = f'{seconds} seconds {note}'.strip()
+        if response.get('ttft') is not None:
+            time_text += f' (first token after {response["ttft"]} seconds)'
+        answer = response['result']
+        if not response.get('done', True):
+            answer += ' ...'
+        if response.get('error'):
+            answer += f' [Error: {response["error"]}]'
+        return html.Div(children=[
+            html.Div(children=[
+                html.B('Question:', style={'display':'inline-block', 'margin-right':'10px'}),
+                html.P(f'{response["query"]}', style={'display':'inline-block'})
+            ]),
+            html.Div(children=[
+                html.B('Answer: ', style={'display':'inline-block', 'margin-right':'10px'}),
+                html.P(f'{answer}', style={'display':'inline-block'})
+            ]),
+            html.Div(children=[
+                html.B('Time: ', style={'display':'inline-block', 'margin-right':'10px'}),
+                html.P(time_text, style={'display':'inline-block'})
+            ]),
+            html.Div(html.B('Citations:')),
+            html.Div(
+                children=[
+                    html.P([f'Page: {doc.metadata["page"]+1}',html.Br(), f'{doc.page_content}'], style={'margin':'20px 0px'}) for doc in response['source_documents']
+                ]
+            ),
+        ])
+
+@callback([Output('output-query', 'children'),
+           Output('stream-id', 'data'),
+           Output('stream-poll', 'disabled')],
           [Input('query-btn', 'n_clicks'),
            State('input-query', 'value'),
-           State('filename-hidden', 'children')],
+           State('filename-hidden', 'children'),
+           State('query-scope', 'value'),
+           State('page-from', 'value'),
+           State('page-to', 'value')],
            prevent_initial_callback=True)
-def llm_query(n_clicks, qstring, filename):
-    db_path = get_db_path(filename)
-    if n_clicks and db_exists(db_path):
+@profiled('llm_query')
+def llm_query(n_clicks, qstring, filename, scope, page_from, page_to):
+    from src.corpus import corpus_exists
+    from src.llm import cached_answer, query, stream_query
+    pages = page_range(page_from, page_to)
+    if scope == 'corpus':
+        db_path = cfg.CORPUS_DB_PATH if corpus_exists() else None
+    else:
+        db_path = get_db_path(filename)
+    if n_clicks and db_path and db_exists(db_path):
         if qstring and db_path:
             print(f'Querying: "{qstring}"')
-            response = query(qstring, db_path, LLM)
-            return html.Div(children=[
-                html.Div(children=[
-                    html.B('Question:', style={'display':'inline-block', 'margin-right':'10px'}),
-                    html.P(f'{response["query"]}', style={'display':'inline-block'})
-                ]),
-                html.Div(children=[
-                    html.B('Answer: ', style={'display':'inline-block', 'margin-right':'10px'}),
-                    html.P(f'{response["result"]}', style={'display':'inline-block'})
-                ]),
-                html.Div(children=[
-                    html.B('Time: ', style={'display':'inline-block', 'margin-right':'10px'}),
-                    html.P(f'{response["time"]} seconds', style={'display':'inline-block'})
-                ]),
-                html.Div(html.B('Citations:')),
-                html.Div(
-                    children=[
-                        html.P([f'Page: {doc.metadata["page"]+1}',html.Br(), f'{doc.page_content}'], style={'margin':'20px 0px'}) for doc in response['source_documents']
-                    ]
-                ),
-            ])
+            response = cached_answer(qstring, db_path, pages=pages)
+            if response is not None:
+                return render_response(response), None, True
+            try:
+                if cfg.STREAMING:
+                    buffer = new_buffer(qstring)
+                    future = SCHEDULER.submit(forward(lambda llm, callbacks: stream_query(qstring, db_path, llm, buffer, pages=pages, callbacks=callbacks, use_cache=False)))
+                    future.add_done_callback(lambda f: finish_unstarted(buffer, f))
+                    return render_response(buffer.response()), buffer.id, False
+                response = SCHEDULER.run(forward(lambda llm, callbacks: query(qstring, db_path, llm, pages=pages, callbacks=callbacks, use_cache=False)))
+                return render_response(response), None, True
+            except (QueueFull, QueryTimeout) as E:
+                print(E)
+                return html.Div(html.P(f'Server busy: {E}')), None, True
         elif qstring:
-            return html.Div(html.P('Index not yet built'))
-    return html.Div(html.P('Result will appear here'))
+            return html.Div(html.P('Index not yet built')), None, True
+    return html.Div(html.P('Result will appear here')), None, True
+
+@callback([Output('output-query', 'children', allow_duplicate=True),
+           Output('stream-poll', 'disabled', allow_duplicate=True)],
+          Input('stream-poll', 'n_intervals'),
+          State('stream-id', 'data'),
+          prevent_initial_call=True)
+def poll_stream(n_intervals, stream_id):
+    buffer = get_buffer(stream_id) if stream_id else None
+    if buffer is None:
+        return html.Div(html.P('Result will appear here')), True
+    response = buffer.response()
+    return render_response(response), response['done']
 
 @callback([Output('filename-hidden', 'children'),
            Output('transcribe-btn', 'n_clicks'),
@@ -207,8 +398,8 @@ def llm_query(n_clicks, qstring, filename):
            prevent_initial_call=True)
 def update_output(contents, filename, date):
     if contents is not None:
-        parse_contents(contents, filename, date)
-        return filename, 0, 0
+        stored = parse_contents(contents, filename, date)
+        return stored.get('filename', filename) if isinstance(stored, dict) else filename, 0, 0
 
 def parse_contents(contents, filename, date):
     if filename[-4:] == '.pdf':
@@ -217,14 +408,20 @@ def parse_contents(contents, filename, date):
         return parse_unsupported(filename)
 
 def parse_pdf(contents, filename, date):
-    content_type, content_data = contents.split(',')
+    try:
+        result = store_upload(data_url_chunks(contents), filename, files_dir)
+    except UploadTooLarge as E:
+        print(E)
+        return {}
+    if result['replaced']:
+        drop_transcription(result['filename'])
+    return result
+
+def drop_transcription(filename):
+    # A new upload under an existing name makes the earlier OCR output stale
     if is_transcribed(filename):
-        filepath = transcribed_dir + filename
-    else:
-        filepath = files_dir + filename
-    fh = open(filepath, 'wb')
-    fh.write(base64.b64decode(content_data))
-    fh.close()
+        os.remove(transcribed_dir + filename)
+        print(f'Removed stale transcription of {filename}')
 
 def parse_unsupported(filename):
     return html.Div(html.H5(f"{filename} is unsupported; only .pdf is currently supported"))
@@ -263,56 +460,115 @@ def update_preview(filepath, filename):
     return output_upload, filename_visible
 
 @callback([Output('transcribed', 'children'),
-           Output('filepath-hidden', 'children')],
+           Output('filepath-hidden', 'children'),
+           Output('transcribe-job', 'data'),
+           Output('job-poll', 'disabled')],
            [Input('transcribe-btn', 'n_clicks')],
-           [State('filename-hidden', 'children')])
+           [State('filename-hidden', 'children')],
+           prevent_initial_call=True)
+@profiled('transcribe')
 def transcribe(n_clicks, filename):
     n_clicks = n_clicks or 0
     filepath = files_dir + filename
-    transcribed_filepath = transcribed_dir + filename
     print(f'Filename: {filename}\nFilepath: {filepath}')
     if n_clicks >= 1:
-        if os.path.exists(transcribed_filepath):
-            text = f'Success: {filename} previously transcribed, cached file loaded'
+        if is_transcribed(filename):
             print(f'{filename} previously transcribed, loading cached file')
-        else:
-            try:
-                transcribe_pdf(filepath, transcribed_filepath)
-                text = f"Success: OCR applied to {filename} successfully"
-            except Exception as E:
-                print(E)
-                text = f'Failed to transcribe file: {E}'
-        filepath = transcribed_filepath
-    else:
-        text = 'Not yet transcribed: only necessary when the .pdf is scanned'
-    return html.Div([html.P(text)]), filepath
+            return (html.Div([html.P(f'Success: {filename} previously transcribed, cached file loaded')]),
+                    transcribed_dir + filename, None, no_update)
+        job_id = JOBS.submit('transcribe', {'filename': filename}, profile=profile_requested())
+        return html.Div([html.P('Queued')]), no_update, job_id, False
+    return html.Div([html.P('Not yet transcribed: only necessary when the .pdf is scanned')]), filepath, None, no_update
+
+def transcribe_document(filename, progress=None):
+    from src.ocr import transcribe_pdf
+    if is_transcribed(filename):
+        return f'Success: {filename} previously transcribed, cached file loaded'
+    transcribe_pdf(files_dir + filename, transcribed_dir + filename, progress=progress)
+    return f"Success: OCR applied to {filename} successfully"
 
-@callback([Output('indexed', 'children')],
+@callback([Output('indexed', 'children'),
+           Output('index-job', 'data'),
+           Output('job-poll', 'disabled', allow_duplicate=True)],
           [Input('index-btn', 'n_clicks')],
           [State('filename-hidden', 'children'),
            State('chunk-size-input', 'value'),
-           State('chunk-overlap-input', 'value')])
+           State('chunk-overlap-input', 'value')],
+          prevent_initial_call=True)
+@profiled('index')
 def index(n_clicks, filename, chunk_size, chunk_overlap):
     n_clicks = n_clicks or 0
-    db_path, text = None, None
     if n_clicks >= 1:
-        db_path = get_db_path(filename)
-        if not db_exists(db_path):
-            try:
-                print(f'Building index for {filename}')
-                if is_transcribed(filename):
-                    run_db_build(filename, transcribed_dir, db_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-                else:
-                    run_db_build(filename, files_dir, db_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-                text = f'Success: Index built for {filename}'
-            except Exception as E:
-                text = f'Error: Failed to build index for {filename}'
-                print(E)
-        else:
-            text = f'Index previously built for {filename}'
-    text = text or 'Not yet indexed: .pdf must be digital native or transcribed first'
-    return [html.Div([html.P(text)])]
+        job_id = JOBS.submit('index', {'filename': filename, 'chunk_size': chunk_size, 'chunk_overlap': chunk_overlap,
+                                       'upload': upload_record(filename, files_dir)},
+                             profile=profile_requested())
+        return html.Div([html.P('Queued')]), job_id, False
+    return html.Div([html.P('Not yet indexed: pages without a text layer are OCR-ed while indexing')]), None, no_update
+
+def index_document(filename, chunk_size, chunk_overlap, progress=None, upload=None):
+    from src.build_cache import remember_file
+    from src.corpus import add_document
+    from src.db_build import chunk_loader, run_db_build
+    db_path = get_db_path(filename)
+    data_path = transcribed_dir if is_transcribed(filename) else files_dir
+    if upload and data_path == files_dir:
+        # Hashed while it was uploaded; the index builds and the page cache reuse that instead of reading it again
+        remember_file(files_dir + filename, upload)
+    chunk_size = chunk_size or cfg.CHUNK_SIZE
+    chunk_overlap = chunk_overlap or cfg.CHUNK_OVERLAP
+    # Extracted and split at most once for both indexes
+    load = chunk_loader(data_path, filename, chunk_size, chunk_overlap, progress)
+    print(f'Building index for {filename}')
+    built = run_db_build(filename, data_path, db_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap, progress=progress, load=load)
+    add_document(filename, data_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap, progress=progress, load=load)
+    return f'Success: Index built for {filename}' if built else f'Index previously built for {filename}'
+
+# # # Background jobs
+def transcribe_job(params, progress):
+    return transcribe_document(params['filename'], progress)
+
+def index_job(params, progress):
+    return index_document(params['filename'], params['chunk_size'], params['chunk_overlap'], progress,
+                          params.get('upload'))
+
+def ingest_job(params, progress):
+    if params['transcribe']:
+        transcribe_document(params['filename'], progress)
+    return index_document(params['filename'], params['chunk_size'], params['chunk_overlap'], progress,
+                          params.get('upload'))
+
+def job_status(job_id, filename):
+    """ The job's UI text, or None when there is no such job or it belongs to another file """
+    job = JOBS.get(job_id) if job_id else None
+    if job is None or job['params']['filename'] != filename:
+        return None, False
+    return html.Div([html.P(describe(job))]), job['status'] in ('queued', 'running')
+
+@callback([Output('transcribed', 'children', allow_duplicate=True),
+           Output('filepath-hidden', 'children', allow_duplicate=True),
+           Output('indexed', 'children', allow_duplicate=True),
+           Output('job-poll', 'disabled', allow_duplicate=True)],
+          Input('job-poll', 'n_intervals'),
+          [State('transcribe-job', 'data'),
+           State('index-job', 'data'),
+           State('filename-hidden', 'children')],
+          prevent_initial_call=True)
+def poll_jobs(n_intervals, transcribe_job_id, index_job_id, filename):
+    transcribed, transcribing = job_status(transcribe_job_id, filename)
+    indexed, indexing = job_status(index_job_id, filename)
+    filepath = transcribed_dir + filename if transcribed is not None and is_transcribed(filename) else no_update
+    return (transcribed or no_update, filepath, indexed or no_update, not (transcribing or indexing))
+
+if SERVER_PROCESS:
+    JOBS.start()
+mark('layout and callbacks')
 
 if __name__ == '__main__':
+    if cfg.STARTUP_MODE == 'eager':
+        # Serve only once everything is loaded, as before background warm-up existed
+        WARM_UP.join()
+        while not SCHEDULER.ready() and len(SCHEDULER.load_errors) < SCHEDULER.n_workers:
+            time.sleep(0.5)
+    print(f'Startup: serving after {startup_report()["uptime_s"]}s')
     # app.run(debug=True, dev_tools_hot_reload=True)
     app.run(debug=False, dev_tools_hot_reload=False)
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import sys, struct, math, argparse
+import sys, struct, math, argparse, time
 from pathlib import Path
 
 import numpy as np
@@ -26,6 +26,13 @@ GGML_QUANT_SIZES = {
     gguf.GGMLQuantizationType.Q8_K : (256, 4 + QK_K + QK_K // 8),
 }
 
+# Fixed-size records, decoded straight from the memmap
+HPARAMS_DTYPE = np.dtype([(name, '<u4') for name in ('n_vocab', 'n_embd', 'n_mult', 'n_head', 'n_layer', 'n_rot', 'ftype')])
+# Variable-length records are walked with precompiled structs reading the memmap in place
+UINT32 = struct.Struct('<I')
+TENSOR_HEADER = struct.Struct('<3I')
+BYTE_TOKENS = [bytes(f'<0x{i:02X}>', encoding = 'UTF-8') for i in range(256)]
+
 class Hyperparameters:
     def __init__(self):
         self.n_vocab = self.n_embd = self.n_mult = self.n_head = self.n_layer = self.n_rot = self.ftype = 0
@@ -38,36 +45,49 @@ class Hyperparameters:
         self.n_ff = ff_tensor.dims[1]
 
     def load(self, data, offset):
-        (
-            self.n_vocab,
-            self.n_embd,
-            self.n_mult,
-            self.n_head,
-            self.n_layer,
-            self.n_rot,
-            self.ftype,
-        ) = struct.unpack('<7I', data[offset:offset + (4 * 7)])
-        return 4 * 7
+        header = np.frombuffer(data, dtype = HPARAMS_DTYPE, count = 1, offset = offset)[0]
+        for name in HPARAMS_DTYPE.names:
+            setattr(self, name, int(header[name]))
+        return HPARAMS_DTYPE.itemsize
 
     def __str__(self):
         return f'<Hyperparameters: n_vocab={self.n_vocab}, n_embd={self.n_embd}, n_mult={self.n_mult}, n_head={self.n_head}, n_layer={self.n_layer}, n_rot={self.n_rot}, n_ff={self.n_ff}, ftype={self.ftype}>'
 
 class Vocab:
     def __init__(self):
-        self.items = []
+        # All items as one bytes copy of the vocab section; token i is blob[starts[i]:starts[i] + lengths[i]]
+        self.blob = b''
+        self.starts = self.lengths = np.zeros(0, dtype = np.int64)
+        self.scores = np.zeros(0, dtype = np.float32)
 
     def load(self, data, offset, n_vocab):
-        orig_offset = offset
-        for _ in range(n_vocab):
-            itemlen = struct.unpack('<I', data[offset:offset + 4])[0]
-            assert itemlen < 4096, 'Absurd vocab item length'
-            offset += 4
-            vocab = bytes(data[offset:offset + itemlen])
-            offset += itemlen
-            score = struct.unpack('<f', data[offset:offset + 4])[0]
-            offset += 4
-            self.items.append((vocab, score))
-        return offset - orig_offset
+        # Items are (u32 length, bytes, f32 score): only the lengths need a sequential walk, which
+        # reads them in place through a memoryview; the rest is decoded in bulk once offsets are known
+        view = memoryview(data)
+        starts = [0] * n_vocab
+        lengths = [0] * n_vocab
+        pos = offset
+        for i in range(n_vocab):
+            itemlen = UINT32.unpack_from(view, pos)[0]
+            starts[i] = pos + 4
+            lengths[i] = itemlen
+            pos += itemlen + 8
+        self.starts = np.array(starts, dtype = np.int64) - offset
+        self.lengths = np.array(lengths, dtype = np.int64)
+        assert not len(self.lengths) or self.lengths.max() < 4096, 'Absurd vocab item length'
+        self.blob = bytes(view[offset:pos])
+        score_offsets = self.starts + self.lengths
+        raw = np.frombuffer(self.blob, dtype = np.uint8)
+        self.scores = raw[score_offsets[:, None] + np.arange(4)].view('<f4').ravel()
+        return pos - offset
+
+    def tokens(self):
+        blob, starts = self.blob, self.starts.tolist()
+        return [blob[s:s + n] for s, n in zip(starts, self.lengths.tolist())]
+
+    @property
+    def items(self):
+        return list(zip(self.tokens(), self.scores.tolist()))
 
 class Tensor:
     def __init__(self):
@@ -78,23 +98,24 @@ class Tensor:
         self.len_bytes = 0
 
     def load(self, data, offset):
+        # data is a memoryview of the input: headers are read in place, tensor data is skipped
         orig_offset = offset
-        (n_dims, name_len, dtype) = struct.unpack('<3I', data[offset:offset + 12])
+        (n_dims, name_len, dtype) = TENSOR_HEADER.unpack_from(data, offset)
         assert n_dims >= 0 and n_dims <= 4, f'Invalid tensor dimensions {n_dims}'
         assert name_len < 4096, 'Absurd tensor name length'
         quant = GGML_QUANT_SIZES.get(dtype)
         assert quant is not None, 'Unknown tensor type'
         (blksize, tysize) = quant
-        offset += 12
+        offset += TENSOR_HEADER.size
         self.dtype= dtype
-        self.dims = struct.unpack(f'<{n_dims}I', data[offset:offset + (4 * n_dims)])
+        self.dims = struct.unpack_from(f'<{n_dims}I', data, offset)
         offset += 4 * n_dims
         self.name = bytes(data[offset:offset + name_len])
         offset += name_len
         pad = ((offset + 31) & ~31) - offset
         offset += pad
-        n_elems = np.prod(self.dims)
-        n_bytes = np.int64(np.int64(n_elems) * np.int64(tysize)) // np.int64(blksize)
+        n_elems = math.prod(self.dims)
+        n_bytes = n_elems * tysize // blksize
         self.start_offset = offset
         self.len_bytes = n_bytes
         offset += n_bytes
@@ -107,6 +128,7 @@ class GGMLV3Model:
         self.vocab = None
         self.tensor_map = {}
         self.tensors = []
+        self.scan_times = {}
 
     def validate_header(self, data, offset):
         if bytes(data[offset:offset + 4]) != b'tjgg' or struct.unpack('<I', data[offset + 4:offset + 8])[0] != 3:
@@ -114,16 +136,20 @@ class GGMLV3Model:
         return 8
 
     def load(self, data, offset):
+        t0 = time.perf_counter()
         offset += self.validate_header(data, offset)
         hp = Hyperparameters()
         offset += hp.load(data, offset)
+        t1 = time.perf_counter()
         vocab = Vocab()
         offset += vocab.load(data, offset, hp.n_vocab)
+        t2 = time.perf_counter()
+        view = memoryview(data)
         tensors = []
         tensor_map = {}
         while offset < len(data):
             tensor = Tensor()
-            offset += tensor.load(data, offset)
+            offset += tensor.load(view, offset)
             tensor_map[tensor.name] = len(tensors)
             tensors.append(tensor)
         self.hyperparameters = hp
@@ -131,8 +157,16 @@ class GGMLV3Model:
         self.tensors = tensors
         self.tensor_map = tensor_map
         hp.set_n_ff(self)
+        t3 = time.perf_counter()
+        self.scan_times = {'header': t1 - t0, 'vocab': t2 - t1, 'tensors': t3 - t2}
         return offset
 
+    def scan_report(self):
+        times = self.scan_times
+        return (f'* Scanned GGML input in {sum(times.values()) * 1000:.1f} ms: '
+                + ', '.join(f'{phase} {seconds * 1000:.1f} ms' for phase, seconds in times.items())
+                + f' ({len(self.vocab.lengths)} vocab items, {len(self.tensors)} tensors)')
+
 class GGMLToGGUF:
     def __init__(self, ggml_model, data, cfg, params_override = None, vocab_override = None):
         hp = ggml_model.hyperparameters
@@ -227,33 +261,30 @@ class GGMLToGGUF:
                 gguf_writer.add_token_types(toktypes)
             return
         print(f'* Adding {hp.n_vocab} vocab item(s)')
-        assert len(self.model.vocab.items) >= 3, 'Cannot handle unexpectedly short model vocab'
-        for (tokid, (vbytes, vscore)) in enumerate(self.model.vocab.items):
-            tt = 1 # Normal
-            # Special handling for UNK, BOS, EOS tokens.
-            if tokid <= 2:
-                if tokid == 0:
-                    vbytes = b'<unk>'
-                    tt = 2
-                elif tokid == 1:
-                    vbytes = b'<s>'
-                    tt = 3
-                else:
-                    vbytes = b'</s>'
-                    tt = 3
-            elif len(vbytes) == 0:
-                tt = 3 # Control
-            elif tokid >= 3 and tokid <= 258 and len(vbytes) == 1:
-                vbytes = bytes(f'<0x{vbytes[0]:02X}>', encoding = 'UTF-8')
-                tt = 6 # Byte
-            else:
-                vbytes = vbytes.replace(b' ', b'\xe2\x96\x81')
-            toktypes.append(tt)
-            tokens.append(vbytes)
-            scores.append(vscore)
+        vocab = self.model.vocab
+        n_items = len(vocab.lengths)
+        assert n_items >= 3, 'Cannot handle unexpectedly short model vocab'
+        tokids = np.arange(n_items)
+        toktypes = np.ones(n_items, dtype = np.int32) # Normal
+        toktypes[vocab.lengths == 0] = 3 # Control
+        byte_tokens = (tokids >= 3) & (tokids <= 258) & (vocab.lengths == 1)
+        toktypes[byte_tokens] = 6 # Byte
+        # Special handling for UNK, BOS, EOS tokens.
+        toktypes[:3] = (2, 3, 3)
+        # Spaces become U+2581 across the whole section at once; every space moves the bytes after it
+        # two further along, so token boundaries shift by twice the number of spaces before them
+        spaces = np.flatnonzero(np.frombuffer(vocab.blob, dtype = np.uint8) == ord(' '))
+        escaped = vocab.blob.replace(b' ', b'\xe2\x96\x81')
+        ends = vocab.starts + vocab.lengths
+        starts = vocab.starts + 2 * np.searchsorted(spaces, vocab.starts)
+        ends += 2 * np.searchsorted(spaces, ends)
+        tokens = [escaped[s:e] for s, e in zip(starts.tolist(), ends.tolist())]
+        for tokid in np.flatnonzero(byte_tokens).tolist():
+            tokens[tokid] = BYTE_TOKENS[vocab.blob[vocab.starts[tokid]]]
+        tokens[:3] = [b'<unk>', b'<s>', b'</s>']
         gguf_writer.add_token_list(tokens)
-        gguf_writer.add_token_scores(scores)
-        gguf_writer.add_token_types(toktypes)
+        gguf_writer.add_token_scores(vocab.scores.tolist())
+        gguf_writer.add_token_types(toktypes.tolist())
         gguf_writer.add_unk_token_id(0)
         gguf_writer.add_bos_token_id(1)
         gguf_writer.add_eos_token_id(2)
@@ -317,6 +348,7 @@ def handle_args():
     parser.add_argument('--model-metadata-dir', '-m', type = Path, help ='Load HuggingFace/.pth vocab and metadata from the specified directory')
     parser.add_argument("--vocab-dir", type=Path, help="directory containing tokenizer.model, if separate from model file - only meaningful with --model-metadata-dir")
     parser.add_argument("--vocabtype", choices=["spm", "bpe"], help="vocab format - only meaningful with --model-metadata-dir and/or --vocab-dir (default: spm)", default="spm")
+    parser.add_argument('--scan-only', action = 'store_true', help = 'Scan the input and report scan timings without writing any output')
     return parser.parse_args()
 
 def main():
@@ -327,7 +359,10 @@ def main():
     model = GGMLV3Model()
     print('* Scanning GGML input file')
     offset = model.load(data, 0)
+    print(model.scan_report())
     print(f'* GGML model hyperparameters: {model.hyperparameters}')
+    if cfg.scan_only:
+        return
     vocab_override = None
     params_override = None
     if cfg.model_metadata_dir is not None:
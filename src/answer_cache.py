@@ -0,0 +1,188 @@
+'''
+===========================================
+        Module: Semantic answer cache
+===========================================
+'''
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import box
+import numpy as np
+import yaml
+from src.build_cache import read_manifest
+from src.registry import get_embeddings, index_fingerprint
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+def normalize_question(qstring):
+    return re.sub(r'\s+', ' ', qstring.strip().lower())
+
+
+def answer_namespace(db_path, prompt_template, sources=None, pages=None):
+    """ Answers are only shared between questions asked of the same index content, prompt, model and filters """
+    index_hash = read_manifest(db_path).get('key') or str(index_fingerprint(db_path))
+    params = {'index': index_hash,
+              'prompt': prompt_template,
+              'model': cfg.LLM_MODEL_PATH,
+              'temperature': cfg.TEMPERATURE,
+              'k': cfg.CONTEXT_FETCH_K if cfg.CONTEXT_PACKING else cfg.VECTOR_COUNT,
+              'rerank': [cfg.RERANK_MODEL, cfg.RERANK_CANDIDATES, cfg.RERANK_TOP_N] if cfg.RERANK else None,
+              'rescore': [cfg.RESCORE, cfg.RESCORE_FACTOR],
+              'hybrid': [cfg.HYBRID_SEARCH, cfg.HYBRID_FETCH_K, cfg.RRF_K, cfg.BM25_K1, cfg.BM25_B] if cfg.HYBRID_SEARCH else None,
+              'context': [cfg.CONTEXT_PACKING, cfg.N_CTX, cfg.CONTEXT_TOKEN_BUDGET, cfg.CONTEXT_DEDUP_THRESHOLD],
+              'sources': sorted(sources or []),
+              'pages': list(pages) if pages is not None else None}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf8')).hexdigest()
+
+
+# Question embeddings kept from lookup misses until the answer is put
+PENDING_VECTORS = 256
+
+
+class AnswerCache:
+    """ Exact and near-duplicate question lookup with TTL/LRU eviction. Persisted as an append-only log
+        of pickled (key, entry) records, compacted once it holds twice as many records as live entries """
+
+    def __init__(self, path=None, max_entries=None, ttl=None, threshold=None):
+        self.path = path or cfg.ANSWER_CACHE_PATH
+        self.max_entries = max_entries or cfg.ANSWER_CACHE_SIZE
+        self.ttl = ttl or cfg.ANSWER_CACHE_TTL
+        self.threshold = threshold or cfg.ANSWER_CACHE_THRESHOLD
+        self._lock = threading.Lock()
+        # Disk writes have their own lock so lookups never wait on them
+        self._file_lock = threading.Lock()
+        # (namespace, normalized question) -> entry, least recently used first
+        self._entries = OrderedDict()
+        self._pending = OrderedDict()
+        self._records = 0
+        self.stats = {'exact_hits': 0, 'similar_hits': 0, 'misses': 0}
+        self._load()
+
+    def _load(self):
+        """ Replay the log; a truncated last record (e.g. a crash mid-append) is dropped by compacting """
+        truncated = False
+        try:
+            with open(self.path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                while f.tell() < size:
+                    try:
+                        record = pickle.load(f)
+                    except (EOFError, pickle.UnpicklingError, ValueError, AttributeError):
+                        truncated = True
+                        break
+                    if isinstance(record, dict):  # a whole-cache snapshot, as written by earlier versions
+                        self._entries.update(record)
+                        self._records += len(record)
+                    else:
+                        key, entry = record
+                        self._entries[key] = entry
+                        self._entries.move_to_end(key)
+                        self._records += 1
+        except FileNotFoundError:
+            return
+        self._expire()
+        if truncated or self._records > 2 * max(len(self._entries), 1):
+            self._compact()
+
+    def _append(self, key, entry):
+        with self._file_lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'ab') as f:
+                pickle.dump((key, entry), f)
+            self._records += 1
+            compact = self._records > 2 * max(len(self._entries), self.max_entries // 2, 1)
+        if compact:
+            self._compact()
+
+    def _compact(self):
+        with self._file_lock:
+            with self._lock:
+                entries = list(self._entries.items())
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for record in entries:
+                    pickle.dump(record, f)
+            os.replace(tmp_path, self.path)
+            self._records = len(entries)
+
+    def _expire(self):
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if now - e['created'] > self.ttl]:
+            del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _embed(question):
+        vector = np.asarray(get_embeddings().embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, namespace, qstring):
+        """ Cached response for this question, or the most similar one above the threshold, else None """
+        question = normalize_question(qstring)
+        with self._lock:
+            self._expire()
+            entry = self._entries.get((namespace, question))
+            if entry is not None:
+                self._entries.move_to_end((namespace, question))
+                self.stats['exact_hits'] += 1
+                return dict(entry['response'], query=qstring)
+            candidates = [(k, e) for k, e in self._entries.items() if k[0] == namespace]
+        vector = None
+        if candidates:
+            vector = self._embed(question)
+            similarities = np.stack([e['embedding'] for _, e in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                key, entry = candidates[best]
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                    self.stats['similar_hits'] += 1
+                print(f'Answer cache: "{qstring}" matched "{entry["question"]}" ({similarities[best]:.3f})')
+                return dict(entry['response'], query=qstring)
+        with self._lock:
+            self.stats['misses'] += 1
+            if vector is not None:
+                # put() reuses it rather than embedding the question again
+                self._pending[question] = vector
+                while len(self._pending) > PENDING_VECTORS:
+                    self._pending.popitem(last=False)
+        return None
+
+    def put(self, namespace, qstring, response):
+        question = normalize_question(qstring)
+        with self._lock:
+            vector = self._pending.pop(question, None)
+        entry = {'question': question,
+                 'embedding': vector if vector is not None else self._embed(question),
+                 'created': time.time(),
+                 'response': {'result': response['result'],
+                              'source_documents': response.get('source_documents', [])}}
+        with self._lock:
+            self._entries[(namespace, question)] = entry
+            self._entries.move_to_end((namespace, question))
+            self._expire()
+        self._append((namespace, question), entry)
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache()
+        return _answer_cache
@@ -0,0 +1,143 @@
+'''
+===========================================
+        Module: Batch question answering
+===========================================
+'''
+import argparse
+import json
+import os
+import timeit
+from collections import OrderedDict
+
+import box
+import yaml
+from src.llm import build_llm
+from src.packing import context_budget, pack_documents
+from src.rerank import rerank
+from src.utils import retrieve_many, setup_dbqa
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+def record_key(record):
+    return str(record['id']) if 'id' in record else f"{record.get('doc', '')}\t{record['question']}"
+
+
+def doc_db_path(doc, db_dir='db/'):
+    """ An index directory as given, or the per-document index the UI builds under db_dir """
+    if not doc:
+        return cfg.DB_FAISS_PATH
+    if os.path.exists(os.path.join(doc, 'index.faiss')):
+        return doc
+    return os.path.join(db_dir, os.path.splitext(os.path.basename(doc))[0])
+
+
+def read_questions(path):
+    with open(path, 'r', encoding='utf8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def completed_keys(output_path):
+    """ Keys already answered in a previous run; drops a partially written last line """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    valid_bytes = 0
+    with open(output_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                done.add(record_key(json.loads(line)))
+            except (ValueError, KeyError):
+                break
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(output_path):
+        with open(output_path, 'r+b') as f:
+            f.truncate(valid_bytes)
+    return done
+
+
+def group_by_index(records, db_dir):
+    groups = OrderedDict()
+    for record in records:
+        groups.setdefault(doc_db_path(record.get('doc'), db_dir), []).append(record)
+    return groups
+
+
+def context_documents(question, docs, llm, prompt):
+    """ Same post-retrieval steps as build_retrieval_qa: re-ranking, then context packing """
+    if cfg.RERANK:
+        docs = rerank(question, docs, cfg.RERANK_TOP_N)
+    elif not cfg.CONTEXT_PACKING:
+        docs = docs[:cfg.VECTOR_COUNT]
+    if cfg.CONTEXT_PACKING:
+        docs = pack_documents(docs, llm.get_num_tokens, context_budget(llm, prompt, question))
+    return docs
+
+
+def run_batch(input_path, output_path, db_dir='db/', batch_size=32):
+    records = read_questions(input_path)
+    done = completed_keys(output_path)
+    pending = []
+    for record in records:
+        if record_key(record) not in done:
+            done.add(record_key(record))
+            pending.append(record)
+    print(f'{len(records)} questions, {len(records) - len(pending)} already answered or repeated, {len(pending)} to go')
+    if not pending:
+        return
+
+    llm = build_llm()
+    if cfg.RERANK:
+        k = cfg.RERANK_CANDIDATES
+    else:
+        k = cfg.CONTEXT_FETCH_K if cfg.CONTEXT_PACKING else cfg.VECTOR_COUNT
+    start = timeit.default_timer()
+    retrieval_time = 0.0
+    answered = 0
+    with open(output_path, 'a', encoding='utf8') as out:
+        for db_path, group in group_by_index(pending, db_dir).items():
+            if not os.path.exists(os.path.join(db_path, 'index.faiss')):
+                print(f'No index at {db_path}; skipping {len(group)} questions')
+                continue
+            chain = setup_dbqa(db_path, llm).combine_documents_chain
+            for i in range(0, len(group), batch_size):
+                batch = group[i:i + batch_size]
+                t = timeit.default_timer()
+                results = retrieve_many(db_path, [r['question'] for r in batch], k)
+                retrieval_time += timeit.default_timer() - t
+                for j, record in enumerate(batch):
+                    t = timeit.default_timer()
+                    docs = context_documents(record['question'], results.documents(j), llm, chain.llm_chain.prompt)
+                    result = chain.run(input_documents=docs, question=record['question'])
+                    out.write(json.dumps(dict(record,
+                                              result=result,
+                                              sources=[{'source': d.metadata.get('source'), 'page': d.metadata.get('page')}
+                                                       for d in docs],
+                                              time=round(timeit.default_timer() - t, 2))) + '\n')
+                    # Checkpoint: every written line survives a crash
+                    out.flush()
+                    os.fsync(out.fileno())
+                    answered += 1
+            print(f'Answered {len(group)} questions against {db_path}')
+
+    elapsed = timeit.default_timer() - start
+    print('='*100)
+    print(f'answered: {answered} questions in {round(elapsed, 2)} seconds '
+          f'({round(60 * answered / max(elapsed, 1e-9), 1)} per minute)')
+    print(f'retrieval: {round(1000 * retrieval_time / max(answered, 1), 2)} ms per question')
+    print('='*100)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Answer a JSONL file of {"doc", "question"} records')
+    parser.add_argument('input', type=str, help='JSONL questions; records may carry an "id"')
+    parser.add_argument('output', type=str, help='JSONL answers; re-running resumes after the last written answer')
+    parser.add_argument('--db-dir', type=str, default='db/', help='Directory of per-document indexes')
+    parser.add_argument('--batch-size', type=int, default=32, help='Questions embedded and searched together')
+    args = parser.parse_args()
+
+    run_batch(args.input, args.output, args.db_dir, args.batch_size)
@@ -0,0 +1,311 @@
+'''
+===========================================
+        Module: End-to-end benchmarks
+===========================================
+'''
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+from contextlib import contextmanager
+from typing import Any, List, Optional
+
+import box
+import numpy as np
+import yaml
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+from src import build_cache, extract
+from src.perf import RssSampler
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+SAMPLE_DATA_PATH = 'sample_data/'
+
+DEFAULT_QUESTIONS = ['How much is the minimum guarantee payable by adidas?',
+                     'When does the fiscal year of the company end?',
+                     'Who is the mass mailing about public water addressed to?',
+                     'What are the main risk factors described in the report?']
+
+STAGES = ('transcribe', 'build_all', 'build_file', 'load', 'retrieve', 'generate', 'query')
+
+# Report fields compared between runs; True where a higher value is worse
+COMPARED = {'p50_ms': True, 'p95_ms': True, 'units_per_s': False, 'peak_rss_mb': True}
+
+WORDS = ('the', 'company', 'agreement', 'water', 'payment', 'year', 'report', 'minimum', 'shall', 'total',
+         'guarantee', 'mailing', 'public', 'fiscal', 'revenue', 'risk')
+
+
+class FakeLLM(LLM):
+    """ Deterministic stand-in for LlamaCpp: the answer is derived from a hash of the prompt and
+        streamed a word at a time, optionally paced to mimic a real model's token rate """
+    tokens: int = 64
+    token_ms: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake'
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        seed = hashlib.sha256(prompt.encode('utf8')).digest()
+        words = [WORDS[(seed[i % len(seed)] + i) % len(WORDS)] for i in range(self.tokens)]
+        for word in words:
+            if self.token_ms:
+                time.sleep(self.token_ms / 1000)
+            if run_manager:
+                run_manager.on_llm_new_token(' ' + word)
+        return ' '.join(words)
+
+    def get_num_tokens(self, text: str) -> int:
+        # Roughly four characters per Llama token; avoids loading a tokenizer
+        return len(text) // 4
+
+
+@contextmanager
+def cold_caches(root):
+    """ Point the page-text and embedding caches at an empty directory for the duration """
+    saved = extract.cfg.PAGE_CACHE_PATH, build_cache.cfg.EMBEDDING_CACHE_PATH
+    extract.cfg.PAGE_CACHE_PATH = os.path.join(root, 'pages/')
+    build_cache.cfg.EMBEDDING_CACHE_PATH = os.path.join(root, 'embeddings.sqlite')
+    try:
+        yield
+    finally:
+        extract.cfg.PAGE_CACHE_PATH, build_cache.cfg.EMBEDDING_CACHE_PATH = saved
+
+
+def summarize(samples, units, unit, peak_rss_mb, rss_before_mb):
+    """ samples: seconds per call, one list per repeat; the first repeat is reported on its own as the
+        cold run and left out of the statistics unless it is the only one """
+    cold_ms = 1000 * sum(samples[0])
+    warm = [s for run in (samples[1:] or samples) for s in run]
+    warm_units = sum(units[1:] or units)
+    ms = 1000 * np.array(warm)
+    return {'unit': unit,
+            'samples': len(warm),
+            'cold_ms': round(cold_ms, 3),
+            'mean_ms': round(float(ms.mean()), 3),
+            'min_ms': round(float(ms.min()), 3),
+            'max_ms': round(float(ms.max()), 3),
+            'p50_ms': round(float(np.percentile(ms, 50)), 3),
+            'p90_ms': round(float(np.percentile(ms, 90)), 3),
+            'p95_ms': round(float(np.percentile(ms, 95)), 3),
+            'p99_ms': round(float(np.percentile(ms, 99)), 3),
+            'units': warm_units,
+            'units_per_s': round(warm_units / max(sum(warm), 1e-9), 3),
+            'rss_before_mb': round(rss_before_mb, 1),
+            'peak_rss_mb': round(peak_rss_mb, 1)}
+
+
+def time_stage(name, calls, repeat, unit):
+    """ Run every call repeat times; each call takes the repeat number and returns the units it processed """
+    import psutil
+    rss_before_mb = psutil.Process().memory_info().rss / 2**20
+    samples, units = [], []
+    with RssSampler() as rss:
+        for r in range(repeat):
+            samples.append([])
+            units.append(0)
+            for call in calls:
+                start = timeit.default_timer()
+                units[r] += call(r)
+                samples[r].append(timeit.default_timer() - start)
+    stats = summarize(samples, units, unit, rss.peak_mb, rss_before_mb)
+    print(f"{name}: p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, cold {stats['cold_ms']:.1f} ms, "
+          f"{stats['units_per_s']} {unit}/s, peak RSS {stats['peak_rss_mb']} MB")
+    return stats
+
+
+def chunk_count(db_path):
+    return build_cache.read_manifest(db_path).get('chunks', 0)
+
+
+def run_benchmark(stages=STAGES, repeat=None, questions=None, data_path=SAMPLE_DATA_PATH, tokens=64,
+                  token_ms=0.0, cold=False):
+    """ Time each stage over the sample PDFs. Later repeats of the ingest stages hit the page and
+        embedding caches unless cold is set, in which case every repeat starts from empty caches """
+    from src.db_build import build_vectorstore, run_db_build
+    from src.llm import query
+    from src.ocr import transcribe_pdf
+    from src.registry import invalidate
+    from src.utils import setup_dbqa
+
+    repeat = repeat or cfg.BENCH_REPEAT
+    questions = questions or DEFAULT_QUESTIONS
+    files = sorted(f for f in os.listdir(data_path) if f.lower().endswith('.pdf'))
+    llm = FakeLLM(tokens=tokens, token_ms=token_ms)
+    report = {'meta': {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': sys.version.split()[0],
+                       'platform': platform.platform(),
+                       'cpus': os.cpu_count(),
+                       'repeat': repeat,
+                       'files': files,
+                       'questions': len(questions),
+                       'fake_llm': {'tokens': tokens, 'token_ms': token_ms},
+                       'cold': cold,
+                       'config': {key: cfg[key] for key in ('CHUNK_SIZE', 'CHUNK_OVERLAP', 'EMBEDDING_MODEL',
+                                                            'INDEX_TYPE', 'VECTOR_COUNT', 'HYBRID_SEARCH',
+                                                            'RERANK', 'CONTEXT_PACKING')}},
+              'stages': {}}
+
+    with tempfile.TemporaryDirectory(prefix='bench-') as workdir:
+        def fresh(name, r):
+            return os.path.join(workdir, f'{name}-{r}')
+
+        def cached(r, fn):
+            if not cold:
+                return fn()
+            with cold_caches(fresh('caches', r)):
+                return fn()
+
+        if 'transcribe' in stages:
+            def transcribe(filename):
+                def call(r):
+                    return transcribe_pdf(os.path.join(data_path, filename), fresh(filename, r))['pages']
+                return call
+            try:
+                report['stages']['transcribe'] = time_stage('transcribe', [transcribe(f) for f in files],
+                                                            repeat, 'pages')
+            except Exception as E:
+                # Needs tesseract and poppler on the PATH
+                print(f'transcribe: skipped ({E})')
+                report['stages']['transcribe'] = {'skipped': str(E)}
+
+        # Equivalent of run_db_build(glob), which always writes to the configured DB_FAISS_PATH
+        def build_all(r):
+            db_path = fresh('db_all', r)
+            cached(r, lambda: build_vectorstore(data_path, '*.pdf', db_path, cfg.CHUNK_SIZE, cfg.CHUNK_OVERLAP))
+            return chunk_count(db_path)
+
+        if 'build_all' in stages:
+            report['stages']['build_all'] = time_stage('build_all', [build_all], repeat, 'chunks')
+
+        if 'build_file' in stages:
+            def build_file(filename):
+                def call(r):
+                    db_path = fresh(os.path.splitext(filename)[0], r)
+                    cached(r, lambda: run_db_build(filename, data_path, db_path))
+                    return chunk_count(db_path)
+                return call
+            report['stages']['build_file'] = time_stage('build_file', [build_file(f) for f in files],
+                                                        repeat, 'chunks')
+
+        if not {'load', 'retrieve', 'generate', 'query'} & set(stages):
+            return report
+        db_path = fresh('db_all', repeat - 1 if 'build_all' in stages else 'qa')
+        if 'build_all' not in stages:
+            build_all('qa')
+
+        def load(r):
+            invalidate(db_path)
+            setup_dbqa(db_path, llm)
+            return 1
+
+        if 'load' in stages:
+            report['stages']['load'] = time_stage('load', [load], repeat, 'indexes')
+
+        dbqa = setup_dbqa(db_path, llm)
+        if 'retrieve' in stages:
+            def retrieve(question):
+                def call(r):
+                    dbqa.retriever.get_relevant_documents(question)
+                    return 1
+                return call
+            report['stages']['retrieve'] = time_stage('retrieve', [retrieve(q) for q in questions],
+                                                      repeat, 'queries')
+
+        if 'generate' in stages:
+            def generate(question):
+                docs = dbqa.retriever.get_relevant_documents(question)
+                return lambda r: len(dbqa.combine_documents_chain.run(input_documents=docs,
+                                                                      question=question).split())
+            report['stages']['generate'] = time_stage('generate', [generate(q) for q in questions],
+                                                      repeat, 'tokens')
+
+        if 'query' in stages:
+            def ask(question):
+                def call(r):
+                    query(question, db_path, llm, use_cache=False)
+                    return 1
+                return call
+            report['stages']['query'] = time_stage('query', [ask(q) for q in questions], repeat, 'queries')
+        invalidate(db_path)
+    return report
+
+
+def compare(base, new, threshold=None, noise_ms=None):
+    """ Regressions of new against base: a metric at least threshold (relative) worse, ignoring
+        latency differences below noise_ms. Returns (rows, regressions) """
+    threshold = cfg.BENCH_THRESHOLD if threshold is None else threshold
+    noise_ms = cfg.BENCH_NOISE_MS if noise_ms is None else noise_ms
+    rows, regressions = [], []
+    for stage, old in base['stages'].items():
+        current = new['stages'].get(stage)
+        if current is None or 'skipped' in old or 'skipped' in current:
+            continue
+        for metric, higher_is_worse in COMPARED.items():
+            before, after = old[metric], current[metric]
+            change = (after - before) / before if before else 0.0
+            worse = change > threshold if higher_is_worse else change < -threshold
+            if metric.endswith('_ms') and abs(after - before) < noise_ms:
+                worse = False
+            row = {'stage': stage, 'metric': metric, 'base': before, 'new': after,
+                   'change': round(change, 4), 'regression': worse}
+            rows.append(row)
+            if worse:
+                regressions.append(row)
+    return rows, regressions
+
+
+def print_comparison(rows):
+    print(f'{"stage":<12}{"metric":<14}{"base":>12}{"new":>12}{"change":>10}')
+    for row in rows:
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f'{row["stage"]:<12}{row["metric"]:<14}{row["base"]:>12.2f}{row["new"]:>12.2f}'
+              f'{100 * row["change"]:>9.1f}%{flag}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark ingest, retrieval and generation on the sample PDFs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='Run the benchmark and write a JSON report')
+    run.add_argument('--output', type=str, default='bench.json')
+    run.add_argument('--repeat', type=int, default=cfg.BENCH_REPEAT, help='Runs per stage; the first is reported as cold')
+    run.add_argument('--stages', type=str, nargs='+', choices=STAGES, default=list(STAGES))
+    run.add_argument('--questions', type=str, help='Text file with one question per line')
+    run.add_argument('--data-path', type=str, default=SAMPLE_DATA_PATH)
+    run.add_argument('--tokens', type=int, default=64, help='Words generated per answer by the fake LLM')
+    run.add_argument('--token-ms', type=float, default=0.0, help='Delay per generated word, to mimic a real model')
+    run.add_argument('--cold', action='store_true', help='Start every repeat with empty page and embedding caches')
+    diff = commands.add_parser('compare', help='Flag regressions between two reports')
+    diff.add_argument('base', type=str)
+    diff.add_argument('new', type=str)
+    diff.add_argument('--threshold', type=float, default=cfg.BENCH_THRESHOLD, help='Relative change counted as a regression')
+    diff.add_argument('--noise-ms', type=float, default=cfg.BENCH_NOISE_MS, help='Latency differences below this are ignored')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        questions = None
+        if args.questions:
+            with open(args.questions, 'r', encoding='utf8') as f:
+                questions = [line.strip() for line in f if line.strip()]
+        report = run_benchmark(args.stages, args.repeat, questions, args.data_path, args.tokens, args.token_ms, args.cold)
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Wrote {args.output}')
+    else:
+        with open(args.base, 'r', encoding='utf8') as f:
+            base = json.load(f)
+        with open(args.new, 'r', encoding='utf8') as f:
+            new = json.load(f)
+        rows, regressions = compare(base, new, args.threshold, args.noise_ms)
+        print_comparison(rows)
+        print(f'{len(regressions)} regressions')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,167 @@
+'''
+===========================================
+        Module: Index build cache
+===========================================
+'''
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import List
+
+import box
+import numpy as np
+import yaml
+from langchain.embeddings.base import Embeddings
+from src.chunk_store import index_exists
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+MANIFEST_FILE = 'manifest.json'
+
+# (path, size, mtime) -> sha256 of every file version hashed or remembered in this process
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+# # # Content hashing
+def file_sha256(path, known=None):
+    """ sha256 of a file, reusing a previously recorded hash when size and mtime are unchanged """
+    st = os.stat(path)
+    if known and known.get('size') == st.st_size and known.get('mtime') == st.st_mtime_ns:
+        return known['sha256']
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _hashes_lock:
+        if key in _hashes:
+            return _hashes[key]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    with _hashes_lock:
+        _hashes[key] = digest.hexdigest()
+    return digest.hexdigest()
+
+
+def remember_file(path, record):
+    """ Reuse a file record ({sha256, size, mtime}) computed elsewhere, e.g. while an upload streamed in,
+        for as long as the file keeps that size and mtime """
+    st = os.stat(path)
+    if record.get('sha256') and record.get('size') == st.st_size and record.get('mtime') == st.st_mtime_ns:
+        with _hashes_lock:
+            _hashes[(os.path.abspath(path), st.st_size, st.st_mtime_ns)] = record['sha256']
+
+
+def file_record(path, known=None):
+    st = os.stat(path)
+    return {'sha256': file_sha256(path, known), 'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+
+def text_sha256(text):
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+def build_key(file_hashes, chunk_size, chunk_overlap, embedding_model, index_params=None):
+    """ Identifies an index by the content it was built from and how it was built """
+    params = {'files': sorted(file_hashes),
+              'chunk_size': chunk_size,
+              'chunk_overlap': chunk_overlap,
+              'embedding_model': embedding_model,
+              'index': index_params or {'type': 'flat'}}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf8')).hexdigest()
+
+
+# # # Manifest
+def read_manifest(db_path):
+    try:
+        with open(os.path.join(db_path, MANIFEST_FILE), 'r', encoding='utf8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_manifest(db_path, manifest):
+    manifest = dict(manifest, built_at=datetime.datetime.now().isoformat(timespec='seconds'))
+    tmp_path = os.path.join(db_path, MANIFEST_FILE + '.tmp')
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(db_path, MANIFEST_FILE))
+
+
+def is_current(db_path, key):
+    """ True when the index at db_path was built with exactly this build key """
+    return read_manifest(db_path).get('key') == key and index_exists(db_path)
+
+
+# # # Chunk embedding cache
+class EmbeddingCache:
+    """ Chunk embeddings stored in SQLite, keyed by (embedding model, chunk-text hash) """
+
+    def __init__(self, path=None):
+        self.path = path or cfg.EMBEDDING_CACHE_PATH
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS embeddings ('
+                        'model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, '
+                        'PRIMARY KEY (model, hash))')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_many(self, model, hashes):
+        found = {}
+        unique = list(set(hashes))
+        with self._connect() as con:
+            for i in range(0, len(unique), 500):
+                batch = unique[i:i + 500]
+                rows = con.execute('SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN '
+                                   f'({",".join("?" * len(batch))})', [model, *batch])
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, model, items):
+        with self._connect() as con:
+            con.executemany('INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)',
+                            [(model, h, np.asarray(v, dtype=np.float32).tobytes()) for h, v in items])
+
+
+class CachedEmbeddings(Embeddings):
+    """ Embeddings wrapper that only embeds chunks whose text has not been embedded before """
+
+    def __init__(self, embeddings, model_name=None, cache=None):
+        self.embeddings = embeddings
+        self.model_name = model_name or cfg.EMBEDDING_MODEL
+        self.cache = cache or EmbeddingCache()
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        hashes = [text_sha256(text) for text in texts]
+        found = self.cache.get_many(self.model_name, hashes)
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in found:
+                missing.setdefault(h, text)
+        print(f'Embedding cache: {len(texts) - len(missing)} of {len(texts)} chunks reused from cache or duplicates, '
+              f'embedding {len(missing)}')
+        if missing:
+            if hasattr(self.embeddings, 'embed_array'):
+                new_vectors = self.embeddings.embed_array(list(missing.values()))
+            else:
+                new_vectors = np.asarray(self.embeddings.embed_documents(list(missing.values())), dtype=np.float32)
+            self.cache.put_many(self.model_name, zip(missing.keys(), new_vectors))
+            found.update(zip(missing.keys(), new_vectors))
+        dim = len(next(iter(found.values()))) if found else 0
+        vectors = np.empty((len(texts), dim), dtype=np.float32)
+        for i, h in enumerate(hashes):
+            vectors[i] = found[h]
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
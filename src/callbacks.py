@@ -0,0 +1,112 @@
+'''
+===========================================
+        Module: LangChain callback handlers
+===========================================
+'''
+import timeit
+
+from langchain.callbacks.base import BaseCallbackHandler
+from src.scheduler import QueryTimeout
+from src.tracing import count, current_trace, observe, record
+
+# Kept apart from src.streaming and src.scheduler so the web process can start
+# without importing langchain; these are only needed once a query runs.
+
+
+class BufferCallbackHandler(BaseCallbackHandler):
+    """ Forwards tokens streamed by LlamaCpp into a StreamBuffer """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.buffer.append(token)
+
+
+class DeadlineCallbackHandler(BaseCallbackHandler):
+    """ Aborts generation at the next streamed token once the request is past its deadline """
+    raise_error = True
+
+    def __init__(self, job):
+        self.job = job
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self.job.expired():
+            raise QueryTimeout(f'Query exceeded its {self.job.timeout}s timeout')
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """ Splits a chain run into retrieval, prompt build, prompt evaluation and generation spans
+        and counts prompt and completion tokens. Prompt evaluation ends at the first streamed token """
+
+    def __init__(self, llm=None):
+        self.llm = llm
+        # run_id -> start of the outermost retriever; wrapping retrievers start nested runs
+        self.retrievals = {}
+        self.prompt_start = None
+        self.llm_start = None
+        self.first_token = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def mark_prompt_start(self):
+        """ For callers that retrieve outside the chain: prompt building starts now """
+        self.prompt_start = timeit.default_timer()
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        if self.retrievals:
+            return
+        self.retrievals[run_id] = timeit.default_timer()
+        current = current_trace()
+        if current is not None:
+            # Spans recorded while retrieving (embedding, FAISS search) nest under it
+            current.stack.append('retrieve')
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        start = self.retrievals.pop(run_id, None)
+        if start is None:
+            return
+        now = timeit.default_timer()
+        current = current_trace()
+        if current is not None:
+            current.stack.pop()
+        record('retrieve', now - start, start, documents=len(documents))
+        self.prompt_start = now
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        if self.retrievals.pop(run_id, None) is not None and current_trace() is not None:
+            current_trace().stack.pop()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        now = timeit.default_timer()
+        if self.prompt_start is not None:
+            record('prompt_build', now - self.prompt_start, self.prompt_start)
+            self.prompt_start = None
+        self.llm_start = now
+        self.first_token = None
+        self.completion_tokens = 0
+        self.prompt_tokens = sum(self.llm.get_num_tokens(prompt) for prompt in prompts) if self.llm is not None else 0
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self.first_token is None:
+            self.first_token = timeit.default_timer()
+        self.completion_tokens += 1
+
+    def on_llm_end(self, response, **kwargs):
+        now = timeit.default_timer()
+        if self.llm_start is None:
+            return
+        if self.first_token is None:
+            # Not streamed: evaluation and decoding cannot be told apart
+            if self.llm is not None:
+                self.completion_tokens = sum(self.llm.get_num_tokens(generation.text)
+                                             for generations in response.generations for generation in generations)
+            record('generate', now - self.llm_start, self.llm_start, prompt_tokens=self.prompt_tokens)
+        else:
+            record('prompt_eval', self.first_token - self.llm_start, self.llm_start, tokens=self.prompt_tokens)
+            record('generate', now - self.first_token, self.first_token, tokens=self.completion_tokens)
+            if self.completion_tokens > 1 and now > self.first_token:
+                observe('docqa_generation_tokens_per_second', (self.completion_tokens - 1) / (now - self.first_token))
+        count('docqa_tokens_total', self.prompt_tokens, kind='prompt')
+        count('docqa_tokens_total', self.completion_tokens, kind='completion')
+        self.llm_start = None
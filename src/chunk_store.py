@@ -0,0 +1,232 @@
+'''
+===========================================
+        Module: Memory-mapped chunk store
+===========================================
+'''
+import json
+import mmap
+import os
+import pickle
+from collections.abc import MutableMapping
+from typing import Dict, Union
+
+import box
+import faiss
+import numpy as np
+import yaml
+from langchain.docstore.base import AddableMixin, Docstore
+from langchain.schema import Document
+from langchain.vectorstores import FAISS
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# The offsets table, listed first, is written last; its presence means the store is complete
+CHUNK_FILES = ('chunks.idx.npy', 'chunks.txt', 'chunks.meta', 'chunks.sources.json')
+# Read through the page cache as chunks are hit rather than loaded up front
+MAPPED_FILES = ('chunks.txt', 'chunks.meta')
+LEGACY_FILES = ('index.faiss', 'index.pkl')
+
+# Per chunk: text and JSON metadata spans in their blobs, plus source code and page as columns for filtering
+CHUNK_INDEX_DTYPE = np.dtype([('offset', '<i8'), ('length', '<i4'), ('meta_offset', '<i8'), ('meta_length', '<i4'),
+                              ('source', '<i4'), ('page', '<i4')])
+
+
+def has_chunk_store(db_path):
+    return os.path.exists(os.path.join(db_path, CHUNK_FILES[0]))
+
+
+def index_files(db_path):
+    """ Files making up the index at db_path, in the columnar or the older pickled layout """
+    if has_chunk_store(db_path):
+        return ('index.faiss', *CHUNK_FILES)
+    return LEGACY_FILES
+
+
+def index_exists(db_path):
+    return all(os.path.exists(os.path.join(db_path, fname)) for fname in index_files(db_path))
+
+
+def _replace(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def write_chunk_store(db_path, documents):
+    """ Chunk texts and metadata in index order as two contiguous UTF-8 blobs plus an offsets table """
+    texts = [doc.page_content.encode('utf8') for doc in documents]
+    metas = [json.dumps(doc.metadata, ensure_ascii=False, default=str).encode('utf8') for doc in documents]
+    sources = {}
+    index = np.zeros(len(documents), dtype=CHUNK_INDEX_DTYPE)
+    index['length'] = [len(b) for b in texts]
+    index['offset'][1:] = np.cumsum(index['length'])[:-1]
+    index['meta_length'] = [len(b) for b in metas]
+    index['meta_offset'][1:] = np.cumsum(index['meta_length'])[:-1]
+    index['source'] = [sources.setdefault(str(doc.metadata.get('source', '')), len(sources)) for doc in documents]
+    index['page'] = [doc.metadata.get('page', -1) for doc in documents]
+
+    os.makedirs(db_path, exist_ok=True)
+    _replace(os.path.join(db_path, 'chunks.txt'), b''.join(texts))
+    _replace(os.path.join(db_path, 'chunks.meta'), b''.join(metas))
+    _replace(os.path.join(db_path, 'chunks.sources.json'), json.dumps(list(sources)).encode('utf8'))
+    index_path = os.path.join(db_path, 'chunks.idx.npy')
+    with open(index_path + '.tmp', 'wb') as f:
+        np.save(f, index)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def _map(path):
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class ChunkStore(Docstore, AddableMixin):
+    """ Docstore over a chunk store directory. Opening maps the files without reading them; a Document is
+        only built for the positions a search returns. Ids are index positions as strings; documents
+        added later (e.g. by FAISS.add_embeddings) are held in memory until the store is rewritten """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        index_path = os.path.join(db_path, 'chunks.idx.npy')
+        try:
+            self.index = np.load(index_path, mmap_mode='r')
+        except ValueError:  # an empty store cannot be mapped
+            self.index = np.load(index_path)
+        self._text = _map(os.path.join(db_path, 'chunks.txt'))
+        self._meta = _map(os.path.join(db_path, 'chunks.meta'))
+        with open(os.path.join(db_path, 'chunks.sources.json'), 'r', encoding='utf8') as f:
+            self.sources = json.load(f)
+        self._added = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def document(self, position):
+        row = self.index[position]
+        offset, meta_offset = int(row['offset']), int(row['meta_offset'])
+        text = self._text[offset:offset + int(row['length'])].decode('utf8')
+        metadata = json.loads(self._meta[meta_offset:meta_offset + int(row['meta_length'])].decode('utf8'))
+        return Document(page_content=text, metadata=metadata)
+
+    def search(self, search: str) -> Union[str, Document]:
+        if search in self._added:
+            return self._added[search]
+        if search.isdigit() and int(search) < len(self.index):
+            return self.document(int(search))
+        return f'ID {search} not found.'
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        overlapping = [_id for _id in texts if not isinstance(self.search(_id), str)]
+        if overlapping:
+            raise ValueError(f'Tried to add ids that already exist: {set(overlapping)}')
+        self._added.update(texts)
+
+
+class PositionIds(MutableMapping):
+    """ index_to_docstore_id for a ChunkStore: position i maps to str(i) without a dict entry per chunk;
+        entries set or deleted later (e.g. by FAISS.add_embeddings) are kept in an overlay """
+
+    def __init__(self, n):
+        self.n = n
+        self._extra = {}
+        # Positions below n that no longer have an id
+        self._deleted = set()
+
+    def __getitem__(self, position):
+        if position in self._extra:
+            return self._extra[position]
+        if 0 <= position < self.n and position not in self._deleted:
+            return str(position)
+        raise KeyError(position)
+
+    def __setitem__(self, position, _id):
+        self._deleted.discard(position)
+        self._extra[position] = _id
+
+    def __delitem__(self, position):
+        self[position]  # KeyError when there is nothing to delete
+        self._extra.pop(position, None)
+        if 0 <= position < self.n:
+            self._deleted.add(position)
+
+    def __iter__(self):
+        yield from (position for position in range(self.n) if position not in self._deleted)
+        yield from (position for position in self._extra if not 0 <= position < self.n)
+
+    def __len__(self):
+        return self.n - len(self._deleted) + sum(1 for position in self._extra if not 0 <= position < self.n)
+
+    def aligned(self):
+        """ True while position i is exactly chunk i of the store """
+        return not self._extra and not self._deleted
+
+
+def chunk_columns(vectorstore):
+    """ (source names, source code per position, page per position) straight from the store's columns,
+        or None when the vectorstore is not backed by an unmodified chunk store """
+    ids = vectorstore.index_to_docstore_id
+    if not (isinstance(vectorstore.docstore, ChunkStore) and isinstance(ids, PositionIds) and ids.aligned()
+            and len(vectorstore.docstore) == vectorstore.index.ntotal):
+        return None
+    index = vectorstore.docstore.index
+    return vectorstore.docstore.sources, np.asarray(index['source']), np.asarray(index['page'])
+
+
+def read_faiss_index(path, use_mmap=True):
+    """ Memory-map the index where this FAISS build and index type allow it. A mapped index is read-only:
+        anything that adds or removes vectors must read it with use_mmap=False """
+    if use_mmap:
+        with open(path, 'rb') as f:
+            ivf = f.read(4).startswith(b'Iw')
+        # IVF inverted lists map with IO_FLAG_MMAP in every build; IO_FLAG_MMAP_IFC (FAISS 1.9+) maps
+        # flat codes instead, and would read the inverted lists into memory
+        mmap = faiss.IO_FLAG_MMAP if ivf else getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+        flags = mmap | faiss.IO_FLAG_READ_ONLY
+        try:
+            return faiss.read_index(path, flags)
+        except RuntimeError as E:
+            print(f'Memory-mapping {path} failed, reading it instead: {E}')
+    return faiss.read_index(path)
+
+
+def index_is_mapped(index):
+    """ True when the index's codes are paged in from a mapping of index.faiss rather than held in memory.
+        FAISS 1.7.4 maps only IVF inverted lists; flat, HNSW and scalar-quantized indexes are read fully
+        whatever the flags. HNSW keeps its graph in memory either way, so it never counts as mapped """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return isinstance(faiss.downcast_InvertedLists(ivf.invlists), faiss.OnDiskInvertedLists)
+    if not isinstance(index, faiss.IndexFlatCodes):
+        return False
+    # Newer builds hold the codes in a MaybeOwnedVector, which does not own a mapping
+    return getattr(index.codes, 'is_owned', True) is False
+
+
+def load_faiss(db_path, embeddings=None, use_mmap=None):
+    """ FAISS vectorstore over the files at db_path; indexes still in the pickled layout are read as before """
+    use_mmap = cfg.INDEX_MMAP if use_mmap is None else use_mmap
+    index = read_faiss_index(os.path.join(db_path, 'index.faiss'), use_mmap)
+    if has_chunk_store(db_path):
+        docstore = ChunkStore(db_path)
+        index_to_docstore_id = PositionIds(len(docstore))
+    else:
+        with open(os.path.join(db_path, 'index.pkl'), 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings.embed_query if embeddings is not None else None, index, docstore, index_to_docstore_id)
+
+
+def save_faiss(vectorstore, db_path):
+    """ Write the FAISS index and the chunk store, replacing any pickled docstore """
+    ids = vectorstore.index_to_docstore_id
+    documents = [vectorstore.docstore.search(ids[i]) for i in range(vectorstore.index.ntotal)]
+    os.makedirs(db_path, exist_ok=True)
+    index_path = os.path.join(db_path, 'index.faiss')
+    faiss.write_index(vectorstore.index, index_path + '.tmp')
+    os.replace(index_path + '.tmp', index_path)
+    write_chunk_store(db_path, documents)
+    if os.path.exists(os.path.join(db_path, 'index.pkl')):
+        os.remove(os.path.join(db_path, 'index.pkl'))
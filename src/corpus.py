@@ -0,0 +1,268 @@
+'''
+===========================================
+        Module: Multi-document corpus index
+===========================================
+'''
+import os
+import shutil
+import threading
+import weakref
+from collections import Counter
+from typing import List, Optional, Tuple
+
+import box
+import faiss
+import numpy as np
+import yaml
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+from langchain.vectorstores import FAISS
+from src.build_cache import CachedEmbeddings, file_sha256, read_manifest, write_manifest
+from src.chunk_store import chunk_columns, load_faiss, save_faiss
+from src.db_build import chunk_loader, vectorstore_from_vectors
+from src.embedding import BatchEmbeddings
+from src.extract import extraction_params
+from src.index_factory import build_index
+from src.lexical import index_texts, write_lexical_index
+from src.registry import get_embeddings, invalidate
+from src.rescore import base_index, needs_sidecar, remove_vector_sidecar, write_vector_sidecar
+from src.tracing import run_in_executor, span
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+_corpus_lock = threading.Lock()
+_metadata = weakref.WeakKeyDictionary()
+
+
+# # # Metadata-filtered search
+def document_name(source):
+    return os.path.basename(source)
+
+
+def chunk_metadata(vectorstore):
+    """ Source code and page number of every index position, cached per loaded vectorstore """
+    cached = _metadata.get(vectorstore)
+    if cached is not None and cached['ntotal'] == vectorstore.index.ntotal:
+        return cached
+    names = {}
+    columns = chunk_columns(vectorstore)
+    if columns is not None:
+        # Straight from the chunk store, without materializing any chunk
+        store_sources, codes, pages = columns
+        remap = np.array([names.setdefault(document_name(s), len(names)) for s in store_sources], dtype=np.int32)
+        sources = remap[codes] if len(codes) else codes.astype(np.int32)
+        pages = pages.astype(np.int32)
+    else:
+        ids = vectorstore.index_to_docstore_id
+        sources = np.empty(len(ids), dtype=np.int32)
+        pages = np.empty(len(ids), dtype=np.int32)
+        for i in range(len(ids)):
+            metadata = vectorstore.docstore.search(ids[i]).metadata
+            sources[i] = names.setdefault(document_name(metadata.get('source', '')), len(names))
+            pages[i] = metadata.get('page', -1)
+    cached = {'ntotal': vectorstore.index.ntotal, 'names': names, 'sources': sources, 'pages': pages}
+    _metadata[vectorstore] = cached
+    return cached
+
+
+def filter_mask(vectorstore, sources=None, pages=None):
+    """ Boolean mask over index positions; None when nothing is filtered.
+        pages is an inclusive (first, last) range of 0-based page numbers, as stored by PyPDFLoader """
+    if not sources and pages is None:
+        return None
+    meta = chunk_metadata(vectorstore)
+    mask = np.ones(len(meta['sources']), dtype=bool)
+    if sources:
+        codes = [meta['names'][name] for name in map(document_name, sources) if name in meta['names']]
+        mask &= np.isin(meta['sources'], codes)
+    if pages is not None:
+        first, last = pages
+        mask &= (meta['pages'] >= first) & (meta['pages'] <= last)
+    return mask
+
+
+def _search_parameters(index, selector):
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    if hasattr(index, 'hnsw'):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def search_vectors(vectorstore, vectors, k, mask=None):
+    """ (distances, positions) of shape (n, k) for an (n, d) query matrix, -1 padded;
+        the mask is applied inside the FAISS search via an ID selector """
+    with span('faiss_search', queries=len(vectors), k=k, filtered=mask is not None):
+        if mask is None:
+            return vectorstore.index.search(vectors, k)
+        allowed = np.flatnonzero(mask).astype(np.int64)
+        if not len(allowed):
+            return (np.full((len(vectors), k), np.inf, dtype=np.float32),
+                    np.full((len(vectors), k), -1, dtype=np.int64))
+        selector = faiss.IDSelectorBatch(allowed.size, faiss.swig_ptr(allowed))
+        return vectorstore.index.search(vectors, k, params=_search_parameters(base_index(vectorstore.index), selector))
+
+
+def filtered_positions(vectorstore, query, k, mask=None):
+    """ Top-k (index positions, distances) of one query """
+    with span('embed_query'):
+        vector = np.array([vectorstore.embedding_function(query)], dtype=np.float32)
+    distances, positions = search_vectors(vectorstore, vector, k, mask)
+    found = positions[0] != -1
+    return positions[0][found], distances[0][found]
+
+
+def filtered_search(vectorstore, query, k, sources=None, pages=None):
+    """ Top-k (document, distance) pairs restricted to some documents and/or pages """
+    positions, distances = filtered_positions(vectorstore, query, k, filter_mask(vectorstore, sources, pages))
+    ids = vectorstore.index_to_docstore_id
+    return [(vectorstore.docstore.search(ids[p]), float(d)) for p, d in zip(positions, distances)]
+
+
+class FilteredRetriever(BaseRetriever):
+    """ Retriever restricted to some documents and/or a page range of a FAISS vectorstore """
+    vectorstore: FAISS
+    k: int = 4
+    sources: Optional[List[str]] = None
+    pages: Optional[Tuple[int, int]] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return [doc for doc, _ in filtered_search(self.vectorstore, query, self.k, self.sources, self.pages)]
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        results = await run_in_executor(filtered_search, self.vectorstore, query, self.k, self.sources, self.pages)
+        return [doc for doc, _ in results]
+
+
+# # # Corpus maintenance
+def corpus_exists(corpus_path=None):
+    corpus_path = corpus_path or cfg.CORPUS_DB_PATH
+    return os.path.exists(os.path.join(corpus_path, 'index.faiss'))
+
+
+def corpus_documents(corpus_path=None):
+    return read_manifest(corpus_path or cfg.CORPUS_DB_PATH).get('documents', {})
+
+
+def _remove_chunks(vectorstore, filename, index_config):
+    """ Drop one document's chunks in place; returns the number of chunks removed """
+    meta = chunk_metadata(vectorstore)
+    code = meta['names'].get(document_name(filename))
+    if code is None:
+        return 0
+    remove = np.flatnonzero(meta['sources'] == code).astype(np.int64)
+    ids = vectorstore.index_to_docstore_id
+    kept_ids = [ids[i] for i in np.flatnonzero(meta['sources'] != code)]
+    if isinstance(base_index(vectorstore.index), faiss.IndexFlatCodes):
+        # Flat indexes, float32 or scalar-quantized, compact positions on removal, matching the renumbered id map below
+        base_index(vectorstore.index).remove_ids(faiss.IDSelectorBatch(remove.size, faiss.swig_ptr(remove)))
+    elif not kept_ids:
+        # Nothing left to rebuild from; emptying keeps any training, so the next add can reuse it
+        vectorstore.index.reset()
+    else:
+        # Approximate indexes keep stale ids after removal; rebuild from the cached vectors instead
+        texts = [vectorstore.docstore.search(_id).page_content for _id in kept_ids]
+        vectors = CachedEmbeddings(BatchEmbeddings()).embed_array(texts)
+        vectorstore.index, _ = build_index(vectors, index_config)
+    # Removed chunks stay in the docstore until the next save, which only writes the ones still indexed
+    vectorstore.index_to_docstore_id = dict(enumerate(kept_ids))
+    _metadata.pop(vectorstore, None)
+    return len(remove)
+
+
+def _open_corpus(corpus_path, manifest):
+    """ Unmapped copy of the corpus and its index config. Without the manifest's index settings (an
+        interrupted save, a hand-copied corpus) the index is rebuilt from its stored chunks with the
+        configured ones, and each document found in it is recorded in manifest['documents'] """
+    vectorstore = load_faiss(corpus_path, get_embeddings(), use_mmap=False)
+    if 'index' in manifest:
+        return vectorstore, manifest['index']
+    print(f'No index settings in {corpus_path} manifest; rebuilding the corpus index from its chunks')
+    ids = vectorstore.index_to_docstore_id
+    texts = [vectorstore.docstore.search(ids[i]) for i in range(len(ids))]
+    embeddings = CachedEmbeddings(BatchEmbeddings())
+    vectors = embeddings.embed_array([text.page_content for text in texts])
+    vectorstore, index_config = vectorstore_from_vectors(texts, vectors, embeddings)
+    documents = manifest.setdefault('documents', {})
+    # Without the file hashes the next add of one of these documents re-indexes it
+    for name, chunks in Counter(text.metadata.get('source') for text in texts).items():
+        documents.setdefault(name, {'chunks': chunks})
+    return vectorstore, index_config
+
+
+def _save_corpus(vectorstore, corpus_path, index_config):
+    texts = index_texts(vectorstore)
+    save_faiss(vectorstore, corpus_path)
+    write_lexical_index(corpus_path, texts)
+    if needs_sidecar(index_config):
+        # Every chunk was embedded through the cache, so this only reads the vectors back
+        write_vector_sidecar(corpus_path, CachedEmbeddings(BatchEmbeddings()).embed_array(texts))
+    else:
+        remove_vector_sidecar(corpus_path)
+
+
+def add_document(filename, data_path, chunk_size=None, chunk_overlap=None, corpus_path=None, progress=None, load=None):
+    """ Append (or replace) one document in the shared corpus index without rebuilding the rest.
+        load: a chunk_loader for the same file and split parameters, to reuse its chunks """
+    corpus_path = corpus_path or cfg.CORPUS_DB_PATH
+    chunk_size = chunk_size or cfg.CHUNK_SIZE
+    chunk_overlap = chunk_overlap or cfg.CHUNK_OVERLAP
+    record = {'sha256': file_sha256(os.path.join(data_path, filename)),
+              'chunk_size': chunk_size,
+              'chunk_overlap': chunk_overlap,
+              'extraction': extraction_params()}
+    with _corpus_lock:
+        manifest = read_manifest(corpus_path)
+        documents = manifest.setdefault('documents', {})
+        existing = documents.get(filename, {})
+        if corpus_exists(corpus_path) and all(existing.get(k) == v for k, v in record.items()):
+            print(f'{filename} already in corpus')
+            return False
+
+        load = load or chunk_loader(data_path, filename, chunk_size, chunk_overlap, progress)
+        # Copies, so chunks shared with the file's own index keep their metadata
+        texts = [Document(page_content=text.page_content, metadata=dict(text.metadata, source=filename))
+                 for text in load()]
+        embeddings = CachedEmbeddings(BatchEmbeddings(progress=progress))
+        vectors = embeddings.embed_array([text.page_content for text in texts])
+
+        if corpus_exists(corpus_path):
+            # Mutate a private, unmapped copy; queries keep using the registry's copy until it is invalidated
+            vectorstore, index_config = _open_corpus(corpus_path, manifest)
+            removed = _remove_chunks(vectorstore, filename, index_config)
+            if removed:
+                print(f'Replacing {removed} chunks of {filename} in corpus')
+            vectorstore.add_embeddings(zip([text.page_content for text in texts], vectors),
+                                       metadatas=[text.metadata for text in texts])
+        else:
+            vectorstore, index_config = vectorstore_from_vectors(texts, vectors, embeddings)
+        _save_corpus(vectorstore, corpus_path, index_config)
+        documents[filename] = dict(record, chunks=len(texts))
+        write_manifest(corpus_path, {'index': index_config, 'documents': documents})
+        invalidate(corpus_path)
+        print(f'Added {len(texts)} chunks of {filename} to corpus ({vectorstore.index.ntotal} total)')
+        return True
+
+
+def remove_document(filename, corpus_path=None):
+    """ Remove one document's vectors from the corpus without re-embedding the others """
+    corpus_path = corpus_path or cfg.CORPUS_DB_PATH
+    with _corpus_lock:
+        if not corpus_exists(corpus_path):
+            return 0
+        manifest = read_manifest(corpus_path)
+        rebuilt = 'index' not in manifest
+        vectorstore, index_config = _open_corpus(corpus_path, manifest)
+        removed = _remove_chunks(vectorstore, filename, index_config)
+        manifest.get('documents', {}).pop(filename, None)
+        if not vectorstore.index_to_docstore_id:
+            shutil.rmtree(corpus_path)
+        elif removed or rebuilt:
+            _save_corpus(vectorstore, corpus_path, index_config)
+            write_manifest(corpus_path, dict(manifest, index=index_config))
+        invalidate(corpus_path)
+        print(f'Removed {removed} chunks of {filename} from corpus')
+        return removed
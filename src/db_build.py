@@ -2,59 +2,133 @@
 #  Module: Vector DB Build
 # =========================
 import box
+import os
+import threading
 import yaml
+from pathlib import Path
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.vectorstores import FAISS
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.document_loaders import PyPDFLoader, DirectoryLoader
-from langchain.embeddings import HuggingFaceEmbeddings
 from multipledispatch import dispatch
-from torch import cuda
-from src.env import device
-
-import os
-os.environ["TOKENIZERS_PARALLELISM"] = "false"
+from src.build_cache import CachedEmbeddings, build_key, file_record, is_current, read_manifest, write_manifest
+from src.chunk_store import has_chunk_store, load_faiss, save_faiss
+from src.embedding import BatchEmbeddings
+from src.extract import extraction_params, load_pdf_documents
+from src.index_factory import build_index, build_params, index_config
+from src.lexical import index_texts, lexical_current, write_lexical_index
+from src.registry import invalidate, load_vectorstore
+from src.rescore import needs_sidecar, remove_vector_sidecar, write_vector_sidecar
+from src.tracing import span
 
 # Import config vars
 with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
     cfg = box.Box(yaml.safe_load(ymlfile))
 
+# One lock per index directory: two builds of the same file (a double click, two sessions, an index and
+# an ingest job) would otherwise write its index.faiss, chunks.* and manifest.json at the same time
+_build_locks = {}
+_build_locks_lock = threading.Lock()
 
-# Build vector database
-@dispatch(str)
-def run_db_build(glob:str = '*.pdf'):
-    loader = DirectoryLoader(cfg.DATA_PATH,
-                             glob=glob,
-                             loader_cls=PyPDFLoader)
-    documents = loader.load()
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=cfg.CHUNK_SIZE,
-                                                   chunk_overlap=cfg.CHUNK_OVERLAP)
-    texts = text_splitter.split_documents(documents)
 
-    embeddings = HuggingFaceEmbeddings(model_name='sentence-transformers/all-MiniLM-L6-v2',
-                                       model_kwargs={'device': device})
+def vectorstore_from_vectors(documents, vectors, embeddings, config=None):
+    """ FAISS vectorstore over precomputed float32 vectors, without another copy through lists """
+    index, config = build_index(vectors, config)
+    ids = [str(i) for i in range(len(documents))]
+    docstore = InMemoryDocstore(dict(zip(ids, documents)))
+    return FAISS(embeddings.embed_query, index, docstore, dict(enumerate(ids))), config
 
-    vectorstore = FAISS.from_documents(texts, embeddings)
-    vectorstore.save_local(cfg.DB_FAISS_PATH)
 
-@dispatch(str, str, str, chunk_size=int, chunk_overlap=int)
-def run_db_build(filename, data_path, db_faiss_path, chunk_size=None, chunk_overlap=None):
-    chunk_size = chunk_size or cfg.CHUNK_SIZE
-    chunk_overlap = chunk_overlap or cfg.CHUNK_OVERLAP
-    
-    loader = DirectoryLoader(data_path,
-                             glob=filename,
-                             loader_cls=PyPDFLoader)
-    documents = loader.load()
+def load_chunks(data_path, glob, chunk_size, chunk_overlap, progress=None):
+    """ Load the matching PDFs and split them into chunks carrying source and page metadata """
+    documents = [document
+                 for path in sorted(Path(data_path).glob(glob)) if path.is_file()
+                 for document in load_pdf_documents(str(path), progress)]
 
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size,
                                                    chunk_overlap=chunk_overlap)
-    texts = text_splitter.split_documents(documents)
+    with span('split', pages=len(documents)) as attrs:
+        chunks = text_splitter.split_documents(documents)
+        attrs['chunks'] = len(chunks)
+    return chunks
+
+
+def chunk_loader(data_path, glob, chunk_size, chunk_overlap, progress=None):
+    """ load_chunks deferred until first called, then the same chunks on every call; lets a file's own
+        index and the corpus share one extraction while either can still skip it when up to date """
+    loaded = []
+
+    def load():
+        if not loaded:
+            loaded.append(load_chunks(data_path, glob, chunk_size, chunk_overlap, progress))
+        return loaded[0]
+    return load
+
+
+def _build_lock(db_faiss_path):
+    with _build_locks_lock:
+        return _build_locks.setdefault(os.path.abspath(db_faiss_path), threading.Lock())
 
-    embeddings = HuggingFaceEmbeddings(model_name='sentence-transformers/all-MiniLM-L6-v2',
-                                       model_kwargs={'device': device})
 
-    vectorstore = FAISS.from_documents(texts, embeddings)
-    vectorstore.save_local(db_faiss_path)
+def build_vectorstore(data_path, glob, db_faiss_path, chunk_size, chunk_overlap, progress=None, load=None):
+    """ Build the index unless one built from the same content and parameters already exists.
+        load: a chunk_loader for the same files and split parameters, to reuse its chunks.
+        Builds of one index directory run one at a time; a second one finds the first one's index current """
+    with _build_lock(db_faiss_path):
+        return _build_vectorstore(data_path, glob, db_faiss_path, chunk_size, chunk_overlap, progress, load)
+
+
+def _build_vectorstore(data_path, glob, db_faiss_path, chunk_size, chunk_overlap, progress, load):
+    known = read_manifest(db_faiss_path).get('files', {})
+    files = {str(p): file_record(str(p), known.get(str(p)))
+             for p in sorted(Path(data_path).glob(glob)) if p.is_file()}
+    config = index_config()
+    key = build_key([f['sha256'] for f in files.values()], chunk_size, chunk_overlap, cfg.EMBEDDING_MODEL,
+                    dict(build_params(config), extraction=extraction_params()))
+    if is_current(db_faiss_path, key):
+        if not has_chunk_store(db_faiss_path):
+            # Same content in the older pickled layout; rewrite it rather than re-embed
+            save_faiss(load_faiss(db_faiss_path, use_mmap=False), db_faiss_path)
+            invalidate(db_faiss_path)
+        if not lexical_current(db_faiss_path):
+            write_lexical_index(db_faiss_path, index_texts(load_vectorstore(db_faiss_path)))
+            invalidate(db_faiss_path)
+        print(f'Index at {db_faiss_path} is up to date')
+        return False
+
+    texts = load() if load is not None else load_chunks(data_path, glob, chunk_size, chunk_overlap, progress)
+
+    embeddings = CachedEmbeddings(BatchEmbeddings(progress=progress))
+    vectors = embeddings.embed_array([text.page_content for text in texts])
+
+    with span('index_build', chunks=len(texts), type=config['type']):
+        vectorstore, config = vectorstore_from_vectors(texts, vectors, embeddings, config)
+    save_faiss(vectorstore, db_faiss_path)
+    if needs_sidecar(config):
+        write_vector_sidecar(db_faiss_path, vectors)
+    else:
+        remove_vector_sidecar(db_faiss_path)
+    write_lexical_index(db_faiss_path, [text.page_content for text in texts])
+    write_manifest(db_faiss_path, {'key': key,
+                                   'files': files,
+                                   'chunk_size': chunk_size,
+                                   'chunk_overlap': chunk_overlap,
+                                   'embedding_model': cfg.EMBEDDING_MODEL,
+                                   'index': config,
+                                   'chunks': len(texts)})
+    invalidate(db_faiss_path)
+    return True
+
+
+# Build vector database
+@dispatch(str)
+def run_db_build(glob:str = '*.pdf'):
+    return build_vectorstore(cfg.DATA_PATH, glob, cfg.DB_FAISS_PATH, cfg.CHUNK_SIZE, cfg.CHUNK_OVERLAP)
+
+@dispatch(str, str, str, chunk_size=int, chunk_overlap=int)
+def run_db_build(filename, data_path, db_faiss_path, chunk_size=None, chunk_overlap=None, progress=None, load=None):
+    chunk_size = chunk_size or cfg.CHUNK_SIZE
+    chunk_overlap = chunk_overlap or cfg.CHUNK_OVERLAP
+    return build_vectorstore(data_path, filename, db_faiss_path, chunk_size, chunk_overlap, progress, load)
 
 if __name__ == "__main__":
-    run_db_build()
\ No newline at end of file
+    run_db_build('*.pdf')
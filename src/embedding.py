@@ -0,0 +1,116 @@
+'''
+===========================================
+        Module: Batched embedding engine
+===========================================
+'''
+import multiprocessing
+import os
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import box
+import numpy as np
+import yaml
+from langchain.embeddings.base import Embeddings
+from src.registry import get_embeddings
+from src.tracing import record
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+if cfg.EMBED_WORKERS > 1:
+    # Each worker process tokenizes on its own; one tokenizer thread pool per process would oversubscribe
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+_worker_model = None
+
+
+def _init_worker(model_name, threads):
+    """ Loads the sentence-transformer once per worker process """
+    global _worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+    if threads:
+        torch.set_num_threads(threads)
+    _worker_model = SentenceTransformer(model_name, device='cpu')
+
+
+def _encode(model, texts, batch_size):
+    vectors = model.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+    return vectors.astype(np.float32, copy=False)
+
+
+def _worker_encode(texts, batch_size):
+    return _encode(_worker_model, texts, batch_size)
+
+
+def embed_texts(texts, model_name=None, batch_size=None, workers=None, threads=None, progress=None):
+    """ Embed texts into an (n, d) float32 array, batching chunks of similar length together """
+    model_name = model_name or cfg.EMBEDDING_MODEL
+    batch_size = batch_size or cfg.EMBED_BATCH_SIZE
+    workers = workers or cfg.EMBED_WORKERS
+    threads = threads or cfg.EMBED_THREADS
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+
+    start = timeit.default_timer()
+    # Longest first, so every batch is padded to roughly its own length
+    order = np.argsort([-len(text) for text in texts], kind='stable')
+    batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    workers = min(workers, len(batches))
+
+    vectors = None
+    done = 0
+    if workers > 1:
+        # Spawned, not forked: the server has torch/OpenMP and LLM threads running by now, and a child
+        # forked mid-flight can hang on their locks. Each worker loads its own model in _init_worker anyway
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(model_name, threads)) as pool:
+            futures = [(idx, pool.submit(_worker_encode, [texts[i] for i in idx], batch_size))
+                       for idx in batches]
+            for idx, future in futures:
+                batch_vectors = future.result()
+                if vectors is None:
+                    vectors = np.empty((len(texts), batch_vectors.shape[1]), dtype=np.float32)
+                vectors[idx] = batch_vectors
+                done += len(idx)
+                if progress:
+                    progress(done, len(texts), 'chunks')
+    else:
+        model = get_embeddings(model_name).client
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        vectors = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype=np.float32)
+        for idx in batches:
+            vectors[idx] = _encode(model, [texts[i] for i in idx], batch_size)
+            done += len(idx)
+            if progress:
+                progress(done, len(texts), 'chunks')
+
+    elapsed = timeit.default_timer() - start
+    record('embed', elapsed, start, chunks=len(texts))
+    print(f'Embedded {len(texts)} chunks in {elapsed:.2f}s ({len(texts) / elapsed:.1f} chunks/sec, '
+          f'batch size {batch_size}, {max(workers, 1)} process(es))')
+    return vectors
+
+
+class BatchEmbeddings(Embeddings):
+    """ LangChain Embeddings backed by embed_texts for documents and the shared model for queries """
+
+    def __init__(self, model_name=None, progress=None):
+        self.model_name = model_name or cfg.EMBEDDING_MODEL
+        self.progress = progress
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        return embed_texts(texts, self.model_name, progress=self.progress)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return get_embeddings(self.model_name).embed_query(text)
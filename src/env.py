@@ -1,3 +1,8 @@
-from torch import cuda
-
-device = f'cuda:{cuda.current_device()}' if cuda.is_available() else 'cpu'
\ No newline at end of file
+def __getattr__(name):
+    # Resolved on first use so importing the app does not pull in torch
+    global device
+    if name == 'device':
+        from torch import cuda
+        device = f'cuda:{cuda.current_device()}' if cuda.is_available() else 'cpu'
+        return device
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,124 @@
+'''
+===========================================
+        Module: Text extraction
+===========================================
+'''
+import hashlib
+import json
+import multiprocessing
+import os
+import timeit
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import box
+import numpy as np
+import yaml
+from langchain.schema import Document
+from src.build_cache import file_sha256
+from src.ocr import available_cores, ocr_page_text, timed
+from src.tracing import record, span
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# Per page: where its text starts in the blob, how long it is, and whether it came from OCR
+PAGE_INDEX_DTYPE = np.dtype([('offset', '<i8'), ('length', '<i4'), ('ocr', '?')])
+
+
+def extraction_params():
+    """ Everything besides the file content that changes the extracted text """
+    return {'min_page_chars': cfg.MIN_PAGE_CHARS, 'ocr_dpi': cfg.OCR_DPI}
+
+
+def _cache_paths(file_hash):
+    key = hashlib.sha256(json.dumps([file_hash, extraction_params()], sort_keys=True).encode('utf8')).hexdigest()
+    base = os.path.join(cfg.PAGE_CACHE_PATH, key)
+    return base + '.idx.npy', base + '.txt'
+
+
+def needs_ocr(text):
+    return len(text.strip()) < cfg.MIN_PAGE_CHARS
+
+
+def _ocr_pages(filepath, page_numbers, progress=None):
+    """ OCR the given 0-based pages in parallel; returns {page: text} """
+    texts = {}
+    workers = max(1, min(cfg.OCR_WORKERS or available_cores(), len(page_numbers)))
+    # Spawned rather than forked from a server whose torch and LLM threads are already running
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        todo = deque(page_numbers)
+        pending = deque()
+        while todo and len(pending) < 2 * workers:
+            page = todo.popleft()
+            pending.append((page, pool.submit(timed, ocr_page_text, filepath, page + 1, cfg.OCR_DPI)))
+        while pending:
+            page, future = pending.popleft()
+            texts[page], seconds = future.result()
+            record('ocr_page', seconds, page=page)
+            if todo:
+                next_page = todo.popleft()
+                pending.append((next_page, pool.submit(timed, ocr_page_text, filepath, next_page + 1, cfg.OCR_DPI)))
+            if progress:
+                progress(len(texts), len(page_numbers), "pages OCR'd")
+    return texts
+
+
+def extract_pages(filepath, progress=None):
+    """ Text of every page: the native text layer where there is one, OCR for pages with too little text """
+    from pypdf import PdfReader
+    start = timeit.default_timer()
+    with span('extract', file=os.path.basename(filepath)) as attrs:
+        texts = [page.extract_text() or '' for page in PdfReader(filepath).pages]
+        scanned = [i for i, text in enumerate(texts) if needs_ocr(text)]
+        ocr = np.zeros(len(texts), dtype=bool)
+        if scanned:
+            for page, text in _ocr_pages(filepath, scanned, progress).items():
+                texts[page] = text
+            ocr[scanned] = True
+        attrs.update(pages=len(texts), ocr_pages=len(scanned))
+    print(f'Extracted {len(texts)} pages of {os.path.basename(filepath)} in {timeit.default_timer() - start:.2f}s '
+          f'({len(texts) - len(scanned)} from the text layer, {len(scanned)} OCR-ed)')
+    return texts, ocr
+
+
+def write_page_cache(index_path, blob_path, texts, ocr):
+    encoded = [text.encode('utf8') for text in texts]
+    index = np.zeros(len(texts), dtype=PAGE_INDEX_DTYPE)
+    index['length'] = [len(b) for b in encoded]
+    index['offset'][1:] = np.cumsum(index['length'])[:-1]
+    index['ocr'] = ocr
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with open(blob_path + '.tmp', 'wb') as f:
+        f.write(b''.join(encoded))
+    os.replace(blob_path + '.tmp', blob_path)
+    # The index is written last, so its presence means the blob is complete
+    with open(index_path + '.tmp', 'wb') as f:
+        np.save(f, index)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def read_page_cache(index_path, blob_path):
+    index = np.load(index_path)
+    with open(blob_path, 'rb') as f:
+        blob = f.read()
+    texts = [blob[o:o + n].decode('utf8') for o, n in zip(index['offset'], index['length'])]
+    return texts, index['ocr']
+
+
+def cached_pages(filepath, progress=None):
+    """ Per-page text of a PDF, extracted once per file content and extraction settings """
+    index_path, blob_path = _cache_paths(file_sha256(filepath))
+    if os.path.exists(index_path):
+        return read_page_cache(index_path, blob_path)
+    texts, ocr = extract_pages(filepath, progress)
+    write_page_cache(index_path, blob_path, texts, ocr)
+    return texts, ocr
+
+
+def load_pdf_documents(filepath, progress=None):
+    """ One Document per page, with the same source/page metadata as PyPDFLoader """
+    texts, ocr = cached_pages(filepath, progress)
+    return [Document(page_content=text, metadata={'source': str(filepath), 'page': i, 'ocr': bool(is_ocr)})
+            for i, (text, is_ocr) in enumerate(zip(texts, ocr))]
@@ -0,0 +1,69 @@
+'''
+===========================================
+        Module: Hybrid BM25 + vector retrieval
+===========================================
+'''
+import timeit
+from typing import List, Optional, Tuple
+
+import box
+import numpy as np
+import yaml
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+from langchain.vectorstores import FAISS
+from src.corpus import filter_mask, filtered_positions
+from src.lexical import lexical_index
+from src.tracing import run_in_executor, span
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=None):
+    """ Top-k (positions, scores) by sum of 1 / (rrf_k + rank) over every ranking a position appears in """
+    rrf_k = rrf_k or cfg.RRF_K
+    scores = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking):
+            scores[int(position)] = scores.get(int(position), 0.0) + 1.0 / (rrf_k + rank + 1)
+    top = sorted(scores, key=scores.get, reverse=True)[:k]
+    return np.array(top, dtype=np.int64), np.array([scores[p] for p in top], dtype=np.float32)
+
+
+def hybrid_search(vectorstore, query, k, sources=None, pages=None, fetch_k=None):
+    """ Top-k documents fusing the FAISS and BM25 rankings; falls back to FAISS alone without postings """
+    fetch_k = max(fetch_k or cfg.HYBRID_FETCH_K, k)
+    mask = filter_mask(vectorstore, sources, pages)
+    start = timeit.default_timer()
+    dense, _ = filtered_positions(vectorstore, query, fetch_k, mask)
+    dense_time = timeit.default_timer() - start
+    lexical = lexical_index(vectorstore)
+    if lexical is None:
+        positions = dense[:k]
+        lexical_time = 0.0
+    else:
+        start = timeit.default_timer()
+        with span('lexical_search', k=fetch_k):
+            sparse, _ = lexical.search(query, fetch_k, mask)
+        lexical_time = timeit.default_timer() - start
+        positions, _ = reciprocal_rank_fusion([dense, sparse], k)
+    print(f'Hybrid retrieval: dense {1000 * dense_time:.1f} ms, lexical {1000 * lexical_time:.1f} ms')
+    ids = vectorstore.index_to_docstore_id
+    return [vectorstore.docstore.search(ids[p]) for p in positions]
+
+
+class HybridRetriever(BaseRetriever):
+    """ Reciprocal-rank fusion of dense FAISS and BM25 results, with the same filters as FilteredRetriever """
+    vectorstore: FAISS
+    k: int = 4
+    fetch_k: Optional[int] = None
+    sources: Optional[List[str]] = None
+    pages: Optional[Tuple[int, int]] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return hybrid_search(self.vectorstore, query, self.k, self.sources, self.pages, self.fetch_k)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        return await run_in_executor(hybrid_search, self.vectorstore, query, self.k, self.sources, self.pages, self.fetch_k)
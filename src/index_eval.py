@@ -0,0 +1,142 @@
+'''
+===========================================
+        Module: Index recall / latency report
+===========================================
+'''
+import argparse
+import json
+import timeit
+
+import box
+import faiss
+import numpy as np
+import yaml
+from src.build_cache import CachedEmbeddings
+from src.embedding import BatchEmbeddings
+from src.index_factory import apply_search_params, build_index, index_config, train_sample
+from src.registry import load_vectorstore
+from src.rescore import RescoringIndex, needs_sidecar
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+NPROBE_SWEEP = (1, 4, 16, 64)
+EF_SEARCH_SWEEP = (16, 32, 64, 128)
+STORAGE_SWEEP = ('float16', 'int8')
+
+
+def index_vectors(db_path):
+    """ Float32 vectors of every chunk in index order, mostly served from the embedding cache """
+    vectorstore = load_vectorstore(db_path)
+    ids = vectorstore.index_to_docstore_id
+    texts = [vectorstore.docstore.search(ids[i]).page_content for i in range(len(ids))]
+    return CachedEmbeddings(BatchEmbeddings()).embed_array(texts)
+
+
+def recall_at_k(found, truth, k):
+    hits = sum(len(set(f[:k]) & set(t[:k])) for f, t in zip(found, truth))
+    return hits / (len(truth) * k)
+
+
+def time_search(index, queries, k):
+    latencies = []
+    results = []
+    for query in queries:
+        start = timeit.default_timer()
+        _, ids = index.search(query[None, :], k)
+        latencies.append((timeit.default_timer() - start) * 1000)
+        results.append(ids[0])
+    return np.array(results), np.array(latencies)
+
+
+def candidate_configs():
+    for nprobe in NPROBE_SWEEP:
+        yield dict(index_config('ivf_flat', 'float32'), nprobe=nprobe)
+    for nprobe in NPROBE_SWEEP:
+        yield dict(index_config('ivf_pq'), nprobe=nprobe)
+    for ef_search in EF_SEARCH_SWEEP:
+        yield dict(index_config('hnsw', 'float32'), ef_search=ef_search)
+    for storage in STORAGE_SWEEP:
+        yield index_config('flat', storage)
+        yield index_config('ivf_flat', storage)
+        yield index_config('hnsw', storage)
+
+
+def evaluate(vectors, queries, k):
+    """ recall@k and per-query latency of each candidate index against exact flat search. Indexes with
+        lossy codes are also measured with exact re-scoring from the float32 vectors """
+    flat, _ = build_index(vectors, {'type': 'flat'})
+    truth, flat_latency = time_search(flat, queries, k)
+    report = [{'type': 'flat', 'params': {}, 'recall': 1.0,
+               'p50_ms': float(np.percentile(flat_latency, 50)),
+               'p95_ms': float(np.percentile(flat_latency, 95)),
+               'build_s': 0.0,
+               'bytes': int(faiss.serialize_index(flat).size)}]
+    built = {}
+    for config in candidate_configs():
+        build = {k: v for k, v in config.items() if k not in ('nprobe', 'ef_search')}
+        key = json.dumps(build, sort_keys=True)
+        if key not in built:
+            start = timeit.default_timer()
+            try:
+                index, effective = build_index(vectors, config)
+            except ValueError as E:
+                print(f'Skipping {config["type"]}: {E}')
+                built[key] = None
+                continue
+            built[key] = (index, effective, timeit.default_timer() - start)
+        if built[key] is None:
+            continue
+        index, effective, build_s = built[key]
+        config = dict(effective, **{k: v for k, v in config.items() if k in ('nprobe', 'ef_search')})
+        apply_search_params(index, config)
+        params = {k: v for k, v in config.items() if k not in ('type', 'train_sample')}
+        nbytes = int(faiss.serialize_index(index).size)
+        variants = [(index, params)]
+        if needs_sidecar(config):
+            variants.append((RescoringIndex(index, vectors), dict(params, rescore=True)))
+        for searched, row_params in variants:
+            found, latency = time_search(searched, queries, k)
+            report.append({'type': config['type'],
+                           'params': row_params,
+                           'recall': recall_at_k(found, truth, k),
+                           'p50_ms': float(np.percentile(latency, 50)),
+                           'p95_ms': float(np.percentile(latency, 95)),
+                           'build_s': round(build_s, 3),
+                           'bytes': nbytes})
+    for row in report:
+        row['saved'] = round(1 - row['bytes'] / report[0]['bytes'], 4)
+    return report
+
+
+def print_report(report, k):
+    print(f'{"index":<10}{"params":<64}{f"recall@{k}":>10}{"p50 ms":>10}{"p95 ms":>10}{"build s":>10}{"MB":>10}{"saved":>8}')
+    for row in report:
+        params = ', '.join(f'{k}={v}' for k, v in row['params'].items())
+        print(f'{row["type"]:<10}{params:<64}{row["recall"]:>10.3f}{row["p50_ms"]:>10.3f}'
+              f'{row["p95_ms"]:>10.3f}{row["build_s"]:>10.2f}{row["bytes"] / 2**20:>10.2f}{100 * row["saved"]:>7.0f}%')
+    print('MB is the index held in memory; rescore=True rows also read the float32 sidecar, which stays on disk')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare approximate FAISS index types against the flat index')
+    parser.add_argument('db_path', type=str, help='Index directory whose chunks are used as the corpus')
+    parser.add_argument('--questions', type=str, help='Text file with one question per line to use as queries')
+    parser.add_argument('--queries', type=int, default=200, help='Number of chunk vectors sampled as queries when no questions are given')
+    parser.add_argument('--k', type=int, default=cfg.VECTOR_COUNT)
+    parser.add_argument('--json', type=str, help='Also write the report to this file')
+    args = parser.parse_args()
+
+    vectors = index_vectors(args.db_path)
+    if args.questions:
+        with open(args.questions, 'r', encoding='utf8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+        queries = BatchEmbeddings().embed_array(questions)
+    else:
+        queries = train_sample(vectors, args.queries, seed=1)
+    report = evaluate(vectors, queries, args.k)
+    print_report(report, args.k)
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
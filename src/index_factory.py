@@ -0,0 +1,118 @@
+'''
+===========================================
+        Module: FAISS index factory
+===========================================
+'''
+import math
+
+import box
+import faiss
+import numpy as np
+import yaml
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+STORAGE_TYPES = ('float32', 'float16', 'int8')
+# ivf_pq codes are already compressed, so VECTOR_STORAGE applies to the other types
+SQ_INDEX_TYPES = ('flat', 'ivf_flat', 'hnsw')
+
+
+def index_config(index_type=None, storage=None):
+    """ Index type and parameters from config; build-time and search-time parameters together """
+    index_type = index_type or cfg.INDEX_TYPE
+    storage = storage or cfg.VECTOR_STORAGE
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f'Unknown INDEX_TYPE {index_type}; expected one of {INDEX_TYPES}')
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f'Unknown VECTOR_STORAGE {storage}; expected one of {STORAGE_TYPES}')
+    config = {'type': index_type}
+    if storage != 'float32' and index_type in SQ_INDEX_TYPES:
+        # Left out for float32 so existing build keys stay valid
+        config.update(storage=storage, train_sample=cfg.INDEX_TRAIN_SAMPLE)
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        config.update(nlist=cfg.IVF_NLIST, train_sample=cfg.INDEX_TRAIN_SAMPLE)
+    if index_type == 'ivf_pq':
+        config.update(pq_m=cfg.PQ_M, pq_nbits=cfg.PQ_NBITS)
+    if index_type == 'hnsw':
+        config.update(m=cfg.HNSW_M, ef_construction=cfg.HNSW_EF_CONSTRUCTION)
+    config.update(search_params(index_type))
+    return config
+
+
+def search_params(index_type):
+    """ Search-time parameters from config; applied on load so they can be tuned without a rebuild """
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        return {'nprobe': cfg.IVF_NPROBE}
+    if index_type == 'hnsw':
+        return {'ef_search': cfg.HNSW_EF_SEARCH}
+    return {}
+
+
+def build_params(config):
+    """ The parameters that change the index contents; search-time ones can change without a rebuild """
+    return {k: v for k, v in config.items() if k not in ('nprobe', 'ef_search')}
+
+
+def train_sample(vectors, size, seed=0):
+    if len(vectors) <= size:
+        return vectors
+    rows = np.random.default_rng(seed).choice(len(vectors), size, replace=False)
+    return vectors[np.sort(rows)]
+
+
+def _sq_type(storage):
+    return {'float16': faiss.ScalarQuantizer.QT_fp16, 'int8': faiss.ScalarQuantizer.QT_8bit}[storage]
+
+
+def build_index(vectors, config=None):
+    """ Build and fill a FAISS index over float32 vectors; returns (index, effective config).
+        With a storage of float16 or int8 the vectors are scalar-quantized; the int8 per-dimension
+        ranges are trained on a sample and serialized with the index """
+    config = dict(config or index_config())
+    n, d = vectors.shape
+    index_type = config['type']
+    storage = config.get('storage', 'float32')
+    if index_type == 'flat':
+        if storage == 'float32':
+            index = faiss.IndexFlatL2(d)
+        else:
+            index = faiss.IndexScalarQuantizer(d, _sq_type(storage), faiss.METRIC_L2)
+    elif index_type == 'hnsw':
+        if storage == 'float32':
+            index = faiss.IndexHNSWFlat(d, config['m'])
+        else:
+            index = faiss.IndexHNSWSQ(d, _sq_type(storage), config['m'])
+        index.hnsw.efConstruction = config['ef_construction']
+    else:
+        # k-means wants ~39 points per centroid; small corpora get fewer lists
+        config['nlist'] = max(1, min(config['nlist'], n // 39))
+        quantizer = faiss.IndexFlatL2(d)
+        if index_type == 'ivf_flat' and storage == 'float32':
+            index = faiss.IndexIVFFlat(quantizer, d, config['nlist'])
+        elif index_type == 'ivf_flat':
+            index = faiss.IndexIVFScalarQuantizer(quantizer, d, config['nlist'], _sq_type(storage), faiss.METRIC_L2)
+        else:
+            if d % config['pq_m']:
+                raise ValueError(f'PQ_M={config["pq_m"]} must divide the embedding dimension {d}')
+            config['pq_nbits'] = max(1, min(config['pq_nbits'], int(math.log2(max(n, 2)))))
+            index = faiss.IndexIVFPQ(quantizer, d, config['nlist'], config['pq_m'], config['pq_nbits'])
+        sample = train_sample(vectors, config['train_sample'])
+        print(f'Training {index_type} index on {len(sample)} of {n} vectors (nlist={config["nlist"]})')
+        index.train(sample)
+    if not index.is_trained:
+        index.train(train_sample(vectors, config['train_sample']))
+    index.add(vectors)
+    apply_search_params(index, config)
+    return index, config
+
+
+def apply_search_params(index, config):
+    """ Set nprobe / efSearch on a built or freshly loaded index """
+    if config.get('type') in ('ivf_flat', 'ivf_pq'):
+        faiss.extract_index_ivf(index).nprobe = config['nprobe']
+    elif config.get('type') == 'hnsw':
+        index.hnsw.efSearch = config['ef_search']
+    return index
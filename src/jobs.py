@@ -0,0 +1,173 @@
+'''
+===========================================
+        Module: Background job runner
+===========================================
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import box
+import yaml
+from src.profiling import profile
+from src.tracing import trace
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+ACTIVE = ('queued', 'running')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    unit TEXT NOT NULL DEFAULT '',
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    progress_started REAL,
+    progress_base INTEGER NOT NULL DEFAULT 0,
+    updated REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status);
+'''
+
+
+def job_key(kind, params):
+    return hashlib.sha256(json.dumps([kind, params], sort_keys=True).encode('utf8')).hexdigest()
+
+
+class JobRunner:
+    """ Runs transcribe/index style jobs on a thread pool, tracked in a SQLite table so progress
+        survives page reloads and interrupted jobs are resumed (or marked stale) on restart """
+
+    def __init__(self, handlers, workers=None, db_path=None):
+        # kind -> fn(params, progress) returning a short result message
+        self.handlers = handlers
+        self.db_path = db_path or cfg.JOB_DB_PATH
+        self._pool = ThreadPoolExecutor(max_workers=workers or cfg.JOB_WORKERS, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _update(self, job_id, **fields):
+        fields['updated'] = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                         [*fields.values(), job_id])
+
+    def start(self):
+        """ Re-queue (JOB_RESUME) or mark stale the jobs a previous process left unfinished """
+        with self._lock, self._connect() as conn:
+            rows = conn.execute('SELECT id, status FROM jobs WHERE status IN (?, ?)', ACTIVE).fetchall()
+            if not cfg.JOB_RESUME:
+                conn.execute("UPDATE jobs SET status = 'stale', finished = ? WHERE status IN (?, ?)",
+                             (time.time(), *ACTIVE))
+        if cfg.JOB_RESUME:
+            for row in rows:
+                self._update(row['id'], status='queued', done=0, total=0, unit='', started=None,
+                             progress_started=None, progress_base=0)
+                self._pool.submit(self._run, row['id'])
+        if rows:
+            print(f"{len(rows)} unfinished jobs {'resumed' if cfg.JOB_RESUME else 'marked stale'}")
+        return self
+
+    def submit(self, kind, params, profile=False):
+        """ Queue a job, or return the id of an identical job that is still queued or running.
+            profile: write a profile of this run to PROFILE_DIR whatever the PROFILE setting """
+        key = job_key(kind, params)
+        with self._lock, self._connect() as conn:
+            row = conn.execute('SELECT id FROM jobs WHERE key = ? AND status IN (?, ?)', (key, *ACTIVE)).fetchone()
+            if row is not None:
+                return row['id']
+            job_id = uuid.uuid4().hex
+            conn.execute('INSERT INTO jobs (id, kind, key, params, status, created) VALUES (?, ?, ?, ?, ?, ?)',
+                         (job_id, kind, key, json.dumps(params), 'queued', time.time()))
+        self._pool.submit(self._run, job_id, profile)
+        return job_id
+
+    def _run(self, job_id, force_profile=False):
+        job = self.get(job_id)
+        if job is None or job['status'] != 'queued':
+            return
+        started = time.time()
+        self._update(job_id, status='running', started=started)
+        last = [0.0]
+
+        def progress(done, total, unit):
+            # A phase change (new unit) restarts the ETA clock from this report; writes are throttled
+            now = time.time()
+            if unit != job['unit']:
+                first_phase = not job['unit']
+                job['unit'] = unit
+                self._update(job_id, done=done, total=total, unit=unit,
+                             progress_started=started if first_phase else now,
+                             progress_base=0 if first_phase else done)
+            elif now - last[0] >= cfg.JOB_PROGRESS_INTERVAL or done >= total:
+                self._update(job_id, done=done, total=total)
+            else:
+                return
+            last[0] = now
+
+        with profile(job['kind'], force=force_profile), trace(job['kind'], job_id=job_id) as current:
+            try:
+                result = self.handlers[job['kind']](job['params'], progress)
+                self._update(job_id, status='done', result=result, finished=time.time())
+            except Exception as E:
+                print(f"Job {job['kind']} {job_id} failed: {E}")
+                current.attrs['error'] = str(E)
+                self._update(job_id, status='failed', error=str(E), finished=time.time())
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['eta_s'] = None
+        progressed = job['done'] - job['progress_base']
+        if job['status'] == 'running' and progressed > 0 and job['total'] and job['progress_started']:
+            rate = progressed / max(job['updated'] - job['progress_started'], 1e-6)
+            job['eta_s'] = round((job['total'] - job['done']) / rate, 1)
+        return job
+
+    def recent(self, limit=50):
+        with self._connect() as conn:
+            ids = [row['id'] for row in conn.execute('SELECT id FROM jobs ORDER BY created DESC LIMIT ?', (limit,))]
+        return [self.get(job_id) for job_id in ids]
+
+
+def describe(job):
+    """ One-line status for the UI """
+    if job['status'] == 'done':
+        return job['result'] or 'Done'
+    if job['status'] == 'failed':
+        return f"Failed: {job['error']}"
+    if job['status'] == 'stale':
+        return 'Interrupted by a restart; run it again'
+    if job['status'] == 'queued':
+        return 'Queued'
+    if not job['total']:
+        return 'Running'
+    eta = f", about {job['eta_s']:.0f}s left" if job['eta_s'] is not None else ''
+    return f"Running: {job['done']} of {job['total']} {job['unit']}{eta}"
@@ -0,0 +1,134 @@
+'''
+===========================================
+        Module: BM25 inverted index
+===========================================
+'''
+import json
+import os
+import re
+import weakref
+from collections import Counter
+
+import box
+import numpy as np
+import yaml
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+LEXICAL_FILES = ('lexical_offsets.npy', 'lexical_docs.npy', 'lexical_weights.npy', 'lexical_vocab.json')
+
+# Keeps tickers, note numbers ("12.3") and hyphenated defined terms as single tokens
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-'&][a-z0-9]+)*")
+
+_indexes = weakref.WeakKeyDictionary()
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def index_texts(vectorstore):
+    """ Chunk texts in FAISS index position order """
+    ids = vectorstore.index_to_docstore_id
+    return [vectorstore.docstore.search(ids[i]).page_content for i in range(len(ids))]
+
+
+def build_postings(texts, k1=None, b=None):
+    """ Term -> (doc positions, BM25 impact weights) in CSR form; weights are precomputed so a query
+        only gathers and sums postings """
+    k1 = k1 or cfg.BM25_K1
+    b = cfg.BM25_B if b is None else b
+    vocab = {}
+    term_ids, doc_ids, tfs = [], [], []
+    doc_len = np.zeros(len(texts), dtype=np.float32)
+    for d, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        doc_len[d] = sum(counts.values())
+        for term, tf in counts.items():
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            doc_ids.append(d)
+            tfs.append(tf)
+    term_ids = np.array(term_ids, dtype=np.int32)
+    # Stable sort keeps positions ascending within each term's postings
+    order = np.argsort(term_ids, kind='stable')
+    docs = np.array(doc_ids, dtype=np.int32)[order]
+    tf = np.array(tfs, dtype=np.float32)[order]
+    df = np.bincount(term_ids, minlength=len(vocab))
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(df, out=offsets[1:])
+    idf = np.log1p((len(texts) - df + 0.5) / (df + 0.5)).astype(np.float32)
+    norm = k1 * (1 - b + b * doc_len[docs] / (doc_len.mean() or 1.0))
+    weights = (idf[term_ids[order]] * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+    return vocab, offsets, docs, weights
+
+
+def write_lexical_index(db_path, texts):
+    vocab, offsets, docs, weights = build_postings(texts)
+    os.makedirs(db_path, exist_ok=True)
+    np.save(os.path.join(db_path, 'lexical_offsets.npy'), offsets)
+    np.save(os.path.join(db_path, 'lexical_docs.npy'), docs)
+    np.save(os.path.join(db_path, 'lexical_weights.npy'), weights)
+    with open(os.path.join(db_path, 'lexical_vocab.json'), 'w', encoding='utf8') as f:
+        json.dump({'n_docs': len(texts), 'k1': cfg.BM25_K1, 'b': cfg.BM25_B, 'terms': list(vocab)}, f)
+    size = sum(os.path.getsize(os.path.join(db_path, fname)) for fname in LEXICAL_FILES)
+    faiss_path = os.path.join(db_path, 'index.faiss')
+    faiss_size = os.path.getsize(faiss_path) if os.path.exists(faiss_path) else 0
+    print(f'Lexical index: {len(vocab)} terms, {len(docs)} postings, {size / 2**20:.1f} MB '
+          f'(FAISS index {faiss_size / 2**20:.1f} MB)')
+
+
+def lexical_current(db_path):
+    """ True when postings exist and were weighted with the configured BM25 parameters """
+    try:
+        with open(os.path.join(db_path, 'lexical_vocab.json'), 'r', encoding='utf8') as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return False
+    return meta['k1'] == cfg.BM25_K1 and meta['b'] == cfg.BM25_B and all(
+        os.path.exists(os.path.join(db_path, fname)) for fname in LEXICAL_FILES)
+
+
+class LexicalIndex:
+    """ Memory-mapped BM25 postings aligned with FAISS index positions """
+
+    def __init__(self, db_path):
+        with open(os.path.join(db_path, 'lexical_vocab.json'), 'r', encoding='utf8') as f:
+            meta = json.load(f)
+        self.n_docs = meta['n_docs']
+        self.vocab = {term: i for i, term in enumerate(meta['terms'])}
+        self.offsets = np.load(os.path.join(db_path, 'lexical_offsets.npy'), mmap_mode='r')
+        self.docs = np.load(os.path.join(db_path, 'lexical_docs.npy'), mmap_mode='r')
+        self.weights = np.load(os.path.join(db_path, 'lexical_weights.npy'), mmap_mode='r')
+
+    def search(self, query, k, mask=None):
+        """ Top-k (positions, scores) by BM25; mask restricts which positions may be returned """
+        term_ids = [self.vocab[t] for t in set(tokenize(query)) if t in self.vocab]
+        if not term_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        spans = [(self.offsets[t], self.offsets[t + 1]) for t in term_ids]
+        docs = np.concatenate([self.docs[s:e] for s, e in spans])
+        weights = np.concatenate([self.weights[s:e] for s, e in spans])
+        scores = np.bincount(docs, weights=weights, minlength=self.n_docs)
+        if mask is not None:
+            scores[~mask] = 0
+        k = min(k, int(np.count_nonzero(scores)))
+        if not k:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return top, scores[top].astype(np.float32)
+
+
+def attach_lexical_index(vectorstore, db_path):
+    if lexical_current(db_path):
+        _indexes[vectorstore] = LexicalIndex(db_path)
+
+
+def lexical_index(vectorstore):
+    """ The postings loaded alongside this vectorstore, or None if it has none """
+    index = _indexes.get(vectorstore)
+    if index is not None and index.n_docs == vectorstore.index.ntotal:
+        return index
+    return None
@@ -7,9 +7,15 @@ import argparse
 import box
 from dotenv import find_dotenv, load_dotenv
 from langchain.llms import LlamaCpp
+from langchain.llms.base import BaseLLM
 from multipledispatch import dispatch
 import timeit
-from src.utils import setup_dbqa
+from src.answer_cache import answer_namespace, get_answer_cache
+from src.callbacks import BufferCallbackHandler, TracingCallbackHandler
+from src.prefix_cache import enable_prefix_cache
+from src.profiling import profile
+from src.tracing import span, trace
+from src.utils import set_prompt, setup_dbqa
 import yaml
 
 # Load environment variables from .env file
@@ -22,8 +28,8 @@ with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
 @dispatch()
 def build_llm():
     llm = LlamaCpp(
-        model_path='models\llama-2-13b-chat.gguf.q8_0.bin',
-        n_ctx= 2048,
+        model_path=cfg.LLM_MODEL_PATH,
+        n_ctx=cfg.N_CTX,
         verbose=True,
         use_mlock=True,
         n_gpu_layers=100,
@@ -32,30 +38,45 @@ def build_llm():
         temperature=cfg.TEMPERATURE,
         max_tokens=cfg.MAX_NEW_TOKENS
     )
-    return llm
+    return enable_prefix_cache(llm)
 
-@dispatch(str)
-def query(qstring: str):
+def cached_answer(qstring: str, db_path: str, sources=None, pages=None):
+    """ Cached response with its time field marked as cached, or None on a miss """
+    if not cfg.ANSWER_CACHE:
+        return None
     start = timeit.default_timer()
-    dbqa = setup_dbqa()
-    response = dbqa({'query': qstring})
-    end = timeit.default_timer()
+    namespace = answer_namespace(db_path, set_prompt().template, sources, pages)
+    response = get_answer_cache().lookup(namespace, qstring)
+    if response is not None:
+        response['time'] = f'{round(timeit.default_timer() - start, 2)} (cached)'
+    return response
 
-    print('='*100)
-    print(f"query: {response['query']}")
-    print(f"result: {response['result']}")
-    print(f"time: {round(end - start, 2)} seconds")
-    print('='*100)
+def cache_answer(qstring: str, db_path: str, response, sources=None, pages=None):
+    if cfg.ANSWER_CACHE and not response.get('error'):
+        namespace = answer_namespace(db_path, set_prompt().template, sources, pages)
+        get_answer_cache().put(namespace, qstring, response)
 
-    return response
+@dispatch(str)
+def query(qstring: str):
+    return query(qstring, cfg.DB_FAISS_PATH)
 
 @dispatch(str, str)
 def query(qstring: str, db_path: str):
-    start = timeit.default_timer()
-    dbqa = setup_dbqa(db_path)
-    response = dbqa({'query': qstring})
-    end = timeit.default_timer()
-    response['time'] = round(end - start, 2)
+    return query(qstring, db_path, build_llm())
+
+@dispatch(str, str, BaseLLM)
+def query(qstring: str, db_path: str, llm, sources=None, pages=None, callbacks=None, use_cache=True):
+    with profile('query'), trace('query', question=qstring, db_path=db_path) as current:
+        start = timeit.default_timer()
+        response = cached_answer(qstring, db_path, sources, pages) if use_cache else None
+        current.attrs['cached'] = response is not None
+        if response is None:
+            with span('setup'):
+                dbqa = setup_dbqa(db_path, llm, sources=sources, pages=pages)
+            response = dbqa({'query': qstring}, callbacks=[TracingCallbackHandler(llm), *(callbacks or [])])
+            end = timeit.default_timer()
+            response['time'] = round(end - start, 2)
+            cache_answer(qstring, db_path, response, sources, pages)
 
     print('='*100)
     print(f"query: {response['query']}")
@@ -65,17 +86,43 @@ def query(qstring: str, db_path: str):
 
     return response
 
-@dispatch(str, str, LlamaCpp)
-def query(qstring: str, db_path: str, llm):
-    start = timeit.default_timer()
-    dbqa = setup_dbqa(db_path, llm)
-    response = dbqa({'query': qstring})
-    end = timeit.default_timer()
-    response['time'] = round(end - start, 2)
+def stream_query(qstring: str, db_path: str, llm, buffer, sources=None, pages=None, callbacks=None, use_cache=True):
+    """ Answer into a StreamBuffer: citations as soon as retrieval finishes, then tokens as generated """
+    with profile('stream_query'), trace('stream_query', question=qstring, db_path=db_path, stream_id=buffer.id) as current:
+        cached = cached_answer(qstring, db_path, sources, pages) if use_cache else None
+        current.attrs['cached'] = cached is not None
+        if cached is not None:
+            buffer.cached = True
+            buffer.set_sources(cached['source_documents'])
+            buffer.append(cached['result'])
+            buffer.finish()
+            return buffer.response()
+        try:
+            with span('setup'):
+                dbqa = setup_dbqa(db_path, llm, sources=sources, pages=pages)
+            tracer = TracingCallbackHandler(llm)
+            with span('retrieve') as attrs:
+                docs = dbqa.retriever.get_relevant_documents(qstring)
+                attrs['documents'] = len(docs)
+            buffer.set_sources(docs)
+            tracer.mark_prompt_start()
+            dbqa.combine_documents_chain.run(input_documents=docs,
+                                             question=qstring,
+                                             callbacks=[tracer, BufferCallbackHandler(buffer), *(callbacks or [])])
+            buffer.finish()
+        except Exception as E:
+            print(E)
+            buffer.finish(error=str(E))
+            current.attrs['error'] = str(E)
+            # The reader already has the error; re-raised so the scheduler counts a timeout or failure
+            raise
+        response = buffer.response()
+        cache_answer(qstring, db_path, response, sources, pages)
 
     print('='*100)
     print(f"query: {response['query']}")
     print(f"result: {response['result']}")
+    print(f"time to first token: {response['ttft']} seconds")
     print(f"time: {response['time']} seconds")
     print('='*100)
 
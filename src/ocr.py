@@ -0,0 +1,104 @@
+'''
+===========================================
+        Module: OCR pipeline
+===========================================
+'''
+import io
+import multiprocessing
+import os
+import timeit
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import box
+import yaml
+from src.perf import peak_child_rss_mb, peak_rss_mb
+from src.tracing import record
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def timed(fn, *args):
+    """ (fn(*args), seconds) measured inside the pool worker, so queueing time is not counted """
+    start = timeit.default_timer()
+    result = fn(*args)
+    return result, timeit.default_timer() - start
+
+
+def ocr_page_range(filepath, first_page, last_page, dpi):
+    """ Rasterize and OCR one batch of pages; runs inside a pool worker """
+    import pytesseract
+    from pdf2image import convert_from_path
+    images = convert_from_path(filepath, dpi=dpi, first_page=first_page, last_page=last_page)
+    return [pytesseract.image_to_pdf_or_hocr(image) for image in images]
+
+
+def ocr_page_text(filepath, page_number, dpi):
+    """ Rasterize and OCR one (1-based) page to plain text; runs inside a pool worker """
+    import pytesseract
+    from pdf2image import convert_from_path
+    images = convert_from_path(filepath, dpi=dpi, first_page=page_number, last_page=page_number)
+    return '\n'.join(pytesseract.image_to_string(image) for image in images)
+
+
+def page_batches(n_pages, batch_size):
+    return [(first, min(first + batch_size - 1, n_pages))
+            for first in range(1, n_pages + 1, batch_size)]
+
+
+def transcribe_pdf(filepath, transcribed_filepath, batch_size=None, workers=None, progress=None):
+    """ OCR a PDF into a searchable PDF, rasterizing and OCR-ing page batches in parallel;
+        progress(done, total, unit) is called after every batch """
+    import PyPDF2
+    from pdf2image import pdfinfo_from_path
+    start = timeit.default_timer()
+    n_pages = pdfinfo_from_path(filepath)['Pages']
+    batches = page_batches(n_pages, batch_size or cfg.OCR_BATCH_SIZE)
+    workers = max(1, min(workers or cfg.OCR_WORKERS or available_cores(), len(batches)))
+
+    pdf_writer = PyPDF2.PdfWriter()
+    done = 0
+    # Spawned rather than forked from a server whose torch and LLM threads are already running
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        # Only a couple of batches per worker are in flight, so at most that many
+        # rasterized batches exist at once; results are consumed in page order.
+        todo = deque(batches)
+        pending = deque()
+        while todo and len(pending) < 2 * workers:
+            pending.append(pool.submit(timed, ocr_page_range, filepath, *todo.popleft(), cfg.OCR_DPI))
+        while pending:
+            pages, seconds = pending.popleft().result()
+            if todo:
+                pending.append(pool.submit(timed, ocr_page_range, filepath, *todo.popleft(), cfg.OCR_DPI))
+            # A batch is rasterized in one call; each of its pages is recorded with the batch average
+            for _ in pages:
+                record('ocr_page', seconds / len(pages))
+            for page in pages:
+                pdf_writer.add_page(PyPDF2.PdfReader(io.BytesIO(page)).pages[0])
+            done += len(pages)
+            print(f'Transcribed page {done} of {n_pages}')
+            if progress:
+                progress(done, n_pages, 'pages')
+
+    with open(transcribed_filepath, 'wb') as f:
+        pdf_writer.write(f)
+    elapsed = timeit.default_timer() - start
+    record('transcribe', elapsed, start, pages=n_pages)
+    stats = {'pages': n_pages,
+             'seconds': round(elapsed, 2),
+             'pages_per_sec': round(n_pages / elapsed, 2) if elapsed else 0.0,
+             'workers': workers,
+             'peak_rss_mb': round(peak_rss_mb(), 1),
+             'peak_worker_rss_mb': round(peak_child_rss_mb(), 1)}
+    print(f"{n_pages} pages transcribed in {stats['seconds']}s ({stats['pages_per_sec']} pages/sec, "
+          f"{workers} workers, peak RSS {stats['peak_rss_mb']} MB, worker peak RSS {stats['peak_worker_rss_mb']} MB)")
+    return stats
@@ -0,0 +1,127 @@
+'''
+===========================================
+        Module: Context packing
+===========================================
+'''
+import re
+from typing import Any, List, Optional
+
+import box
+import yaml
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+from src.tracing import run_in_executor, span
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# The "stuff" chain joins documents with this separator
+DOCUMENT_SEPARATOR = '\n\n'
+MIN_OVERLAP = 10
+
+
+def overlap_length(a, b, min_overlap=MIN_OVERLAP):
+    """ Length of the longest suffix of a that is a prefix of b (at least min_overlap), else 0 """
+    if len(b) < min_overlap:
+        return 0
+    head = b[:min_overlap]
+    pos = a.find(head, max(0, len(a) - len(b)))
+    while pos != -1:
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        pos = a.find(head, pos + 1)
+    return 0
+
+
+def merge_overlapping(docs):
+    """ Merge chunks of the same page that overlap or contain each other; keeps the best rank's position """
+    merged = []
+    for doc in docs:
+        key = (doc.metadata.get('source'), doc.metadata.get('page'))
+        text = doc.page_content
+        for i, (other_key, other) in enumerate(merged):
+            if other_key != key:
+                continue
+            if text in other:
+                break
+            if other in text:
+                merged[i] = (key, text)
+                break
+            ov = overlap_length(other, text)
+            if ov:
+                merged[i] = (key, other + text[ov:])
+                break
+            ov = overlap_length(text, other)
+            if ov:
+                merged[i] = (key, text + other[ov:])
+                break
+        else:
+            merged.append((key, text))
+    first = {}
+    for doc in docs:
+        first.setdefault((doc.metadata.get('source'), doc.metadata.get('page')), doc.metadata)
+    return [Document(page_content=text, metadata=dict(first[key])) for key, text in merged]
+
+
+def _shingles(text, n=3):
+    words = re.findall(r'\w+', text.lower())
+    return {tuple(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+
+
+def drop_near_duplicates(docs, threshold=None):
+    """ Drop lower-ranked chunks whose word 3-gram Jaccard similarity to a kept chunk is above threshold """
+    threshold = threshold or cfg.CONTEXT_DEDUP_THRESHOLD
+    kept, kept_shingles = [], []
+    for doc in docs:
+        shingles = _shingles(doc.page_content)
+        if any(len(shingles & other) / (len(shingles | other) or 1) >= threshold for other in kept_shingles):
+            continue
+        kept.append(doc)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def context_budget(llm, prompt, question):
+    """ Tokens left for context: the context window minus generation room and the rest of the prompt """
+    if cfg.CONTEXT_TOKEN_BUDGET:
+        return cfg.CONTEXT_TOKEN_BUDGET
+    scaffold = prompt.format(context='', question=question)
+    return cfg.N_CTX - cfg.MAX_NEW_TOKENS - llm.get_num_tokens(scaffold) - cfg.CONTEXT_MARGIN
+
+
+def pack_documents(docs, count_tokens, budget):
+    """ Merge, de-duplicate and greedily fill the token budget in retrieval order """
+    candidates = drop_near_duplicates(merge_overlapping(docs))
+    separator = count_tokens(DOCUMENT_SEPARATOR)
+    packed, used = [], 0
+    for doc in candidates:
+        tokens = count_tokens(doc.page_content) + (separator if packed else 0)
+        if used + tokens > budget:
+            continue
+        packed.append(doc)
+        used += tokens
+    print(f'Context packing: {len(docs)} chunks -> {len(candidates)} merged/unique -> '
+          f'{len(packed)} packed, {used} of {budget} tokens')
+    return packed
+
+
+class PackingRetriever(BaseRetriever):
+    """ Wraps a retriever so the documents it returns fit the LLM context window """
+    base: BaseRetriever
+    llm: Any
+    prompt: Any
+    budget: Optional[int] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        docs = self.base.get_relevant_documents(query, callbacks=run_manager.get_child())
+        return self._pack(query, docs)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        docs = await self.base.aget_relevant_documents(query, callbacks=run_manager.get_child())
+        return await run_in_executor(self._pack, query, docs)
+
+    def _pack(self, query, docs):
+        with span('pack', chunks=len(docs)):
+            budget = self.budget or context_budget(self.llm, self.prompt, query)
+            return pack_documents(docs, self.llm.get_num_tokens, budget)
@@ -0,0 +1,60 @@
+'''
+===========================================
+        Module: Resource usage helpers
+===========================================
+'''
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB """
+    if resource is None:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT / 2**20
+
+
+def peak_child_rss_mb():
+    """ Peak RSS of the largest terminated child process (e.g. pool workers) in MB """
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * _RSS_UNIT / 2**20
+
+
+class RssSampler:
+    """ Samples this process's current RSS on a background thread; peak_mb is the highest seen
+        while the block ran, unlike peak_rss_mb which never goes down """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stop = None
+        self._thread = None
+
+    def _sample(self):
+        import psutil
+        process = psutil.Process()
+        while True:
+            self.peak_mb = max(self.peak_mb, process.memory_info().rss / 2**20)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        import threading
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='rss-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
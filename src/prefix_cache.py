@@ -0,0 +1,93 @@
+'''
+===========================================
+        Module: llama.cpp prompt prefix cache
+===========================================
+'''
+import os
+import threading
+
+import box
+import yaml
+from langchain.callbacks.base import BaseCallbackHandler
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+_stats_lock = threading.Lock()
+_stats = {'queries': 0, 'prefix_hits': 0, 'prompt_tokens': 0, 'prompt_tokens_saved': 0}
+
+
+def enable_prefix_cache(llm, mode=None):
+    """ Attach a llama.cpp KV state cache keyed on prompt tokens ('ram', 'disk', or 'off'/'' to disable).
+        Every scheduler worker owns an LLM and so its own cache: PREFIX_CACHE_MB is a cap per worker, and
+        one saved state of a 13B model at a 4096-token context is already a few GB """
+    mode = cfg.PREFIX_CACHE if mode is None else mode
+    if mode and mode != 'off':
+        from llama_cpp import LlamaDiskCache, LlamaRAMCache
+        capacity = int(cfg.PREFIX_CACHE_MB * 2**20)
+        print(f'Prefix cache: {mode}, up to {cfg.PREFIX_CACHE_MB} MB for this LLM instance; '
+              f'the server has one per worker (LLM_WORKERS: {cfg.LLM_WORKERS})')
+        if mode == 'disk':
+            os.makedirs(cfg.PREFIX_CACHE_DIR, exist_ok=True)
+            llm.client.set_cache(LlamaDiskCache(cache_dir=cfg.PREFIX_CACHE_DIR, capacity_bytes=capacity))
+        else:
+            llm.client.set_cache(LlamaRAMCache(capacity_bytes=capacity))
+    llm.callbacks = [*(llm.callbacks or []), PrefixCacheCallbackHandler(llm)]
+    return llm
+
+
+def common_prefix_length(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _evaluated_tokens(client):
+    """ Tokens whose KV state is currently loaded in the llama.cpp context """
+    if hasattr(client, 'n_tokens') and hasattr(client, 'input_ids'):
+        return list(client.input_ids[:client.n_tokens])
+    return list(getattr(client, 'eval_tokens', []))
+
+
+def _cached_prefixes(cache):
+    if cache is None:
+        return []
+    if hasattr(cache, 'cache_state'):
+        return list(cache.cache_state.keys())
+    return list(cache.cache.iterkeys())
+
+
+class PrefixCacheCallbackHandler(BaseCallbackHandler):
+    """ Reports how much of each prompt llama.cpp can reuse from the loaded or cached KV state """
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        client = self.llm.client
+        for prompt in prompts:
+            tokens = client.tokenize(prompt.encode('utf8'))
+            # llama.cpp always re-evaluates at least the last prompt token
+            candidates = [_evaluated_tokens(client), *_cached_prefixes(getattr(client, 'cache', None))]
+            reused = min(max((common_prefix_length(tokens, c) for c in candidates), default=0), len(tokens) - 1)
+            reused = max(reused, 0)
+            with _stats_lock:
+                _stats['queries'] += 1
+                _stats['prefix_hits'] += reused > 1
+                _stats['prompt_tokens'] += len(tokens)
+                _stats['prompt_tokens_saved'] += reused
+                hit_rate = _stats['prefix_hits'] / _stats['queries']
+            print(f'Prefix cache: reused {reused} of {len(tokens)} prompt tokens '
+                  f'({100 * reused / max(len(tokens), 1):.0f}%), hit rate {hit_rate:.0%}')
+
+
+def prefix_cache_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['hit_rate'] = round(stats['prefix_hits'] / max(stats['queries'], 1), 3)
+    stats['saved_fraction'] = round(stats['prompt_tokens_saved'] / max(stats['prompt_tokens'], 1), 3)
+    return stats
@@ -0,0 +1,253 @@
+'''
+===========================================
+        Module: On-demand profiling
+===========================================
+'''
+import contextvars
+import cProfile
+import functools
+import html
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import timeit
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+import box
+import yaml
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+PROFILE_MODES = ('cprofile', 'sample')
+# Raw output per mode: pstats dump (snakeviz, pstats) or collapsed stacks (flamegraph.pl, speedscope)
+PROFILE_SUFFIXES = {'cprofile': '.prof', 'sample': '.folded'}
+
+# Set in threads running work submitted by a request that asked for a profile
+_requested = contextvars.ContextVar('profile_requested', default=False)
+# Name of the profile running on this thread; nested profile() blocks join it
+_active = threading.local()
+_save_lock = threading.Lock()
+
+
+def _truthy(value):
+    return value is not None and str(value).strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+
+def request_flag():
+    """ True when the current web request asks for a profile: an X-Profile header, or profile=1 in the
+        query string of the request or of the page it came from (Dash callbacks are POSTs from the page) """
+    flask = sys.modules.get('flask')
+    if flask is None or not flask.has_request_context():
+        return False
+    request = flask.request
+    if _truthy(request.headers.get('X-Profile')) or _truthy(request.args.get('profile')):
+        return True
+    referrer = parse_qs(urlparse(request.referrer or '').query).get('profile')
+    return bool(referrer) and _truthy(referrer[-1])
+
+
+def profile_requested():
+    return cfg.PROFILE or _requested.get() or request_flag()
+
+
+def forward(fn):
+    """ fn to run on another thread (e.g. a scheduler worker), carrying this request's profile flag with it """
+    if not profile_requested():
+        return fn
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        token = _requested.set(True)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _requested.reset(token)
+    return run
+
+
+class StackSampler:
+    """ Samples one thread's Python stack on a background thread; counts are kept per collapsed stack """
+
+    def __init__(self, thread_id, interval=None):
+        self.thread_id = thread_id
+        self.interval = (interval or cfg.PROFILE_SAMPLE_MS) / 1000
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def enable(self):
+        self._thread = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def _cprofile_top(profiler, n):
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:n]
+    return [{'function': f'{func} ({os.path.basename(path)}:{line})', 'calls': calls,
+             'self_s': round(tottime, 4), 'cumulative_s': round(cumtime, 4)}
+            for (path, line, func), (_, calls, tottime, cumtime, _) in rows]
+
+
+def _sample_top(sampler, seconds, n):
+    per_sample = seconds / max(sampler.samples, 1)
+    own, inclusive = Counter(), Counter()
+    for stack, hits in sampler.stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += hits
+        for frame in set(frames):
+            inclusive[frame] += hits
+    return [{'function': frame, 'calls': None, 'self_s': round(hits * per_sample, 4),
+             'cumulative_s': round(inclusive[frame] * per_sample, 4)}
+            for frame, hits in own.most_common(n)]
+
+
+def _rotate(directory, keep):
+    summaries = sorted(f for f in os.listdir(directory) if f.endswith('.json'))
+    for fname in summaries[:max(len(summaries) - keep, 0)]:
+        stem = fname[:-len('.json')]
+        for suffix in ('.json', *PROFILE_SUFFIXES.values()):
+            path = os.path.join(directory, stem + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _save(name, mode, profiler, seconds, started):
+    directory = cfg.PROFILE_DIR
+    # Names sort by start time, which is the order rotation and listing rely on
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(started)) + f'.{int(started * 1000) % 1000:03d}'
+    stem = f'{stamp}-{name}-{uuid.uuid4().hex[:8]}'
+    data_file = stem + PROFILE_SUFFIXES[mode]
+    os.makedirs(directory, exist_ok=True)
+    if mode == 'cprofile':
+        profiler.dump_stats(os.path.join(directory, data_file))
+        top = _cprofile_top(profiler, cfg.PROFILE_TOP)
+    else:
+        with open(os.path.join(directory, data_file), 'w', encoding='utf8') as f:
+            f.writelines(f'{stack} {hits}\n' for stack, hits in profiler.stacks.most_common())
+        top = _sample_top(profiler, seconds, cfg.PROFILE_TOP)
+    summary = {'name': name, 'mode': mode, 'started': started, 'seconds': round(seconds, 3),
+               'file': data_file, 'top': top}
+    # The summary is written last: listing only shows profiles whose data file is complete
+    with _save_lock:
+        with open(os.path.join(directory, stem + '.json'), 'w', encoding='utf8') as f:
+            json.dump(summary, f)
+        _rotate(directory, cfg.PROFILE_KEEP)
+    print(f'Profile of {name} ({mode}, {seconds:.2f}s) written to {os.path.join(directory, data_file)}')
+
+
+@contextmanager
+def profile(name, force=False):
+    """ Profile the block when forced, PROFILE is on or the current request asks for it; otherwise
+        costs one flag check. Blocks nested inside a running profile on the same thread join it """
+    if not (force or profile_requested()) or getattr(_active, 'name', None):
+        yield
+        return
+    mode = cfg.PROFILE_MODE
+    if mode not in PROFILE_MODES:
+        raise ValueError(f'Unknown PROFILE_MODE {mode}; expected one of {PROFILE_MODES}')
+    profiler = cProfile.Profile() if mode == 'cprofile' else StackSampler(threading.get_ident())
+    try:
+        profiler.enable()
+    except ValueError as E:  # Python 3.12+ allows one cProfile at a time per process
+        print(f'Not profiling {name}: {E}')
+        profiler = None
+    if profiler is None:
+        yield
+        return
+    _active.name = name
+    started = time.time()
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _active.name = None
+        _save(name, mode, profiler, timeit.default_timer() - start, started)
+
+
+def profiled(name):
+    """ Decorator form of profile() for Dash callbacks """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with profile(name):
+                return fn(*args, **kwargs)
+        return run
+    return decorate
+
+
+def list_profiles(limit=None):
+    """ Summaries of the saved profiles, newest first """
+    directory = cfg.PROFILE_DIR
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for fname in sorted((f for f in os.listdir(directory) if f.endswith('.json')), reverse=True)[:limit]:
+        try:
+            with open(os.path.join(directory, fname), 'r', encoding='utf8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):  # rotated away or half-written
+            continue
+    return profiles
+
+
+def profile_path(fname):
+    """ Path of a saved profile's data file, or None for anything that is not one """
+    fname = os.path.basename(fname)
+    path = os.path.join(cfg.PROFILE_DIR, fname)
+    if os.path.splitext(fname)[1] not in PROFILE_SUFFIXES.values() or not os.path.exists(path):
+        return None
+    return path
+
+
+def render_profiles(profiles, link_prefix='/profiles/'):
+    """ A plain HTML page listing profiles with their top functions by self time """
+    parts = ['<!DOCTYPE html><html><head><meta charset="utf-8"><title>Profiles</title>',
+             '<style>body{font-family:sans-serif;margin:20px}table{border-collapse:collapse;margin:8px 0 24px}'
+             'td,th{border:1px solid #ccc;padding:2px 8px;font-size:13px}td.n{text-align:right}</style></head><body>',
+             f'<h2>Recent profiles ({len(profiles)})</h2>']
+    if not profiles:
+        parts.append('<p>None yet. Add ?profile=1 to the page URL, send an X-Profile: 1 header '
+                     'or set PROFILE: True in config/config.yml.</p>')
+    for p in profiles:
+        started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(p['started']))
+        parts.append(f'<h3>{html.escape(p["name"])} &middot; {started} &middot; {p["seconds"]:.3f}s '
+                     f'&middot; {p["mode"]} &middot; <a href="{link_prefix}{html.escape(p["file"])}">'
+                     f'{html.escape(p["file"])}</a></h3>')
+        parts.append('<table><tr><th>Function</th><th>Calls</th><th>Self s</th><th>Cumulative s</th></tr>')
+        for row in p['top']:
+            calls = '' if row['calls'] is None else row['calls']
+            parts.append(f'<tr><td>{html.escape(row["function"])}</td><td class="n">{calls}</td>'
+                         f'<td class="n">{row["self_s"]:.4f}</td><td class="n">{row["cumulative_s"]:.4f}</td></tr>')
+        parts.append('</table>')
+    parts.append('</body></html>')
+    return ''.join(parts)
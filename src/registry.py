@@ -0,0 +1,145 @@
+'''
+===========================================
+        Module: Model and index registry
+===========================================
+'''
+import os
+import threading
+from collections import OrderedDict
+
+import box
+import yaml
+from langchain.embeddings import HuggingFaceEmbeddings
+from src.build_cache import read_manifest
+from src.chunk_store import MAPPED_FILES, index_files, index_is_mapped, load_faiss
+from src.index_factory import apply_search_params, search_params
+from src.lexical import attach_lexical_index
+from src.rescore import enable_rescoring
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+_embeddings = {}
+_embeddings_lock = threading.Lock()
+
+_cross_encoders = {}
+
+# db_path -> (fingerprint, estimated bytes, vectorstore), least recently used first
+_vectorstores = OrderedDict()
+_vectorstores_lock = threading.Lock()
+
+_stats = {
+    'embedding_hits': 0,
+    'embedding_misses': 0,
+    'vectorstore_hits': 0,
+    'vectorstore_misses': 0,
+    'vectorstore_evictions': 0,
+    'vectorstore_invalidations': 0,
+}
+
+
+def get_embeddings(model_name=None, device=None):
+    """ One shared embedding model per (model name, device) for the whole process """
+    from src.env import device as default_device
+    key = (model_name or cfg.EMBEDDING_MODEL, device or default_device)
+    with _embeddings_lock:
+        embeddings = _embeddings.get(key)
+        if embeddings is not None:
+            _stats['embedding_hits'] += 1
+            return embeddings
+        _stats['embedding_misses'] += 1
+        print(f'Loading embedding model {key[0]} on {key[1]}')
+        embeddings = HuggingFaceEmbeddings(model_name=key[0],
+                                           model_kwargs={'device': key[1]})
+        _embeddings[key] = embeddings
+        return embeddings
+
+
+def get_cross_encoder(model_name=None):
+    """ One shared CPU cross-encoder per model name, loaded on first use """
+    model_name = model_name or cfg.RERANK_MODEL
+    with _embeddings_lock:
+        model = _cross_encoders.get(model_name)
+        if model is None:
+            from sentence_transformers import CrossEncoder
+            print(f'Loading cross-encoder {model_name} on cpu')
+            model = CrossEncoder(model_name, max_length=cfg.RERANK_MAX_LENGTH, device='cpu')
+            _cross_encoders[model_name] = model
+        return model
+
+
+def index_fingerprint(db_path):
+    """ (mtime, size) of every index file; changes whenever the index is rewritten """
+    fingerprint = []
+    for fname in index_files(db_path):
+        st = os.stat(os.path.join(db_path, fname))
+        fingerprint.append((fname, st.st_mtime_ns, st.st_size))
+    return tuple(fingerprint)
+
+
+def _budget_bytes():
+    return int(cfg.VECTORSTORE_CACHE_MB * 1024 * 1024)
+
+
+def _evict(needed):
+    total = sum(nbytes for _, nbytes, _ in _vectorstores.values())
+    while _vectorstores and total + needed > _budget_bytes():
+        db_path, (_, nbytes, _) = _vectorstores.popitem(last=False)
+        total -= nbytes
+        _stats['vectorstore_evictions'] += 1
+        print(f'Evicted vectorstore {db_path} from cache')
+
+
+def load_vectorstore(db_path, embeddings=None):
+    """ Load a FAISS vectorstore, reusing the cached copy while its files are unchanged """
+    embeddings = embeddings or get_embeddings()
+    key = os.path.normpath(db_path)
+    try:
+        fingerprint = index_fingerprint(db_path)
+    except FileNotFoundError:
+        invalidate(db_path)
+        raise
+    with _vectorstores_lock:
+        cached = _vectorstores.get(key)
+        if cached is not None:
+            if cached[0] == fingerprint:
+                _vectorstores.move_to_end(key)
+                _stats['vectorstore_hits'] += 1
+                return cached[2]
+            del _vectorstores[key]
+            _stats['vectorstore_invalidations'] += 1
+        _stats['vectorstore_misses'] += 1
+        vectorstore = load_faiss(db_path, embeddings)
+        mapped = MAPPED_FILES + (('index.faiss',) if index_is_mapped(vectorstore.index) else ())
+        index_config = read_manifest(db_path).get('index')
+        if index_config:
+            apply_search_params(vectorstore.index, dict(index_config, **search_params(index_config['type'])))
+        enable_rescoring(vectorstore, db_path)
+        attach_lexical_index(vectorstore, db_path)
+        # On-disk size is a reasonable estimate of the resident size of an index read into memory;
+        # chunk texts, and index codes where FAISS maps them, are only paged in as they are hit
+        nbytes = sum(size for fname, _, size in fingerprint if fname not in mapped)
+        _evict(nbytes)
+        _vectorstores[key] = (fingerprint, nbytes, vectorstore)
+        return vectorstore
+
+
+def invalidate(db_path=None):
+    """ Drop one cached vectorstore, or all of them when no path is given """
+    with _vectorstores_lock:
+        if db_path is None:
+            _stats['vectorstore_invalidations'] += len(_vectorstores)
+            _vectorstores.clear()
+        elif _vectorstores.pop(os.path.normpath(db_path), None) is not None:
+            _stats['vectorstore_invalidations'] += 1
+
+
+def cache_stats():
+    with _vectorstores_lock:
+        stats = dict(_stats)
+        stats['vectorstores_cached'] = len(_vectorstores)
+        stats['vectorstore_bytes'] = sum(nbytes for _, nbytes, _ in _vectorstores.values())
+    stats['embedding_models_cached'] = len(_embeddings)
+    stats['cross_encoders_cached'] = len(_cross_encoders)
+    return stats
@@ -0,0 +1,60 @@
+'''
+===========================================
+        Module: Cross-encoder re-ranking
+===========================================
+'''
+import timeit
+from typing import List, Optional
+
+import box
+import numpy as np
+import yaml
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+from src.registry import get_cross_encoder
+from src.tracing import run_in_executor, span
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+def rerank(query, docs, top_n, batch_size=None, budget_ms=None):
+    """ Top-n documents by cross-encoder score; keeps retrieval order if scoring runs over budget """
+    batch_size = batch_size or cfg.RERANK_BATCH_SIZE
+    budget_ms = budget_ms or cfg.RERANK_BUDGET_MS
+    if len(docs) <= 1:
+        return docs[:top_n]
+    model = get_cross_encoder()
+    pairs = [(query, doc.page_content) for doc in docs]
+    scores = np.empty(len(pairs), dtype=np.float32)
+    start = timeit.default_timer()
+    for i in range(0, len(pairs), batch_size):
+        scores[i:i + batch_size] = model.predict(pairs[i:i + batch_size], batch_size=batch_size,
+                                                 show_progress_bar=False)
+        elapsed_ms = 1000 * (timeit.default_timer() - start)
+        if elapsed_ms > budget_ms and i + batch_size < len(pairs):
+            print(f'Re-rank over budget ({elapsed_ms:.0f} ms > {budget_ms} ms); keeping vector order')
+            return docs[:top_n]
+    order = np.argsort(-scores, kind='stable')[:top_n]
+    print(f'Re-ranked {len(docs)} candidates in {elapsed_ms:.0f} ms; kept positions {order.tolist()}')
+    return [docs[i] for i in order]
+
+
+class RerankRetriever(BaseRetriever):
+    """ Fetches a wide candidate set from the base retriever and keeps the top_n by cross-encoder score """
+    base: BaseRetriever
+    top_n: int = 4
+    budget_ms: Optional[int] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        docs = self.base.get_relevant_documents(query, callbacks=run_manager.get_child())
+        return self._rerank(query, docs)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        docs = await self.base.aget_relevant_documents(query, callbacks=run_manager.get_child())
+        return await run_in_executor(self._rerank, query, docs)
+
+    def _rerank(self, query, docs):
+        with span('rerank', candidates=len(docs)):
+            return rerank(query, docs, self.top_n, budget_ms=self.budget_ms)
@@ -0,0 +1,97 @@
+'''
+===========================================
+        Module: Exact re-scoring of quantized indexes
+===========================================
+'''
+import os
+
+import box
+import numpy as np
+import yaml
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# Float32 copy of every vector in index order, next to an index whose codes are lossy
+SIDECAR_FILE = 'vectors.f32.npy'
+
+
+def needs_sidecar(config):
+    return config.get('storage', 'float32') != 'float32' or config.get('type') == 'ivf_pq'
+
+
+def write_vector_sidecar(db_path, vectors):
+    path = os.path.join(db_path, SIDECAR_FILE)
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+    os.replace(path + '.tmp', path)
+
+
+def remove_vector_sidecar(db_path):
+    path = os.path.join(db_path, SIDECAR_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def read_vector_sidecar(db_path):
+    """ The sidecar mapped read-only, or None when the index has none """
+    path = os.path.join(db_path, SIDECAR_FILE)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+def base_index(index):
+    """ The FAISS index itself, for code that needs FAISS types (search parameters, IVF extraction) """
+    return index.index if isinstance(index, RescoringIndex) else index
+
+
+class RescoringIndex:
+    """ Searches a quantized index for factor * k candidates, then orders them by exact L2 distance
+        against the float32 sidecar. Everything else is delegated to the wrapped index """
+
+    def __init__(self, index, vectors, factor=None):
+        self.index = index
+        self.vectors = vectors
+        self.factor = factor or cfg.RESCORE_FACTOR
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def search(self, x, k, params=None):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        fetch = min(max(k * self.factor, k), self.index.ntotal) or k
+        if params is None:
+            _, candidates = self.index.search(x, fetch)
+        else:
+            _, candidates = self.index.search(x, fetch, params=params)
+        found = candidates != -1
+        # Gather in ascending position order, which keeps reads from the mapped sidecar sequential
+        rows = np.unique(candidates[found])
+        exact = np.full(candidates.shape, np.inf, dtype=np.float32)
+        if len(rows):
+            stored = np.asarray(self.vectors[rows], dtype=np.float32)
+            where = np.searchsorted(rows, candidates[found])
+            query_rows = np.nonzero(found)[0]
+            diff = stored[where] - x[query_rows]
+            exact[found] = np.einsum('ij,ij->i', diff, diff)
+        order = np.argsort(exact, axis=1, kind='stable')[:, :k]
+        distances = np.take_along_axis(exact, order, axis=1)
+        positions = np.take_along_axis(candidates, order, axis=1)
+        positions[~np.isfinite(distances)] = -1
+        if k > fetch:
+            pad = k - fetch
+            distances = np.pad(distances, ((0, 0), (0, pad)), constant_values=np.inf)
+            positions = np.pad(positions, ((0, 0), (0, pad)), constant_values=-1)
+        return distances, positions
+
+
+def enable_rescoring(vectorstore, db_path):
+    """ Wrap the vectorstore's index when RESCORE is on and the index has a sidecar """
+    if not cfg.RESCORE:
+        return vectorstore
+    vectors = read_vector_sidecar(db_path)
+    if vectors is not None and len(vectors) == vectorstore.index.ntotal:
+        vectorstore.index = RescoringIndex(vectorstore.index, vectors)
+    return vectorstore
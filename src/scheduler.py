@@ -0,0 +1,150 @@
+'''
+===========================================
+        Module: LLM query scheduler
+===========================================
+'''
+import queue
+import threading
+import timeit
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import box
+import numpy as np
+import yaml
+from src.tracing import record
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+
+class QueueFull(Exception):
+    """ Raised by submit when the request queue is at capacity """
+
+
+class QueryTimeout(Exception):
+    """ Raised inside a worker when a request runs past its deadline """
+
+
+class Job:
+    def __init__(self, fn, timeout):
+        self.fn = fn
+        self.timeout = timeout
+        self.submitted = timeit.default_timer()
+        self.deadline = self.submitted + timeout if timeout else None
+        self.future = Future()
+
+    def expired(self):
+        return self.future.cancelled() or (self.deadline is not None and timeit.default_timer() > self.deadline)
+
+
+class QueryScheduler:
+    """ Bounded request queue served by a fixed set of workers, each owning one LLM instance """
+
+    def __init__(self, llm_factory, workers=None, max_queue=None, timeout=None):
+        self.llm_factory = llm_factory
+        self.n_workers = workers or cfg.LLM_WORKERS
+        self.timeout = timeout or cfg.QUERY_TIMEOUT
+        self._queue = queue.Queue(maxsize=max_queue or cfg.QUERY_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._ready = 0
+        self._busy = 0
+        self._waits = deque(maxlen=1000)
+        self._runs = deque(maxlen=1000)
+        self._counts = {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0, 'timed_out': 0}
+        self.load_errors = []
+
+    def start(self):
+        for i in range(self.n_workers):
+            thread = threading.Thread(target=self._worker, name=f'llm-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def _worker(self):
+        from src.callbacks import DeadlineCallbackHandler
+        try:
+            llm = self.llm_factory()
+        except Exception as E:
+            print(f'{threading.current_thread().name} failed to load its LLM: {E}')
+            with self._lock:
+                self.load_errors.append(str(E))
+            return
+        with self._lock:
+            self._ready += 1
+        while True:
+            job = self._queue.get()
+            if job.expired() or not job.future.set_running_or_notify_cancel():
+                if not job.future.done():
+                    job.future.set_exception(QueryTimeout('Query timed out while waiting in the queue'))
+                self._count('timed_out')
+                continue
+            start = timeit.default_timer()
+            with self._lock:
+                self._busy += 1
+                self._waits.append(start - job.submitted)
+            record('queue_wait', start - job.submitted, job.submitted)
+            try:
+                job.future.set_result(job.fn(llm, [DeadlineCallbackHandler(job)]))
+                self._count('completed')
+            except QueryTimeout as E:
+                job.future.set_exception(E)
+                self._count('timed_out')
+            except Exception as E:
+                job.future.set_exception(E)
+                self._count('failed')
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self._runs.append(timeit.default_timer() - start)
+
+    def submit(self, fn, timeout=None):
+        """ Queue fn(llm, callbacks) for the next free worker; raises QueueFull instead of waiting """
+        job = Job(fn, timeout or self.timeout)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._count('rejected')
+            raise QueueFull(f'{self._queue.maxsize} queries already waiting; try again shortly')
+        self._count('submitted')
+        return job.future
+
+    def run(self, fn, timeout=None):
+        """ Submit and wait for the result, enforcing the per-request timeout """
+        timeout = timeout or self.timeout
+        future = self.submit(fn, timeout)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise QueryTimeout(f'Query exceeded its {timeout}s timeout')
+
+    def ready(self):
+        return self._ready == self.n_workers
+
+    def counts(self):
+        """ Monotonic request counts since start: submitted, rejected, completed, failed, timed_out """
+        with self._lock:
+            return dict(self._counts)
+
+    def metrics(self):
+        with self._lock:
+            waits = np.array(self._waits) if self._waits else np.zeros(1)
+            runs = np.array(self._runs) if self._runs else np.zeros(1)
+            return {'workers': self.n_workers,
+                    'workers_ready': self._ready,
+                    'workers_busy': self._busy,
+                    'queue_depth': self._queue.qsize(),
+                    'queue_capacity': self._queue.maxsize,
+                    **self._counts,
+                    'wait_mean_s': round(float(waits.mean()), 3),
+                    'wait_p95_s': round(float(np.percentile(waits, 95)), 3),
+                    'wait_max_s': round(float(waits.max()), 3),
+                    'run_mean_s': round(float(runs.mean()), 3),
+                    'run_p95_s': round(float(np.percentile(runs, 95)), 3)}
@@ -0,0 +1,77 @@
+'''
+===========================================
+        Module: Startup timing and warm-up
+===========================================
+'''
+import threading
+import timeit
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_start = timeit.default_timer()
+_last_mark = _start
+_lock = threading.Lock()
+_phases = OrderedDict()
+_components = OrderedDict()
+
+
+def mark(name):
+    """ Record a main-thread phase as the time since the previous mark (or process start) """
+    global _last_mark
+    now = timeit.default_timer()
+    with _lock:
+        elapsed = now - _last_mark
+        _phases[name] = round(elapsed, 3)
+        _last_mark = now
+    print(f'Startup: {name} took {elapsed:.2f}s')
+
+
+@contextmanager
+def phase(name):
+    """ Record the duration of a phase that may run on any thread """
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        elapsed = timeit.default_timer() - start
+        with _lock:
+            _phases[name] = round(elapsed, 3)
+        print(f'Startup: {name} took {elapsed:.2f}s')
+
+
+def set_component(name, state):
+    with _lock:
+        _components[name] = state
+
+
+def warm_up(steps):
+    """ Run (name, fn) steps in order on a daemon thread, tracking each as a component """
+    for name, _ in steps:
+        set_component(name, 'pending')
+
+    def run():
+        for name, fn in steps:
+            set_component(name, 'loading')
+            try:
+                with phase(name):
+                    fn()
+                set_component(name, 'ready')
+            except Exception as E:
+                print(f'Warm-up of {name} failed: {E}')
+                set_component(name, f'failed: {E}')
+
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def startup_report():
+    with _lock:
+        return {'uptime_s': round(timeit.default_timer() - _start, 1),
+                'phases': dict(_phases),
+                'components': dict(_components)}
+
+
+def components_ready():
+    with _lock:
+        return all(state == 'ready' for state in _components.values())
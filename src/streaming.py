@@ -0,0 +1,122 @@
+'''
+===========================================
+        Module: Streaming answers
+===========================================
+'''
+import json
+import threading
+import timeit
+import uuid
+
+import box
+import yaml
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+
+
+class StreamBuffer:
+    """ Tokens, citations and timings of one in-flight answer, shared with the UI """
+
+    def __init__(self, qstring):
+        self.id = uuid.uuid4().hex
+        self.query = qstring
+        self.tokens = []
+        self.source_documents = None
+        self.done = False
+        self.error = None
+        self.start = timeit.default_timer()
+        self.retrieval_time = None
+        self.first_token_time = None
+        self.total_time = None
+        self.finished_at = None
+        self.cached = False
+        self._cond = threading.Condition()
+
+    def _elapsed(self):
+        return round(timeit.default_timer() - self.start, 2)
+
+    def set_sources(self, docs):
+        with self._cond:
+            self.source_documents = docs
+            self.retrieval_time = self._elapsed()
+            self._cond.notify_all()
+
+    def append(self, token):
+        with self._cond:
+            if self.first_token_time is None:
+                self.first_token_time = self._elapsed()
+            self.tokens.append(token)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.error = error
+            self.done = True
+            self.total_time = self._elapsed()
+            self.finished_at = timeit.default_timer()
+            self._cond.notify_all()
+
+    def wait(self, n_tokens, has_sources, timeout):
+        """ Block until there are more than n_tokens tokens, sources arrived, or the answer is done """
+        with self._cond:
+            self._cond.wait_for(lambda: (self.done or len(self.tokens) > n_tokens
+                                         or (self.source_documents is not None) != has_sources), timeout)
+
+    def response(self):
+        """ Same shape as the response of src.llm.query, plus streaming state and timings """
+        with self._cond:
+            elapsed = self.total_time if self.done else self._elapsed()
+            return {'query': self.query,
+                    'result': ''.join(self.tokens),
+                    'source_documents': self.source_documents or [],
+                    'retrieval_time': self.retrieval_time,
+                    'ttft': self.first_token_time,
+                    'time': f'{elapsed} (cached)' if self.cached else elapsed,
+                    'done': self.done,
+                    'error': self.error}
+
+
+def new_buffer(qstring):
+    buffer = StreamBuffer(qstring)
+    now = timeit.default_timer()
+    with _buffers_lock:
+        for stream_id in [i for i, b in _buffers.items()
+                          if b.done and now - b.finished_at > cfg.STREAM_BUFFER_TTL]:
+            del _buffers[stream_id]
+        _buffers[buffer.id] = buffer
+    return buffer
+
+
+def get_buffer(stream_id):
+    with _buffers_lock:
+        return _buffers.get(stream_id)
+
+
+def sse_events(buffer, heartbeat=15):
+    """ Server-sent events for one answer: citations once retrieval finishes, then tokens, then timings """
+    sent_sources = False
+    n_tokens = 0
+    while True:
+        buffer.wait(n_tokens, sent_sources, heartbeat)
+        response = buffer.response()
+        new_sources = not sent_sources and buffer.source_documents is not None
+        if new_sources:
+            sources = [{'page': doc.metadata.get('page'), 'source': doc.metadata.get('source'),
+                        'content': doc.page_content} for doc in response['source_documents']]
+            yield f'event: sources\ndata: {json.dumps(sources)}\n\n'
+            sent_sources = True
+        tokens = buffer.tokens[n_tokens:]
+        for token in tokens:
+            yield f'event: token\ndata: {json.dumps(token)}\n\n'
+        n_tokens += len(tokens)
+        if response['done']:
+            timings = {k: response[k] for k in ('retrieval_time', 'ttft', 'time', 'error')}
+            yield f'event: done\ndata: {json.dumps(timings)}\n\n'
+            return
+        if not tokens and not new_sources:
+            yield ': keep-alive\n\n'
@@ -0,0 +1,247 @@
+'''
+===========================================
+        Module: Tracing and Prometheus metrics
+===========================================
+'''
+import asyncio
+import bisect
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import timeit
+import uuid
+from contextlib import contextmanager
+
+import box
+import yaml
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# Standard library only: the web process imports this before langchain or numpy
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 100, 200)
+
+HELP = {
+    'docqa_stage_seconds': ('histogram', 'Time spent in each pipeline stage'),
+    'docqa_generation_tokens_per_second': ('histogram', 'Decoding speed of each LLM call after the first token'),
+    'docqa_tokens_total': ('counter', 'Prompt and completion tokens processed by the LLM'),
+    'docqa_cache_requests_total': ('counter', 'Cache lookups by cache and result'),
+    'docqa_cache_hit_ratio': ('gauge', 'Share of lookups served from each cache'),
+}
+
+_lock = threading.Lock()
+_log_lock = threading.Lock()
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Histogram:
+    """ Cumulative-bucket histogram per label value, in the Prometheus layout """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, label, value):
+        counts, total = self.series.get(label, ([0] * (len(self.buckets) + 1), [0.0]))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+        self.series[label] = (counts, total)
+
+
+_histograms = {'docqa_stage_seconds': Histogram(SECONDS_BUCKETS),
+               'docqa_generation_tokens_per_second': Histogram(RATE_BUCKETS)}
+# (metric name, sorted label items) -> value
+_counters = {}
+
+
+class Trace:
+    """ The spans of one request or job, written as a JSON line when TRACE_LOG is on """
+
+    def __init__(self, kind, attrs):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.attrs = attrs
+        self.started = time.time()
+        self.start = timeit.default_timer()
+        self.spans = []
+        self.stack = []
+
+    def to_dict(self):
+        return {'trace_id': self.id,
+                'kind': self.kind,
+                'started': self.started,
+                'duration_ms': round(1000 * (timeit.default_timer() - self.start), 3),
+                'attrs': self.attrs,
+                'spans': self.spans}
+
+
+def record(stage, seconds, start=None, **attrs):
+    """ Add a timed stage to the stage histogram and, inside a trace, to its span list.
+        start is a timeit.default_timer() value; without one the span is taken to end now """
+    if not cfg.TRACING:
+        return
+    with _lock:
+        _histograms['docqa_stage_seconds'].observe(stage, seconds)
+    current = _current.get()
+    if current is not None:
+        start = start if start is not None else timeit.default_timer() - seconds
+        current.spans.append({'stage': stage,
+                              'parent': current.stack[-1] if current.stack else None,
+                              'offset_ms': round(1000 * (start - current.start), 3),
+                              'duration_ms': round(1000 * seconds, 3),
+                              **attrs})
+
+
+@contextmanager
+def span(stage, **attrs):
+    """ Time the block as one stage; attributes added to the yielded dict end up on the span """
+    current = _current.get()
+    if current is not None:
+        current.stack.append(stage)
+    start = timeit.default_timer()
+    try:
+        yield attrs
+    finally:
+        if current is not None:
+            current.stack.pop()
+        record(stage, timeit.default_timer() - start, start, **attrs)
+
+
+def count(name, value=1, **labels):
+    if not cfg.TRACING:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, label=''):
+    if not cfg.TRACING:
+        return
+    with _lock:
+        _histograms[name].observe(label, value)
+
+
+def _write_trace(current):
+    path = cfg.TRACE_LOG_PATH
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    line = json.dumps(current.to_dict(), default=str)
+    with _log_lock, open(path, 'a', encoding='utf8') as f:
+        f.write(line + '\n')
+
+
+@contextmanager
+def trace(kind, **attrs):
+    """ Collect the spans recorded on this thread (or context) until the block ends.
+        Nested calls join the outer trace """
+    if _current.get() is not None:
+        yield _current.get()
+        return
+    current = Trace(kind, attrs)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        if cfg.TRACING and cfg.TRACE_LOG:
+            _write_trace(current)
+
+
+def current_trace():
+    return _current.get()
+
+
+async def run_in_executor(fn, *args, **kwargs):
+    """ Await blocking fn on the default executor, in a copy of this context so its spans join the current trace """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, fn, *args, **kwargs))
+
+
+def cache_stats():
+    """ {cache: (hits, misses)} of the caches already loaded in this process; nothing is imported here """
+    stats = {}
+    registry = sys.modules.get('src.registry')
+    if registry is not None:
+        registry_stats = registry.cache_stats()
+        stats['embedding_model'] = (registry_stats['embedding_hits'], registry_stats['embedding_misses'])
+        stats['vectorstore'] = (registry_stats['vectorstore_hits'], registry_stats['vectorstore_misses'])
+    answer_cache = sys.modules.get('src.answer_cache')
+    if answer_cache is not None and answer_cache._answer_cache is not None:
+        answer_stats = answer_cache._answer_cache.stats
+        stats['answer'] = (answer_stats['exact_hits'] + answer_stats['similar_hits'], answer_stats['misses'])
+    prefix_cache = sys.modules.get('src.prefix_cache')
+    if prefix_cache is not None:
+        prefix_stats = prefix_cache.prefix_cache_stats()
+        stats['llm_prefix'] = (prefix_stats['prefix_hits'], prefix_stats['queries'] - prefix_stats['prefix_hits'])
+    return stats
+
+
+def _labels(items):
+    if not items:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metrics(gauges=None, counters=None):
+    """ Everything recorded so far in the Prometheus text exposition format (version 0.0.4).
+        gauges: extra {name: (help, value)} sampled by the caller, e.g. scheduler queue depth;
+        counters: the same for monotonic counts, whose names end in _total """
+    lines = []
+
+    def header(name):
+        kind, text = HELP[name]
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    with _lock:
+        histograms = {name: {label: (list(counts), total[0]) for label, (counts, total) in h.series.items()}
+                      for name, h in _histograms.items()}
+        buckets = {name: h.buckets for name, h in _histograms.items()}
+        recorded = dict(_counters)
+
+    for name, series in histograms.items():
+        header(name)
+        label_name = 'stage' if name == 'docqa_stage_seconds' else None
+        for label, (counts, total) in sorted(series.items()):
+            base = [(label_name, label)] if label_name else []
+            cumulative = 0
+            for bound, n in zip((*buckets[name], '+Inf'), counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{_labels(base + [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_labels(base)} {_number(total)}')
+            lines.append(f'{name}_count{_labels(base)} {cumulative}')
+
+    for name in sorted({name for name, _ in recorded}):
+        if name in HELP:
+            header(name)
+        for (_, items), value in sorted((k, v) for k, v in recorded.items() if k[0] == name):
+            lines.append(f'{name}{_labels(items)} {_number(value)}')
+
+    caches = cache_stats()
+    if caches:
+        header('docqa_cache_requests_total')
+        for cache, (hits, misses) in caches.items():
+            lines.append(f'docqa_cache_requests_total{_labels([("cache", cache), ("result", "hit")])} {hits}')
+            lines.append(f'docqa_cache_requests_total{_labels([("cache", cache), ("result", "miss")])} {misses}')
+        header('docqa_cache_hit_ratio')
+        for cache, (hits, misses) in caches.items():
+            lines.append(f'docqa_cache_hit_ratio{_labels([("cache", cache)])} {_number(hits / max(hits + misses, 1))}')
+
+    for kind, sampled in (('counter', counters), ('gauge', gauges)):
+        for name, (text, value) in (sampled or {}).items():
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {_number(value)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,149 @@
+'''
+===========================================
+        Module: Streaming uploads
+===========================================
+'''
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+import timeit
+import uuid
+
+import box
+import yaml
+from src.tracing import record
+
+# Import config vars
+with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
+    cfg = box.Box(yaml.safe_load(ymlfile))
+
+# filename -> {sha256, size, mtime} of every stored upload. It and the partial uploads live under
+# UPLOAD_STATE_PATH, not next to the uploads, which Dash serves publicly from assets/
+UPLOAD_INDEX = 'index.json'
+# Earlier {sha256: filename} index kept in the upload directory itself
+LEGACY_INDEX = '.uploads.json'
+
+_lock = threading.Lock()
+
+
+class UploadTooLarge(Exception):
+    """ Raised while streaming once an upload passes the size limit """
+
+
+def max_upload_bytes():
+    return int(cfg.UPLOAD_MAX_MB * 2**20)
+
+
+def _state_dir(dest_dir):
+    """ Private directory for the index and partial uploads of one upload directory """
+    key = hashlib.sha256(os.path.abspath(dest_dir).encode('utf8')).hexdigest()[:16]
+    return os.path.join(cfg.UPLOAD_STATE_PATH, key)
+
+
+def _read_index(dest_dir):
+    try:
+        with open(os.path.join(_state_dir(dest_dir), UPLOAD_INDEX), 'r', encoding='utf8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+    try:
+        with open(os.path.join(dest_dir, LEGACY_INDEX), 'r', encoding='utf8') as f:
+            index = {name: {'sha256': digest} for digest, name in json.load(f).items()}
+    except (FileNotFoundError, ValueError):
+        return {}
+    # Moved out of the served directory as soon as it is seen
+    _write_index(dest_dir, index)
+    return index
+
+
+def _write_index(dest_dir, index):
+    os.makedirs(_state_dir(dest_dir), exist_ok=True)
+    path = os.path.join(_state_dir(dest_dir), UPLOAD_INDEX)
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(index, f, indent=2)
+    os.replace(path + '.tmp', path)
+    legacy = os.path.join(dest_dir, LEGACY_INDEX)
+    if os.path.exists(legacy):
+        os.remove(legacy)
+
+
+def upload_record(filename, dest_dir):
+    """ {sha256, size, mtime} of a stored upload as recorded when it was written, or None """
+    with _lock:
+        return _read_index(dest_dir).get(os.path.basename(filename))
+
+
+def stream_chunks(stream, chunk_size=None):
+    chunk_size = chunk_size or cfg.UPLOAD_CHUNK_KB * 1024
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def data_url_chunks(contents, chunk_size=None):
+    """ Decode a base64 data URL (as sent by dcc.Upload) a slice at a time """
+    # Slices must be a multiple of 4 characters to decode independently
+    chunk_chars = (chunk_size or cfg.UPLOAD_CHUNK_KB * 1024) // 3 * 4
+    for i in range(contents.index(',') + 1, len(contents), chunk_chars):
+        yield base64.b64decode(contents[i:i + chunk_chars])
+
+
+def store_upload(chunks, filename, dest_dir, max_bytes=None):
+    """ Write byte chunks to dest_dir/filename, hashing them on the way. Content already stored under
+        another name is not written twice; the returned filename is then that of the stored copy """
+    filename = os.path.basename(filename)
+    max_bytes = max_bytes or max_upload_bytes()
+    start = timeit.default_timer()
+    os.makedirs(dest_dir, exist_ok=True)
+    os.makedirs(_state_dir(dest_dir), exist_ok=True)
+    tmp_path = os.path.join(_state_dir(dest_dir), f'{uuid.uuid4().hex}.part')
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f'{filename} exceeds the {max_bytes / 2**20:.0f} MB upload limit')
+                sha.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    digest = sha.hexdigest()
+
+    with _lock:
+        index = _read_index(dest_dir)
+        existing = next((name for name, stored in index.items()
+                         if stored['sha256'] == digest and os.path.exists(os.path.join(dest_dir, name))), None)
+        duplicate = existing is not None
+        replaced = False
+        if duplicate:
+            os.remove(tmp_path)
+            filename = existing
+        else:
+            path = os.path.join(dest_dir, filename)
+            replaced = os.path.exists(path)
+            # A rename when cache/ and the upload directory share a filesystem, a copy otherwise
+            shutil.move(tmp_path, path)
+            st = os.stat(path)
+            index[filename] = {'sha256': digest, 'size': st.st_size, 'mtime': st.st_mtime_ns}
+            _write_index(dest_dir, index)
+        file_record = dict(index[filename])
+
+    elapsed = timeit.default_timer() - start
+    record('upload', elapsed, start, bytes=size, duplicate=duplicate)
+    print(f'Stored upload {filename}: {size / 2**20:.1f} MB in {elapsed:.2f}s'
+          + (' (identical to an earlier upload, not stored again)' if duplicate else ''))
+    return {'filename': filename,
+            'sha256': digest,
+            'bytes': size,
+            'file_record': file_record,
+            'duplicate': duplicate,
+            'replaced': replaced,
+            'seconds': round(elapsed, 3)}
@@ -4,15 +4,20 @@
 ===========================================
 '''
 import box
+import numpy as np
 import yaml
 
-from src.env import device
 from langchain import PromptTemplate
 from langchain.chains import RetrievalQA
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.llms import LlamaCpp
-from langchain.vectorstores import FAISS
+from langchain.llms.base import BaseLLM
 from multipledispatch import dispatch
+from src.corpus import FilteredRetriever, filter_mask, search_vectors
+from src.hybrid import HybridRetriever, reciprocal_rank_fusion
+from src.lexical import lexical_index
+from src.packing import PackingRetriever
+from src.rerank import RerankRetriever
+from src.registry import get_embeddings, load_vectorstore
+from src.tracing import span
 
 # Import config vars
 with open('config/config.yml', 'r', encoding='utf8') as ymlfile:
@@ -32,22 +37,85 @@ def set_prompt():
     return prompt
 
 
-def build_retrieval_qa(llm, prompt, vectordb):
+def build_retriever(vectordb, sources=None, pages=None, k=None):
+    k = k or cfg.VECTOR_COUNT
+    if cfg.HYBRID_SEARCH and lexical_index(vectordb) is not None:
+        return HybridRetriever(vectorstore=vectordb, k=k, sources=sources, pages=pages)
+    # Also used unfiltered, so every search goes through corpus.search_vectors and is traced
+    return FilteredRetriever(vectorstore=vectordb, k=k, sources=sources, pages=pages)
+
+
+def build_retrieval_qa(llm, prompt, vectordb, sources=None, pages=None):
+    if cfg.RERANK:
+        retriever = RerankRetriever(base=build_retriever(vectordb, sources, pages, k=cfg.RERANK_CANDIDATES),
+                                    top_n=cfg.RERANK_TOP_N)
+    elif cfg.CONTEXT_PACKING:
+        retriever = build_retriever(vectordb, sources, pages, k=cfg.CONTEXT_FETCH_K)
+    else:
+        retriever = build_retriever(vectordb, sources, pages)
+    if cfg.CONTEXT_PACKING:
+        # Keep what fits the context window after merging and de-duplication
+        retriever = PackingRetriever(base=retriever, llm=llm, prompt=prompt)
     dbqa = RetrievalQA.from_chain_type(llm=llm,
                                        chain_type='stuff',
-                                       retriever=vectordb.as_retriever(search_kwargs={'k': cfg.VECTOR_COUNT}),
+                                       retriever=retriever,
                                        return_source_documents=cfg.RETURN_SOURCE_DOCUMENTS,
                                        chain_type_kwargs={'prompt': prompt}
                                        )
     return dbqa
 
-@dispatch(str, LlamaCpp)
-def setup_dbqa(db_faiss_path, llm):
-
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2",
-                                       model_kwargs={'device': device})
-    vectordb = FAISS.load_local(db_faiss_path, embeddings)
+@dispatch(str, BaseLLM)
+def setup_dbqa(db_faiss_path, llm, sources=None, pages=None):
+    """ sources/pages restrict retrieval to some documents or an inclusive 0-based page range """
+    vectordb = load_vectorstore(db_faiss_path)
     prompt = set_prompt()
-    dbqa = build_retrieval_qa(llm, prompt, vectordb)
+    dbqa = build_retrieval_qa(llm, prompt, vectordb, sources, pages)
+
+    return dbqa
+
+
+class RetrievalResults:
+    """ Top-k index positions and scores per question as (n, k) arrays, -1 padded.
+        Scores are FAISS distances, or fusion scores when the lexical leg was used """
+
+    def __init__(self, vectorstore, questions, positions, scores, fused=False):
+        self.vectorstore = vectorstore
+        self.questions = questions
+        self.positions = positions
+        self.scores = scores
+        self.fused = fused
+
+    def __len__(self):
+        return len(self.questions)
+
+    def documents(self, i):
+        ids = self.vectorstore.index_to_docstore_id
+        return [self.vectorstore.docstore.search(ids[p]) for p in self.positions[i] if p != -1]
+
+    def texts(self, i):
+        return [doc.page_content for doc in self.documents(i)]
+
+
+def retrieve_many(db_faiss_path, questions, k=None, sources=None, pages=None, hybrid=None):
+    """ Embed all questions in one batch and run a single FAISS search over the (n, d) query matrix """
+    k = k or cfg.VECTOR_COUNT
+    hybrid = cfg.HYBRID_SEARCH if hybrid is None else hybrid
+    vectordb = load_vectorstore(db_faiss_path)
+    with span('embed_query', questions=len(questions)):
+        vectors = np.asarray(get_embeddings().embed_documents(list(questions)), dtype=np.float32)
+    mask = filter_mask(vectordb, sources, pages)
+    lexical = lexical_index(vectordb) if hybrid else None
+    fetch_k = max(cfg.HYBRID_FETCH_K, k) if lexical is not None else k
+    distances, positions = search_vectors(vectordb, vectors, fetch_k, mask)
+    if lexical is None:
+        return RetrievalResults(vectordb, questions, positions, distances)
 
-    return dbqa
\ No newline at end of file
+    fused_positions = np.full((len(questions), k), -1, dtype=np.int64)
+    fused_scores = np.zeros((len(questions), k), dtype=np.float32)
+    for i, question in enumerate(questions):
+        with span('lexical_search', k=fetch_k):
+            sparse, _ = lexical.search(question, fetch_k, mask)
+        top, scores = reciprocal_rank_fusion([positions[i][positions[i] != -1], sparse], k)
+        fused_positions[i, :len(top)] = top
+        fused_scores[i, :len(top)] = scores
+    return RetrievalResults(vectordb, questions, fused_positions, fused_scores, fused=True)
@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pytest
+from langchain.schema import Document
+
+# Modules read config/config.yml relative to the working directory at import time
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+DIM = 32
+
+
+def fake_vector(text):
+    """ Deterministic unit vector per text, so equal texts embed identically """
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class FakeModel:
+    def get_sentence_embedding_dimension(self):
+        return DIM
+
+
+class FakeEmbeddings:
+    client = FakeModel()
+
+    def embed_query(self, text):
+        return fake_vector(text).tolist()
+
+    def embed_documents(self, texts):
+        return [fake_vector(text).tolist() for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def fake_embeddings(monkeypatch, tmp_path):
+    """ Hash-derived embeddings in place of the sentence-transformers model, with caches under tmp_path """
+    import src.answer_cache, src.build_cache, src.corpus, src.embedding, src.registry, src.utils
+    embeddings = FakeEmbeddings()
+    for module in (src.registry, src.embedding, src.corpus, src.utils, src.answer_cache):
+        monkeypatch.setattr(module, 'get_embeddings', lambda *args, **kwargs: embeddings)
+    monkeypatch.setattr(src.embedding, '_encode', lambda model, texts, batch_size: np.stack([fake_vector(t) for t in texts]))
+    monkeypatch.setattr(src.embedding.cfg, 'EMBED_WORKERS', 1)
+    monkeypatch.setattr(src.build_cache.cfg, 'EMBEDDING_CACHE_PATH', str(tmp_path / 'embeddings.sqlite'))
+    return embeddings
+
+
+def chunk_texts(filename, n):
+    return [f'{filename} chunk {i} ' + 'lorem ipsum ' * (i % 5) for i in range(n)]
+
+
+@pytest.fixture
+def text_documents(tmp_path, monkeypatch):
+    """ (data_path, write) for documents that are text files; load_chunks returns one chunk per line,
+        ten lines to a page. write(filename, n) writes chunk_texts(filename, n) """
+    import src.db_build
+    data_path = tmp_path / 'data'
+    data_path.mkdir()
+
+    def load_chunks(path, glob, chunk_size=None, chunk_overlap=None, progress=None):
+        return [Document(page_content=line, metadata={'source': file.name, 'page': i // 10})
+                for file in sorted(data_path.glob(glob))
+                for i, line in enumerate(file.read_text().splitlines())]
+
+    def write(filename, n):
+        (data_path / filename).write_text('\n'.join(chunk_texts(filename, n)))
+
+    monkeypatch.setattr(src.db_build, 'load_chunks', load_chunks)
+    return data_path, write
+
+
+@pytest.fixture
+def indexed_documents(text_documents, tmp_path):
+    """ Loaded vectorstore over two 30-chunk text documents, a.txt and b.txt """
+    from src.db_build import run_db_build
+    from src.registry import load_vectorstore
+    data_path, write = text_documents
+    write('a.txt', 30)
+    write('b.txt', 30)
+    db_path = str(tmp_path / 'db')
+    run_db_build('*.txt', str(data_path), db_path)
+    return load_vectorstore(db_path)
+
+
+def assert_async_matches_sync(retriever, query):
+    expected = retriever.get_relevant_documents(query)
+    assert expected
+    result = asyncio.run(retriever.aget_relevant_documents(query))
+    assert [d.page_content for d in result] == [d.page_content for d in expected]
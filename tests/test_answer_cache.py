@@ -0,0 +1,60 @@
+import pickle
+from collections import OrderedDict
+
+from src.answer_cache import AnswerCache
+
+
+def response(text):
+    return {'result': text, 'source_documents': []}
+
+
+def test_exact_and_similar_hits(tmp_path):
+    cache = AnswerCache(path=str(tmp_path / 'answers.pkl'), max_entries=10, ttl=3600, threshold=0.95)
+    assert cache.lookup('ns', 'What is the fee?') is None
+    cache.put('ns', 'What is the fee?', response('10'))
+    assert cache.lookup('ns', '  what is the FEE? ')['result'] == '10'
+    assert cache.lookup('other', 'What is the fee?') is None
+    assert cache.stats == {'exact_hits': 1, 'similar_hits': 0, 'misses': 2}
+
+
+def test_miss_embedding_is_reused(tmp_path, fake_embeddings, monkeypatch):
+    cache = AnswerCache(path=str(tmp_path / 'answers.pkl'), max_entries=10, ttl=3600, threshold=0.95)
+    cache.put('ns', 'first question', response('1'))
+    calls = []
+    embed_query = fake_embeddings.embed_query
+    monkeypatch.setattr(fake_embeddings, 'embed_query', lambda text: calls.append(text) or embed_query(text))
+    assert cache.lookup('ns', 'second question') is None
+    cache.put('ns', 'second question', response('2'))
+    assert calls == ['second question']
+
+
+def test_log_replay_and_compaction(tmp_path):
+    path = str(tmp_path / 'answers.pkl')
+    cache = AnswerCache(path=path, max_entries=4, ttl=3600, threshold=0.95)
+    for i in range(20):
+        cache.put('ns', f'question {i}', response(str(i)))
+    assert cache._records <= 2 * 4 + 1
+    reloaded = AnswerCache(path=path, max_entries=4, ttl=3600, threshold=0.95)
+    assert [q for _, q in reloaded._entries] == [f'question {i}' for i in range(16, 20)]
+    assert reloaded.lookup('ns', 'question 19')['result'] == '19'
+
+
+def test_truncated_log_keeps_complete_records(tmp_path):
+    path = str(tmp_path / 'answers.pkl')
+    cache = AnswerCache(path=path, max_entries=10, ttl=3600, threshold=0.95)
+    cache.put('ns', 'kept', response('a'))
+    with open(path, 'ab') as f:
+        f.write(pickle.dumps((('ns', 'lost'), {}))[:-5])
+    reloaded = AnswerCache(path=path, max_entries=10, ttl=3600, threshold=0.95)
+    assert list(reloaded._entries) == [('ns', 'kept')]
+    reloaded.put('ns', 'after', response('b'))
+    assert list(AnswerCache(path=path, max_entries=10, ttl=3600, threshold=0.95)._entries) == [('ns', 'kept'), ('ns', 'after')]
+
+
+def test_reads_snapshot_format(tmp_path, fake_embeddings):
+    path = str(tmp_path / 'answers.pkl')
+    cache = AnswerCache(path=path, max_entries=10, ttl=3600, threshold=0.95)
+    cache.put('ns', 'old', response('x'))
+    with open(path, 'wb') as f:
+        pickle.dump(OrderedDict(cache._entries), f)
+    assert AnswerCache(path=path, max_entries=10, ttl=3600, threshold=0.95).lookup('ns', 'old')['result'] == 'x'
@@ -0,0 +1,57 @@
+import json
+
+import src.batch as batch
+from src.batch import completed_keys, record_key, run_batch
+from src.bench import FakeLLM
+from src.db_build import run_db_build
+from tests.conftest import chunk_texts
+
+
+def write_lines(path, records, tail=''):
+    path.write_text(''.join(json.dumps(r) + '\n' for r in records) + tail, encoding='utf8')
+
+
+def test_record_key():
+    assert record_key({'id': 7, 'doc': 'a.pdf', 'question': 'q'}) == '7'
+    assert record_key({'doc': 'a.pdf', 'question': 'q'}) == 'a.pdf\tq'
+    assert record_key({'question': 'q'}) == '\tq'
+
+
+def test_completed_keys_drops_partial_last_line(tmp_path):
+    output = tmp_path / 'answers.jsonl'
+    assert completed_keys(str(output)) == set()
+    write_lines(output, [{'id': 1, 'question': 'a'}, {'id': 2, 'question': 'b'}], tail='{"id": 3, "quest')
+    assert completed_keys(str(output)) == {'1', '2'}
+    # The partial line is cut off so the next append starts on a fresh line
+    assert output.read_text(encoding='utf8').endswith('"b"}\n')
+    assert completed_keys(str(output)) == {'1', '2'}
+
+
+def test_completed_keys_stops_at_invalid_line(tmp_path):
+    output = tmp_path / 'answers.jsonl'
+    write_lines(output, [{'id': 1, 'question': 'a'}], tail='not json\n' + json.dumps({'id': 2, 'question': 'b'}) + '\n')
+    assert completed_keys(str(output)) == {'1'}
+    assert [json.loads(line)['id'] for line in output.read_text(encoding='utf8').splitlines()] == [1]
+
+
+def test_run_batch_resumes(text_documents, tmp_path, monkeypatch):
+    data_path, write = text_documents
+    write('a.txt', 20)
+    db_path = str(tmp_path / 'db')
+    run_db_build('*.txt', str(data_path), db_path)
+    monkeypatch.setattr(batch, 'build_llm', lambda: FakeLLM(tokens=4))
+    questions = [{'id': i, 'doc': db_path, 'question': q} for i, q in enumerate(chunk_texts('a.txt', 20)[:4])]
+    # A repeated question is answered once
+    write_lines(tmp_path / 'questions.jsonl', questions + questions[:1])
+    output = tmp_path / 'answers.jsonl'
+
+    run_batch(str(tmp_path / 'questions.jsonl'), str(output))
+    first = output.read_text(encoding='utf8').splitlines()
+    assert [json.loads(line)['id'] for line in first] == [0, 1, 2, 3]
+
+    # Crash while writing the last answer: it is dropped and answered again
+    output.write_text('\n'.join(first[:3]) + '\n' + first[3][:10], encoding='utf8')
+    run_batch(str(tmp_path / 'questions.jsonl'), str(output))
+    answers = [json.loads(line) for line in output.read_text(encoding='utf8').splitlines()]
+    assert [(a['id'], a['result']) for a in answers] == [(a['id'], a['result']) for a in map(json.loads, first)]
+    assert all(a['sources'] for a in answers)
@@ -0,0 +1,118 @@
+import pickle
+
+import faiss
+import numpy as np
+import pytest
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema import Document
+from langchain.vectorstores import FAISS
+
+import src.registry as registry
+from src.chunk_store import (MAPPED_FILES, ChunkStore, PositionIds, chunk_columns, has_chunk_store, index_exists,
+                             index_files, index_is_mapped, load_faiss, save_faiss)
+
+
+def documents():
+    return [Document(page_content=f'chunk {i} é ✓' * (i % 3), metadata={'source': f'doc{i % 2}.pdf', 'page': i})
+            for i in range(7)]
+
+
+def vectorstore_of(docs):
+    index = faiss.IndexFlatL2(4)
+    index.add(np.random.default_rng(0).standard_normal((len(docs), 4)).astype(np.float32))
+    ids = [str(i) for i in range(len(docs))]
+    return FAISS(None, index, InMemoryDocstore(dict(zip(ids, docs))), dict(enumerate(ids)))
+
+
+def test_round_trip(tmp_path):
+    docs = documents()
+    save_faiss(vectorstore_of(docs), str(tmp_path))
+    assert has_chunk_store(str(tmp_path)) and index_exists(str(tmp_path))
+    vectorstore = load_faiss(str(tmp_path))
+    assert isinstance(vectorstore.docstore, ChunkStore)
+    assert [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in range(len(docs))] == docs
+    assert vectorstore.docstore.search('99') == 'ID 99 not found.'
+    sources, codes, pages = chunk_columns(vectorstore)
+    assert [sources[c] for c in codes] == [d.metadata['source'] for d in docs]
+    assert pages.tolist() == list(range(7))
+
+
+def test_empty_store(tmp_path):
+    save_faiss(vectorstore_of([]), str(tmp_path))
+    vectorstore = load_faiss(str(tmp_path))
+    assert len(vectorstore.docstore) == 0 and vectorstore.index.ntotal == 0
+
+
+def test_legacy_pickle_is_read_and_migrated(tmp_path):
+    docs = documents()
+    vectorstore = vectorstore_of(docs)
+    faiss.write_index(vectorstore.index, str(tmp_path / 'index.faiss'))
+    with open(tmp_path / 'index.pkl', 'wb') as f:
+        pickle.dump((vectorstore.docstore, vectorstore.index_to_docstore_id), f)
+    legacy = load_faiss(str(tmp_path))
+    assert not has_chunk_store(str(tmp_path)) and legacy.docstore.search('3') == docs[3]
+    save_faiss(load_faiss(str(tmp_path), use_mmap=False), str(tmp_path))
+    assert has_chunk_store(str(tmp_path)) and not (tmp_path / 'index.pkl').exists()
+    assert load_faiss(str(tmp_path)).docstore.search('3') == docs[3]
+
+
+def test_added_documents_survive_a_save(tmp_path):
+    docs = documents()
+    save_faiss(vectorstore_of(docs), str(tmp_path))
+    vectorstore = load_faiss(str(tmp_path), use_mmap=False)
+    extra = Document(page_content='added later', metadata={'source': 'doc9.pdf', 'page': 0})
+    vectorstore.add_embeddings([(extra.page_content, [0.0, 1.0, 0.0, 1.0])], metadatas=[extra.metadata])
+    assert not vectorstore.index_to_docstore_id.aligned() and chunk_columns(vectorstore) is None
+    save_faiss(vectorstore, str(tmp_path))
+    reloaded = load_faiss(str(tmp_path))
+    assert reloaded.docstore.search('7') == extra and reloaded.index_to_docstore_id.aligned()
+
+
+def test_position_ids_overlay():
+    ids = PositionIds(4)
+    assert list(ids) == [0, 1, 2, 3] and ids[2] == '2' and ids.aligned()
+    ids[5] = 'x'
+    ids[1] = 'y'
+    assert list(ids) == [0, 1, 2, 3, 5] and ids[1] == 'y' and len(ids) == 5 and not ids.aligned()
+    del ids[1]
+    del ids[2]
+    del ids[5]
+    assert list(ids) == [0, 3] and len(ids) == 2 and dict(ids) == {0: '0', 3: '3'}
+    with pytest.raises(KeyError):
+        ids[2]
+    with pytest.raises(KeyError):
+        del ids[2]
+    ids[2] = 'z'
+    assert list(ids) == [0, 2, 3] and ids[2] == 'z'
+
+
+def ivf_vectorstore_of(docs):
+    vectors = np.random.default_rng(0).standard_normal((len(docs), 4)).astype(np.float32)
+    index = faiss.IndexIVFFlat(faiss.IndexFlatL2(4), 4, 2)
+    index.train(vectors)
+    index.add(vectors)
+    ids = [str(i) for i in range(len(docs))]
+    return FAISS(None, index, InMemoryDocstore(dict(zip(ids, docs))), dict(enumerate(ids)))
+
+
+def test_ivf_lists_are_mapped(tmp_path):
+    save_faiss(ivf_vectorstore_of(documents()), str(tmp_path))
+    assert index_is_mapped(load_faiss(str(tmp_path), use_mmap=True).index)
+    assert not index_is_mapped(load_faiss(str(tmp_path), use_mmap=False).index)
+
+
+@pytest.mark.parametrize('layout', ['flat', 'ivf'])
+@pytest.mark.parametrize('use_mmap', [True, False])
+def test_cache_counts_only_resident_index_bytes(tmp_path, monkeypatch, layout, use_mmap):
+    monkeypatch.setattr(registry.cfg, 'INDEX_MMAP', use_mmap)
+    monkeypatch.setattr(registry, 'load_faiss', lambda *args: load_faiss(*args, use_mmap=use_mmap))
+    save_faiss((vectorstore_of if layout == 'flat' else ivf_vectorstore_of)(documents()), str(tmp_path))
+    registry.invalidate()
+    vectorstore = registry.load_vectorstore(str(tmp_path))
+    counted = registry.cache_stats()['vectorstore_bytes']
+    registry.invalidate()
+    other = sum((tmp_path / fname).stat().st_size for fname in index_files(str(tmp_path))
+                if fname not in MAPPED_FILES and fname != 'index.faiss')
+    index_bytes = (tmp_path / 'index.faiss').stat().st_size
+    assert counted == other + (0 if index_is_mapped(vectorstore.index) else index_bytes)
+    assert index_is_mapped(vectorstore.index) == (use_mmap and (layout == 'ivf' or hasattr(faiss, 'IO_FLAG_MMAP_IFC')))
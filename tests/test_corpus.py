@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+import src.corpus as corpus
+import src.db_build as db_build
+import src.index_factory as index_factory
+from src.chunk_store import load_faiss
+from tests.conftest import assert_async_matches_sync, chunk_texts
+
+INDEX_VARIANTS = [('flat', 'float32'), ('flat', 'int8'), ('flat', 'float16'), ('hnsw', 'float32'),
+                  ('hnsw', 'int8'), ('ivf_flat', 'float32'), ('ivf_flat', 'int8'), ('ivf_pq', 'float32')]
+
+
+@pytest.fixture
+def corpus_dir(tmp_path, monkeypatch, text_documents):
+    data_path, write = text_documents
+    monkeypatch.setattr(index_factory.cfg, 'IVF_NLIST', 4)
+    monkeypatch.setattr(index_factory.cfg, 'PQ_M', 8)
+    return data_path, str(tmp_path / 'corpus'), write
+
+
+def use_index(monkeypatch, index_type, storage):
+    monkeypatch.setattr(index_factory.cfg, 'INDEX_TYPE', index_type)
+    monkeypatch.setattr(index_factory.cfg, 'VECTOR_STORAGE', storage)
+
+
+def assert_consistent(corpus_path, expected):
+    """ Every index position maps to a chunk, and each expected text finds itself """
+    vectorstore = load_faiss(corpus_path, corpus.get_embeddings(), use_mmap=False)
+    assert vectorstore.index.ntotal == len(expected)
+    ids = vectorstore.index_to_docstore_id
+    stored = sorted(vectorstore.docstore.search(ids[i]).page_content for i in range(vectorstore.index.ntotal))
+    assert stored == sorted(expected)
+    for text in expected[:5]:
+        (doc, _), = corpus.filtered_search(vectorstore, text, 1)
+        assert doc.page_content == text
+
+
+@pytest.mark.parametrize('index_type,storage', INDEX_VARIANTS)
+def test_replace_only_document(corpus_dir, monkeypatch, index_type, storage):
+    data_path, corpus_path, write = corpus_dir
+    use_index(monkeypatch, index_type, storage)
+    write('a.txt', 50)
+    assert corpus.add_document('a.txt', str(data_path), corpus_path=corpus_path)
+    write('a.txt', 3)
+    assert corpus.add_document('a.txt', str(data_path), corpus_path=corpus_path)
+    assert_consistent(corpus_path, chunk_texts('a.txt', 3))
+
+
+@pytest.mark.parametrize('index_type,storage', INDEX_VARIANTS)
+def test_add_replace_remove(corpus_dir, monkeypatch, index_type, storage):
+    data_path, corpus_path, write = corpus_dir
+    use_index(monkeypatch, index_type, storage)
+    write('a.txt', 60)
+    write('b.txt', 40)
+    corpus.add_document('a.txt', str(data_path), corpus_path=corpus_path)
+    corpus.add_document('b.txt', str(data_path), corpus_path=corpus_path)
+    assert_consistent(corpus_path, chunk_texts('a.txt', 60) + chunk_texts('b.txt', 40))
+
+    write('a.txt', 20)
+    corpus.add_document('a.txt', str(data_path), corpus_path=corpus_path)
+    assert_consistent(corpus_path, chunk_texts('b.txt', 40) + chunk_texts('a.txt', 20))
+    assert set(corpus.corpus_documents(corpus_path)) == {'a.txt', 'b.txt'}
+
+    assert corpus.remove_document('b.txt', corpus_path=corpus_path) == 40
+    assert_consistent(corpus_path, chunk_texts('a.txt', 20))
+    assert corpus.remove_document('a.txt', corpus_path=corpus_path) == 20
+    assert not corpus.corpus_exists(corpus_path)
+
+
+def test_unchanged_document_is_skipped(corpus_dir):
+    data_path, corpus_path, write = corpus_dir
+    write('a.txt', 10)
+    assert corpus.add_document('a.txt', str(data_path), corpus_path=corpus_path)
+    assert not corpus.add_document('a.txt', str(data_path), corpus_path=corpus_path)
+
+
+@pytest.mark.parametrize('index_type,storage', [('flat', 'float32'), ('hnsw', 'int8'), ('ivf_flat', 'float32')])
+def test_corpus_without_manifest(corpus_dir, monkeypatch, index_type, storage):
+    data_path, corpus_path, write = corpus_dir
+    use_index(monkeypatch, index_type, storage)
+    write('a.txt', 30)
+    write('b.txt', 20)
+    write('c.txt', 10)
+    corpus.add_document('a.txt', str(data_path), corpus_path=corpus_path)
+    corpus.add_document('b.txt', str(data_path), corpus_path=corpus_path)
+    os.remove(os.path.join(corpus_path, 'manifest.json'))
+    # The index is rebuilt from its stored chunks instead of the add failing
+    assert corpus.add_document('c.txt', str(data_path), corpus_path=corpus_path)
+    assert_consistent(corpus_path, chunk_texts('a.txt', 30) + chunk_texts('b.txt', 20) + chunk_texts('c.txt', 10))
+    assert set(corpus.corpus_documents(corpus_path)) == {'a.txt', 'b.txt', 'c.txt'}
+
+    with open(os.path.join(corpus_path, 'manifest.json'), 'w', encoding='utf8') as f:
+        f.write('{"index": ')
+    assert corpus.remove_document('b.txt', corpus_path=corpus_path) == 20
+    assert_consistent(corpus_path, chunk_texts('a.txt', 30) + chunk_texts('c.txt', 10))
+    assert set(corpus.corpus_documents(corpus_path)) == {'a.txt', 'c.txt'}
+
+
+def test_filters(corpus_dir):
+    data_path, corpus_path, write = corpus_dir
+    write('a.txt', 30)
+    write('b.txt', 30)
+    corpus.add_document('a.txt', str(data_path), corpus_path=corpus_path)
+    corpus.add_document('b.txt', str(data_path), corpus_path=corpus_path)
+    vectorstore = load_faiss(corpus_path, corpus.get_embeddings())
+    query = chunk_texts('a.txt', 30)[25]
+    results = corpus.filtered_search(vectorstore, query, 10, sources=['b.txt'])
+    assert results and all(doc.metadata['source'] == 'b.txt' for doc, _ in results)
+    results = corpus.filtered_search(vectorstore, query, 30, sources=['a.txt'], pages=(1, 1))
+    assert {doc.metadata['page'] for doc, _ in results} == {1}
+    assert len(results) == 10
+    assert corpus.filtered_search(vectorstore, query, 5, sources=['missing.txt']) == []
+    mask = corpus.filter_mask(vectorstore, pages=(2, 2))
+    assert mask.sum() == 20 and np.all(corpus.chunk_metadata(vectorstore)['pages'][mask] == 2)
+
+
+@pytest.mark.parametrize('storage', ['float32', 'float16', 'int8'])
+def test_flat_removal_is_in_place(corpus_dir, monkeypatch, storage):
+    data_path, corpus_path, write = corpus_dir
+    use_index(monkeypatch, 'flat', storage)
+    write('a.txt', 20)
+    write('b.txt', 10)
+    corpus.add_document('a.txt', str(data_path), corpus_path=corpus_path)
+    corpus.add_document('b.txt', str(data_path), corpus_path=corpus_path)
+    monkeypatch.setattr(corpus, 'build_index', lambda *args, **kwargs: pytest.fail('flat removal rebuilt the index'))
+    assert corpus.remove_document('a.txt', corpus_path=corpus_path) == 20
+    assert_consistent(corpus_path, chunk_texts('b.txt', 10))
+
+
+def test_file_index_and_corpus_share_one_extraction(corpus_dir, monkeypatch, tmp_path):
+    data_path, corpus_path, write = corpus_dir
+    write('a.txt', 12)
+    calls = []
+    load_chunks = db_build.load_chunks
+    monkeypatch.setattr(db_build, 'load_chunks', lambda *args: calls.append(args) or load_chunks(*args))
+    load = db_build.chunk_loader(str(data_path), 'a.txt', 100, 10)
+    assert db_build.run_db_build('a.txt', str(data_path), str(tmp_path / 'a_db'), chunk_size=100, chunk_overlap=10, load=load)
+    assert corpus.add_document('a.txt', str(data_path), chunk_size=100, chunk_overlap=10, corpus_path=corpus_path, load=load)
+    assert len(calls) == 1
+    assert_consistent(corpus_path, chunk_texts('a.txt', 12))
+    # Both up to date: nothing is extracted
+    load = db_build.chunk_loader(str(data_path), 'a.txt', 100, 10)
+    assert not db_build.run_db_build('a.txt', str(data_path), str(tmp_path / 'a_db'), chunk_size=100, chunk_overlap=10, load=load)
+    assert not corpus.add_document('a.txt', str(data_path), chunk_size=100, chunk_overlap=10, corpus_path=corpus_path, load=load)
+    assert len(calls) == 1
+
+
+def test_concurrent_builds_of_one_index(corpus_dir, monkeypatch, tmp_path):
+    data_path, _, write = corpus_dir
+    write('a.txt', 12)
+    calls = []
+    load_chunks = db_build.load_chunks
+
+    def slow_load(*args):
+        calls.append(args)
+        time.sleep(0.2)
+        return load_chunks(*args)
+
+    monkeypatch.setattr(db_build, 'load_chunks', slow_load)
+    db_path = str(tmp_path / 'a_db')
+    built = []
+    threads = [threading.Thread(target=lambda: built.append(db_build.run_db_build('a.txt', str(data_path), db_path)))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The second build waits for the first, then finds its index current
+    assert sorted(built) == [False, True] and len(calls) == 1
+    assert load_faiss(db_path, corpus.get_embeddings()).index.ntotal == 12
+
+
+def test_filtered_retriever_async(indexed_documents):
+    retriever = corpus.FilteredRetriever(vectorstore=indexed_documents, k=8, sources=['a.txt'])
+    assert_async_matches_sync(retriever, chunk_texts('a.txt', 30)[4])
@@ -0,0 +1,58 @@
+import numpy as np
+
+from src.hybrid import HybridRetriever, reciprocal_rank_fusion
+from src.lexical import LexicalIndex, build_postings, lexical_current, tokenize, write_lexical_index
+from tests.conftest import assert_async_matches_sync, chunk_texts
+
+TEXTS = ['Revenue grew in note 12.3 of the annual report',
+         'The board approved the dividend',
+         'Revenue revenue revenue fell sharply',
+         'Cash flow from operating activities']
+
+
+def test_tokenize_keeps_compound_tokens():
+    assert tokenize("Note 12.3: AT&T's non-GAAP revenue") == ['note', '12.3', "at&t's", 'non-gaap', 'revenue']
+
+
+def test_postings_are_grouped_by_term():
+    vocab, offsets, docs, weights = build_postings(TEXTS)
+    revenue = vocab['revenue']
+    assert list(docs[offsets[revenue]:offsets[revenue + 1]]) == [0, 2]
+    assert len(offsets) == len(vocab) + 1 and offsets[-1] == len(docs) == len(weights)
+    assert (weights > 0).all()
+
+
+def test_search_orders_by_bm25(tmp_path):
+    write_lexical_index(str(tmp_path), TEXTS)
+    assert lexical_current(str(tmp_path))
+    positions, scores = LexicalIndex(str(tmp_path)).search('revenue report', 4)
+    # Document 0 matches both terms; document 2 repeats one
+    assert list(positions) == [0, 2]
+    assert scores[0] >= scores[1] > 0
+
+
+def test_search_mask_and_unknown_terms(tmp_path):
+    write_lexical_index(str(tmp_path), TEXTS)
+    index = LexicalIndex(str(tmp_path))
+    mask = np.array([False, True, True, True])
+    positions, _ = index.search('revenue report', 4, mask)
+    assert list(positions) == [2]
+    positions, scores = index.search('goodwill impairment', 4)
+    assert len(positions) == len(scores) == 0
+    positions, _ = index.search('dividend', 4, np.zeros(4, dtype=bool))
+    assert len(positions) == 0
+
+
+def test_reciprocal_rank_fusion():
+    positions, scores = reciprocal_rank_fusion([[3, 1, 2], [1, 4]], 3, rrf_k=60)
+    # 1 ranks high in both lists, so it beats 3, which tops only one
+    assert list(positions) == [1, 3, 4]
+    assert np.isclose(scores[0], 1 / 62 + 1 / 61)
+    assert np.all(np.diff(scores) <= 0)
+    positions, scores = reciprocal_rank_fusion([[], []], 3)
+    assert len(positions) == len(scores) == 0
+
+
+def test_hybrid_retriever_async(indexed_documents):
+    retriever = HybridRetriever(vectorstore=indexed_documents, k=8, pages=(0, 1))
+    assert_async_matches_sync(retriever, chunk_texts('a.txt', 30)[4])
@@ -0,0 +1,23 @@
+import pytest
+
+from src.scheduler import QueryScheduler, QueryTimeout
+from src.tracing import render_metrics
+
+
+def test_render_metrics_types():
+    text = render_metrics(gauges={'docqa_scheduler_queued': ('Queued', 2)},
+                          counters={'docqa_scheduler_requests_completed_total': ('Completed', 5)})
+    assert '# TYPE docqa_scheduler_requests_completed_total counter\ndocqa_scheduler_requests_completed_total 5' in text
+    assert '# TYPE docqa_scheduler_queued gauge\ndocqa_scheduler_queued 2' in text
+
+
+def test_scheduler_counts_timeouts():
+    def expire(llm, callbacks):
+        raise QueryTimeout('deadline passed mid-stream')
+
+    scheduler = QueryScheduler(object, workers=1, max_queue=4, timeout=5).start()
+    assert scheduler.run(lambda llm, callbacks: 'ok') == 'ok'
+    with pytest.raises(QueryTimeout):
+        scheduler.run(expire)
+    counts = scheduler.counts()
+    assert (counts['submitted'], counts['completed'], counts['timed_out']) == (2, 1, 1)
@@ -0,0 +1,39 @@
+from langchain.schema import Document
+
+from src.corpus import FilteredRetriever
+from src.packing import PackingRetriever, merge_overlapping, pack_documents
+from tests.conftest import assert_async_matches_sync, chunk_texts
+
+
+class WordCountLLM:
+    def get_num_tokens(self, text):
+        return len(text.split())
+
+
+def count_tokens(text):
+    return len(text.split())
+
+
+def test_pack_documents_fits_budget():
+    docs = [Document(page_content=f'word{i} ' * n, metadata={'source': 'a.pdf', 'page': i})
+            for i, n in enumerate([8, 6, 3])]
+    packed = pack_documents(docs, count_tokens, 12)
+    assert sum(count_tokens(d.page_content) for d in packed) <= 12
+    # Rank order is kept; a chunk that does not fit is skipped for smaller ones after it
+    assert [d.metadata['page'] for d in packed] == [0, 2]
+
+
+def test_overlapping_chunks_of_a_page_merge():
+    first = 'The quarterly revenue grew by four percent'
+    second = 'revenue grew by four percent on higher volumes'
+    docs = [Document(page_content=first, metadata={'source': 'a.pdf', 'page': 1}),
+            Document(page_content=second, metadata={'source': 'a.pdf', 'page': 1}),
+            Document(page_content=second, metadata={'source': 'a.pdf', 'page': 2})]
+    merged = merge_overlapping(docs)
+    assert [d.page_content for d in merged] == ['The quarterly revenue grew by four percent on higher volumes', second]
+
+
+def test_packing_retriever_async(indexed_documents):
+    base = FilteredRetriever(vectorstore=indexed_documents, k=8, sources=['a.txt'])
+    retriever = PackingRetriever(base=base, llm=WordCountLLM(), prompt=None, budget=30)
+    assert_async_matches_sync(retriever, chunk_texts('a.txt', 30)[4])
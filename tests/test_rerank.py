@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from langchain.schema import Document
+
+import src.rerank as rerank
+from src.corpus import FilteredRetriever
+from src.rerank import RerankRetriever
+from tests.conftest import assert_async_matches_sync, chunk_texts
+
+
+class LengthCrossEncoder:
+    """ Scores longer passages higher, so re-ranking visibly reorders the candidates """
+
+    def predict(self, pairs, batch_size=None, show_progress_bar=False):
+        return np.array([len(passage) for _, passage in pairs], dtype=np.float32)
+
+
+@pytest.fixture(autouse=True)
+def cross_encoder(monkeypatch):
+    monkeypatch.setattr(rerank, 'get_cross_encoder', lambda *args: LengthCrossEncoder())
+
+
+def test_rerank_orders_by_score():
+    docs = [Document(page_content='x' * n) for n in (3, 9, 1, 5)]
+    assert [len(d.page_content) for d in rerank.rerank('q', docs, 3, budget_ms=10000)] == [9, 5, 3]
+
+
+def test_rerank_over_budget_keeps_retrieval_order(monkeypatch):
+    ticks = iter(range(0, 100, 10))
+    monkeypatch.setattr(rerank.timeit, 'default_timer', lambda: next(ticks))
+    docs = [Document(page_content='x' * n) for n in (3, 9, 1, 5)]
+    result = rerank.rerank('q', docs, 3, batch_size=2, budget_ms=1)
+    assert [len(d.page_content) for d in result] == [3, 9, 1]
+
+
+def test_rerank_retriever_async(indexed_documents):
+    base = FilteredRetriever(vectorstore=indexed_documents, k=8, sources=['a.txt'])
+    retriever = RerankRetriever(base=base, top_n=3, budget_ms=10000)
+    assert_async_matches_sync(retriever, chunk_texts('a.txt', 30)[4])
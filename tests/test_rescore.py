@@ -0,0 +1,63 @@
+import faiss
+import numpy as np
+
+from src.rescore import RescoringIndex, base_index, needs_sidecar, read_vector_sidecar, write_vector_sidecar
+
+DIM = 16
+
+
+def quantized_index(vectors):
+    index = faiss.IndexScalarQuantizer(DIM, faiss.ScalarQuantizer.QT_4bit)
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def exact_top(vectors, queries, k):
+    distances = ((queries[:, None, :] - vectors[None, :, :]) ** 2).sum(-1)
+    return np.argsort(distances, axis=1, kind='stable')[:, :k]
+
+
+def test_rescoring_matches_exact_search():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((200, DIM)).astype(np.float32)
+    queries = rng.standard_normal((5, DIM)).astype(np.float32)
+    rescoring = RescoringIndex(quantized_index(vectors), vectors, factor=50)
+    distances, positions = rescoring.search(queries, 5)
+    # Fetching every vector as a candidate leaves only the exact ordering
+    assert (positions == exact_top(vectors, queries, 5)).all()
+    expected = ((vectors[positions] - queries[:, None, :]) ** 2).sum(-1)
+    assert np.allclose(distances, expected, rtol=1e-5)
+    assert (np.diff(distances, axis=1) >= 0).all()
+
+
+def test_rescoring_pads_beyond_ntotal():
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((3, DIM)).astype(np.float32)
+    rescoring = RescoringIndex(faiss.IndexFlatL2(DIM), vectors, factor=4)
+    rescoring.index.add(vectors)
+    distances, positions = rescoring.search(vectors[:1], 5)
+    assert positions.shape == distances.shape == (1, 5)
+    assert positions[0, 0] == 0
+    assert list(positions[0, 3:]) == [-1, -1] and np.isinf(distances[0, 3:]).all()
+
+
+def test_rescoring_passes_search_parameters():
+    rng = np.random.default_rng(2)
+    vectors = rng.standard_normal((50, DIM)).astype(np.float32)
+    rescoring = RescoringIndex(quantized_index(vectors), vectors, factor=4)
+    allowed = np.array([7, 11, 13], dtype=np.int64)
+    selector = faiss.IDSelectorBatch(allowed.size, faiss.swig_ptr(allowed))
+    distances, positions = rescoring.search(vectors[:2], 4, params=faiss.SearchParameters(sel=selector))
+    assert set(positions[positions != -1]) <= set(allowed)
+    assert (positions[:, 3] == -1).all() and np.isinf(distances[:, 3]).all()
+    assert base_index(rescoring) is rescoring.index and rescoring.ntotal == 50
+
+
+def test_vector_sidecar(tmp_path):
+    vectors = np.arange(2 * DIM, dtype=np.float32).reshape(2, DIM)
+    assert read_vector_sidecar(str(tmp_path)) is None
+    write_vector_sidecar(str(tmp_path), vectors)
+    assert (read_vector_sidecar(str(tmp_path)) == vectors).all()
+    assert needs_sidecar({'type': 'flat', 'storage': 'int8'}) and needs_sidecar({'type': 'ivf_pq'})
+    assert not needs_sidecar({'type': 'hnsw'})
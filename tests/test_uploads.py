@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+import src.build_cache as build_cache
+import src.uploads as uploads
+from src.uploads import UploadTooLarge, store_upload, upload_record
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads.cfg, 'UPLOAD_STATE_PATH', str(tmp_path / 'cache' / 'uploads'))
+    return str(tmp_path / 'assets' / 'temp')
+
+
+def test_only_the_upload_lands_in_the_served_directory(dirs):
+    result = store_upload([b'%PDF-', b'one'], 'a.pdf', dirs)
+    assert os.listdir(dirs) == ['a.pdf']
+    assert result['sha256'] == hashlib.sha256(b'%PDF-one').hexdigest()
+    assert upload_record('a.pdf', dirs) == result['file_record']
+    assert result['file_record']['size'] == 8
+
+
+def test_duplicate_and_replaced_uploads(dirs):
+    store_upload([b'one'], 'a.pdf', dirs)
+    duplicate = store_upload([b'one'], 'b.pdf', dirs)
+    assert duplicate['duplicate'] and duplicate['filename'] == 'a.pdf'
+    replaced = store_upload([b'two'], 'a.pdf', dirs)
+    assert replaced['replaced'] and not replaced['duplicate']
+    assert upload_record('a.pdf', dirs)['sha256'] == hashlib.sha256(b'two').hexdigest()
+    assert sorted(os.listdir(dirs)) == ['a.pdf']
+
+
+def test_too_large_upload_leaves_nothing(dirs):
+    with pytest.raises(UploadTooLarge):
+        store_upload([b'x' * 10, b'x' * 10], 'a.pdf', dirs, max_bytes=15)
+    assert os.listdir(dirs) == []
+    assert os.listdir(uploads._state_dir(dirs)) == []
+
+
+def test_legacy_index_leaves_the_served_directory(dirs):
+    os.makedirs(dirs)
+    with open(os.path.join(dirs, 'a.pdf'), 'wb') as f:
+        f.write(b'one')
+    with open(os.path.join(dirs, uploads.LEGACY_INDEX), 'w', encoding='utf8') as f:
+        json.dump({hashlib.sha256(b'one').hexdigest(): 'a.pdf'}, f)
+    assert upload_record('a.pdf', dirs) == {'sha256': hashlib.sha256(b'one').hexdigest()}
+    assert os.listdir(dirs) == ['a.pdf']
+    assert store_upload([b'one'], 'copy.pdf', dirs)['duplicate']
+
+
+def test_upload_hash_is_reused(dirs, monkeypatch):
+    result = store_upload([b'one'], 'a.pdf', dirs)
+    path = os.path.join(dirs, 'a.pdf')
+    build_cache.remember_file(path, result['file_record'])
+    monkeypatch.setattr(build_cache.hashlib, 'sha256', lambda *args: pytest.fail('uploaded file hashed again'))
+    assert build_cache.file_sha256(path) == result['sha256']
+    assert build_cache.file_record(path)['sha256'] == result['sha256']